@@ -0,0 +1,171 @@
+'''
+End-to-end benchmark of parse, combine and render on synthetic logs, with results stored as json for comparison.
+
+    python3 benchmarks/bench_pipeline.py --size_mb 512 --out results.json
+    python3 benchmarks/bench_pipeline.py --size_mb 512 --out new.json --compare results.json
+
+Each stage runs in a fresh process, so its peak RSS is not polluted by the stages before it. Rendering needs the
+graphviz `dot` binary, and is skipped without it.
+'''
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+import gen_tiflash_log  # noqa: E402
+
+RESULTS_VERSION = 1
+
+
+def _stage_parse(work_dir, jobs):
+    import main
+    log_dir = os.path.join(work_dir, 'log')
+    json_dir = os.path.join(work_dir, 'json')
+    os.makedirs(json_dir, exist_ok=True)
+    size = 0
+    for log_filename in sorted(os.listdir(log_dir)):
+        log_file = os.path.join(log_dir, log_filename)
+        size += os.path.getsize(log_file)
+        main._parse_one_log_to_file(log_file, json_dir, jobs)
+    return size / (1 << 20), 'MB'
+
+
+def _stage_combine(work_dir, jobs):
+    import main
+    json_dir = os.path.join(work_dir, 'json')
+    filename = main._combine_json_files(json_dir, ['cluster.ndjson'])
+    return os.path.getsize(filename) / (1 << 20), 'MB'
+
+
+def _stage_render(work_dir, jobs):
+    import main
+    json_path = os.path.join(work_dir, 'json', 'cluster.ndjson')
+    out_dir = os.path.join(work_dir, 'svg')
+    main._render_files(json_path, out_dir, main.RenderOptions(format='svg', jobs=jobs, use_cache=False))
+    return len([f for f in os.listdir(out_dir) if f.endswith('.dot')]), 'queries'
+
+
+def _stage_draw_tasks_dag(work_dir, jobs):
+    import main
+    import task_model
+    from visualize_task_json import draw_tasks_dag
+    queries = main._group_by_query(task_model.read_tasks(os.path.join(work_dir, 'json', 'cluster.ndjson')))
+    tasks = max(queries.values(), key=len)
+    # the largest query without collapsing, which is the worst case of the layout
+    draw_tasks_dag(tasks, os.path.join(work_dir, 'largest.dot'), 'svg', collapse_threshold=None)
+    return len(tasks), 'tasks'
+
+
+STAGES = [
+    ('parse', _stage_parse, False),
+    ('combine', _stage_combine, False),
+    ('render', _stage_render, True),
+    ('draw_tasks_dag', _stage_draw_tasks_dag, True),
+]
+
+
+def _run_stage(func, work_dir, jobs, queue):
+    sys.path.insert(0, SRC_DIR)
+    start = time.perf_counter()
+    amount, unit = func(work_dir, jobs)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on linux, and includes the worker processes through RUSAGE_CHILDREN
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        rss //= 1024
+    queue.put({'seconds': elapsed, 'peak_rss_mb': rss / 1024, 'amount': amount, 'unit': unit,
+               'throughput': amount / elapsed if elapsed > 0 else 0})
+
+
+def run_stage(func, work_dir, jobs):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_stage, args=(func, work_dir, jobs, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ''
+
+
+def compare(baseline, current):
+    print('{:<16} {:>12} {:>12} {:>9} {:>14} {:>14}'.format(
+        'stage', 'baseline(s)', 'current(s)', 'speedup', 'baseline(MB)', 'current(MB)'))
+    for name, _, _ in STAGES:
+        b = baseline['stages'].get(name)
+        c = current['stages'].get(name)
+        if b is None or c is None:
+            continue
+        print('{:<16} {:>12.3f} {:>12.3f} {:>8.2f}x {:>14.1f} {:>14.1f}'.format(
+            name, b['seconds'], c['seconds'], b['seconds'] / c['seconds'] if c['seconds'] > 0 else 0,
+            b['peak_rss_mb'], c['peak_rss_mb']))
+    if baseline.get('dataset') != current.get('dataset'):
+        print('warning: the datasets differ, generate them with the same arguments for a fair comparison')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    gen_tiflash_log.add_arguments(parser)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--work_dir', type=str, help='keep the generated logs and outputs here instead of a temporary dir')
+    parser.add_argument('--out', type=str, help='write the results to this json file')
+    parser.add_argument('--compare', type=str, help='results json of a previous run to compare with')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='flashprof_bench_')
+    try:
+        start = time.perf_counter()
+        dataset = gen_tiflash_log.generate_from_args(os.path.join(work_dir, 'log'), args)
+        dataset.pop('files')
+        print('generated {} queries, {} bytes in {:.2f}s'.format(dataset['queries'], dataset['bytes'], time.perf_counter() - start))
+        results = {
+            'version': RESULTS_VERSION,
+            'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'jobs': args.jobs,
+            'dataset': dataset,
+            'stages': {},
+        }
+        has_dot = shutil.which('dot') is not None
+        for name, func, needs_dot in STAGES:
+            if needs_dot and not has_dot:
+                print('{:<16} skipped, graphviz dot is not installed'.format(name))
+                continue
+            result = run_stage(func, work_dir, args.jobs)
+            results['stages'][name] = result
+            print('{:<16} {:>9.3f}s {:>12.1f} {}/s {:>9.1f} MB peak rss'.format(
+                name, result['seconds'], result['throughput'], result['unit'], result['peak_rss_mb']))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.out is not None:
+        with open(args.out, 'wt') as fd:
+            json.dump(results, fd, indent=1)
+    if args.compare is not None:
+        with open(args.compare, 'rt') as fd:
+            compare(json.load(fd), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+'''
+Single-core throughput of the mmap tracing line scanner against the previous regex path.
+
+    python3 benchmarks/bench_scanner.py --size_mb 256 --tracing_ratio 0.05
+'''
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import gen_tiflash_log  # noqa: E402
+import log_parser  # noqa: E402
+
+SAMPLE_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tracing.json')
+
+
+def _legacy_parse(log_file):
+    # the parser before the byte scanner, kept verbatim for comparison
+    ret = []
+    with open(log_file, 'r') as fd:
+        for line in fd:
+            match = re.search(r'\["(\{.+\})"\] \[source="mpp_task_tracing MPP<query:<[0-9a-zA-Z:_, ]+start_ts:\d+>,task_id:\d+>', line)
+            if match is None:
+                continue
+            json_str = match.group(1).replace('\\', '')
+            try:
+                data = json.loads(json_str)
+            except Exception as e:
+                logging.error('failed to load json: {}\n{}'.format(e, json_str))
+                continue
+            ret.append(data)
+    return ret
+
+
+def _scanner_parse(log_file):
+    return log_parser.parse_range(log_file, 0, os.path.getsize(log_file))
+
+
+# all lines are logged at the same time, which does not matter to the parsers
+LOG_TIME = 1637311166539000
+
+
+def write_log(filename, size, tracing_ratio):
+    with open(SAMPLE_JSON, 'rt') as fd:
+        records = json.load(fd)
+    written = 0
+    tracing = 0
+    i = 0
+    with open(filename, 'wt') as fd:
+        while written < size:
+            if tracing < tracing_ratio * (i + 1):
+                line = gen_tiflash_log.tracing_line(records[tracing % len(records)], LOG_TIME)
+                tracing += 1
+            else:
+                line = gen_tiflash_log.noise_line(i, LOG_TIME)
+            fd.write(line)
+            written += len(line)
+            i += 1
+    return i, tracing
+
+
+def _bench(name, func, log_file, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        records = func(log_file)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    size_mb = os.path.getsize(log_file) / (1 << 20)
+    print('{:<8} {:>10} records {:>8.3f}s {:>10.1f} MB/s'.format(name, len(records), best, size_mb / best))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size_mb', type=int, default=64)
+    parser.add_argument('--tracing_ratio', type=float, default=0.05, help='ratio of tracing lines among all lines')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        log_file = os.path.join(tmp_dir, 'tiflash.log')
+        lines, tracing = write_log(log_file, args.size_mb << 20, args.tracing_ratio)
+        print('{} MB, {} lines, {} tracing lines'.format(args.size_mb, lines, tracing))
+        legacy = _bench('regex', _legacy_parse, log_file, args.repeat)
+        scanner = _bench('scanner', _scanner_parse, log_file, args.repeat)
+        print('speedup {:.1f}x'.format(legacy / scanner))
+
+
+if __name__ == '__main__':
+    main()
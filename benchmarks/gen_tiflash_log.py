@@ -0,0 +1,248 @@
+'''
+Generate tiflash.log files of a synthetic cluster, with task tracing lines of MPP queries among noise lines.
+
+    python3 benchmarks/gen_tiflash_log.py --out_dir /tmp/cluster/log --hosts 3 --size_mb 1024
+
+Each host gets its own `$IP.tiflash.log`, like the log dir of `collect`, holding only the tasks running on it.
+A query is a tree of stages, leaf stages scanning tables and the others receiving from one (aggregation) or two
+(join) upstream stages, each stage having `--fanout` tasks exchanging data with every task of the downstream stage.
+Every task logs an INITIALIZING record when it is dispatched and a FINISHED or CANCELLED record when it ends, and
+lines are written in time order as queries overlap.
+'''
+import argparse
+import datetime
+import heapq
+import json
+import os
+import random
+
+TZ = datetime.timezone(datetime.timedelta(hours=8))
+ERROR_MESSAGE = 'Code: 0, e.displayText() = DB::Exception: Receive cancel request from TiDB, e.what() = DB::Exception'
+
+
+def log_time(ts):
+    '''
+    Prefix of a log line written at ts, in microseconds.
+    '''
+    t = datetime.datetime.fromtimestamp(ts / 1000000, TZ)
+    return '[{}.{:03d} +08:00]'.format(t.strftime('%Y/%m/%d %H:%M:%S'), t.microsecond // 1000)
+
+
+def tracing_line(record, ts):
+    payload = json.dumps(record, separators=(',', ':')).replace('\\', '\\\\').replace('"', '\\"')
+    return '{} [DEBUG] [<unknown>] ["{}"] [source="mpp_task_tracing MPP<query:<query_ts:1, local_query_id:1, ' \
+        'server_id:1, start_ts:{}>,task_id:{}>"] [thread_id=1]\n'.format(
+            log_time(ts), payload, record['query_tso'], record['task_id'])
+
+
+def noise_line(i, ts):
+    return '{} [INFO] [DeltaMergeStore.cpp:1135] ["Write into segment, rows={}"] [source="db_2.t_{}"] ' \
+        '[thread_id=12]\n'.format(log_time(ts), i, i % 97)
+
+
+class QueryGenerator:
+    '''
+    Task records of synthetic queries, as (timestamp, host, record) log events.
+    '''
+
+    def __init__(self, hosts, tasks_per_query, fanout, error_rate, seed=0):
+        self.hosts = hosts
+        self.tasks_per_query = tasks_per_query
+        self.fanout = fanout
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.query_tso = 429211298412363778
+
+    def _plan(self):
+        '''
+        Returns the upstream stages of each stage, stage 0 being the root.
+        '''
+        n = max(1, round(self.tasks_per_query / self.fanout))
+        upstreams = [[] for _ in range(n)]
+        for stage in range(1, n):
+            parents = [s for s in range(stage) if len(upstreams[s]) < 2]
+            upstreams[self.random.choice(parents)].append(stage)
+        return upstreams
+
+    def _executors(self, upstreams, task_ids, next_id, targets):
+        r = self.random
+        ids = iter(range(next_id, next_id + 8))
+        sender = {'id': next(ids), 'type': 'ExchangeSender', 'sender_target_task_ids': targets, 'children': []}
+        if not upstreams:
+            scan = {'id': next(ids), 'type': 'TableFullScan', 'children': []}
+            selection = {'id': next(ids), 'type': 'Selection', 'rows_selectivity': r.random(), 'blocks_selectivity': 1,
+                         'bytes_selectivity': r.random(), 'avg_rows_per_block': r.randint(1, 8192),
+                         'avg_bytes_per_block': r.randint(1, 1 << 20), 'children': [scan['id']]}
+            agg = {'id': next(ids), 'type': 'HashAgg', 'rows_selectivity': r.random(), 'blocks_selectivity': 1,
+                   'bytes_selectivity': r.random(), 'hash_table_rows': r.randint(1, 100000), 'children': [selection['id']]}
+            sender['children'] = [agg['id']]
+            return [sender, agg, selection, scan]
+        receivers = [{'id': next(ids), 'type': 'ExchangeReceiver', 'receiver_source_task_ids': task_ids[u], 'children': []}
+                     for u in upstreams]
+        if len(receivers) == 1:
+            op = {'id': next(ids), 'type': 'HashAgg', 'rows_selectivity': r.random(), 'blocks_selectivity': 1,
+                  'bytes_selectivity': r.random(), 'hash_table_rows': r.randint(1, 100000),
+                  'children': [receivers[0]['id']]}
+        else:
+            op = {'id': next(ids), 'type': 'HashJoin', 'probe_rows_selectivity': r.random(), 'probe_blocks_selectivity': 1,
+                  'probe_bytes_selectivity': r.random() * 4, 'hash_table_bytes': r.randint(1, 1 << 24),
+                  'process_time_for_build': r.randint(0, 1000), 'children': [e['id'] for e in receivers]}
+        projection = {'id': next(ids), 'type': 'Projection', 'children': [op['id']]}
+        sender['children'] = [projection['id']]
+        return receivers + [sender, op, projection]
+
+    def query(self, start):
+        '''
+        Returns the log events of a query started at start, in microseconds.
+        '''
+        r = self.random
+        self.query_tso += r.randint(1, 1 << 16)
+        upstreams = self._plan()
+        downstream = {u: s for s, us in enumerate(upstreams) for u in us}
+        task_ids = {}
+        next_task_id = 1
+        for stage in range(len(upstreams)):
+            task_ids[stage] = list(range(next_task_id, next_task_id + self.fanout))
+            next_task_id += self.fanout
+
+        events = []
+        ends = {}
+        next_executor_id = 1
+        # upstream stages have larger numbers, so they are generated first
+        for stage in reversed(range(len(upstreams))):
+            targets = task_ids[downstream[stage]] if stage in downstream else [-1]
+            executors = self._executors(upstreams[stage], task_ids, next_executor_id, targets)
+            next_executor_id += len(executors)
+            upstream_end = max((ends[u] for u in upstreams[stage]), default=0)
+            stage_ends = []
+            for i, task_id in enumerate(task_ids[stage]):
+                init = start + r.randint(0, 2000)
+                task_start = init + r.randint(100, 1000)
+                compile_start = task_start + r.randint(100, 2000)
+                wait_index_start = wait_index_end = 0
+                if not upstreams[stage]:
+                    wait_index_start = compile_start + r.randint(100, 1000)
+                    wait_index_end = wait_index_start + int(r.expovariate(1 / 5000))
+                compile_end = max(compile_start, wait_index_end) + r.randint(1000, 30000)
+                end = max(compile_end, upstream_end) + int(r.lognormvariate(9, 1))
+                stage_ends.append(end)
+                failed = r.random() < self.error_rate
+                record = {
+                    'query_tso': self.query_tso,
+                    'task_id': task_id,
+                    'sender_executor_id': executors[len(upstreams[stage])]['id'],
+                    'executors': executors,
+                    'host': self.hosts[i % len(self.hosts)],
+                    'task_init_timestamp': init,
+                    'compile_start_timestamp': 0,
+                    'wait_index_start_timestamp': 0,
+                    'wait_index_end_timestamp': 0,
+                    'compile_end_timestamp': 0,
+                    'task_start_timestamp': 0,
+                    'task_end_timestamp': 0,
+                    'status': 'INITIALIZING',
+                    'error_message': '',
+                    'local_input_throughput': 0,
+                    'remote_input_throughput': 0,
+                    'output_throughput': 0,
+                    'cpu_usage': 0,
+                    'memory_peak': 0,
+                }
+                events.append((init, record['host'], record))
+                seconds = (end - task_start) / 1000000
+                final = dict(record)
+                final.update({
+                    'compile_start_timestamp': compile_start,
+                    'wait_index_start_timestamp': wait_index_start,
+                    'wait_index_end_timestamp': wait_index_end,
+                    'compile_end_timestamp': compile_end,
+                    'task_start_timestamp': task_start,
+                    'task_end_timestamp': end,
+                    'status': 'CANCELLED' if failed else 'FINISHED',
+                    'error_message': ERROR_MESSAGE if failed else '',
+                    'local_input_throughput': 0 if upstreams[stage] else r.randint(1, 1 << 30) / seconds,
+                    'remote_input_throughput': r.randint(1, 1 << 26) / seconds if upstreams[stage] else 0,
+                    'output_throughput': r.randint(1, 1 << 26) / seconds,
+                    'memory_peak': r.randint(0, 1 << 30),
+                })
+                events.append((end, final['host'], final))
+            ends[stage] = max(stage_ends)
+        return events
+
+
+def generate(out_dir, hosts=3, size_mb=None, queries=1000, tasks_per_query=12, fanout=3, tracing_ratio=0.05,
+             error_rate=0.01, seed=0, start=1637311166000000):
+    '''
+    Write the logs of a synthetic cluster to out_dir, until size_mb megabytes if given, or else until queries queries.
+    Returns a summary of what was written.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    names = ['10.0.1.{}'.format(i + 1) for i in range(hosts)]
+    generator = QueryGenerator(['{}:3930'.format(n) for n in names], tasks_per_query, fanout, error_rate, seed)
+    files = {'{}:3930'.format(n): open(os.path.join(out_dir, '{}.tiflash.log'.format(n)), 'wt') for n in names}
+    noise_per_line = (1 - tracing_ratio) / tracing_ratio
+    noise_debt = {host: 0.0 for host in files}
+    written = tracing = noise = generated = 0
+    # events of the queries in flight, popped in time order while the next queries start
+    pending = []
+    seq = 0
+    now = start
+    try:
+        while True:
+            done = written >= size_mb * (1 << 20) if size_mb is not None else generated >= queries
+            if not done:
+                for ts, host, record in generator.query(now):
+                    heapq.heappush(pending, (ts, seq, host, record))
+                    seq += 1
+                generated += 1
+                now += int(generator.random.expovariate(1 / 20000))
+            while pending and (done or pending[0][0] < now):
+                ts, _, host, record = heapq.heappop(pending)
+                fd = files[host]
+                line = tracing_line(record, ts)
+                fd.write(line)
+                written += len(line)
+                tracing += 1
+                noise_debt[host] += noise_per_line
+                while noise_debt[host] >= 1:
+                    line = noise_line(noise, ts)
+                    fd.write(line)
+                    written += len(line)
+                    noise += 1
+                    noise_debt[host] -= 1
+            if done and not pending:
+                break
+    finally:
+        for fd in files.values():
+            fd.close()
+    return {'hosts': hosts, 'queries': generated, 'tracing_lines': tracing, 'noise_lines': noise, 'bytes': written,
+            'files': sorted(fd.name for fd in files.values())}
+
+
+def add_arguments(parser):
+    parser.add_argument('--hosts', type=int, default=3)
+    parser.add_argument('--size_mb', type=int, help='total size of the logs, generate --queries queries if not given')
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--tasks_per_query', type=int, default=12)
+    parser.add_argument('--fanout', type=int, default=3, help='number of tasks of each stage')
+    parser.add_argument('--tracing_ratio', type=float, default=0.05, help='ratio of tracing lines among all lines')
+    parser.add_argument('--error_rate', type=float, default=0.01, help='ratio of cancelled tasks')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def generate_from_args(out_dir, args):
+    return generate(out_dir, args.hosts, args.size_mb, args.queries, args.tasks_per_query, args.fanout,
+                    args.tracing_ratio, args.error_rate, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out_dir', type=str, required=True)
+    add_arguments(parser)
+    args = parser.parse_args()
+    summary = generate_from_args(args.out_dir, args)
+    print(json.dumps(summary, indent=1))
+
+
+if __name__ == '__main__':
+    main()
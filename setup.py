@@ -28,5 +28,10 @@ setup(
         'graphviz',
         'paramiko',
         'pyyaml'
-    ]
+    ],
+    extras_require={
+        'stats': ['numpy'],
+        'csv': ['pandas'],
+        'zstd': ['zstandard']
+    }
 )
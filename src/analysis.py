@@ -0,0 +1,277 @@
+import logging
+import statistics
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+# phases of a task on the critical path, in the order they happen, `other` being the gaps between them
+PHASES = ['schedule', 'compile', 'wait_index', 'wait_upstream', 'execute', 'other']
+# on the critical path, the time a task waits on its upstream is the execute of the upstream, so it is left out
+CRITICAL_PHASES = [p for p in PHASES if p != 'wait_upstream']
+# a task taking this many times the median duration of the tasks of its stage is a straggler
+STRAGGLER_RATIO = 2.0
+
+
+def _ts(task, key):
+    # missing timestamps are logged as 0
+    return task.get(key) or None
+
+
+def _span(start, end, since=None, until=None):
+    if start is None or end is None:
+        return 0
+    if since is not None:
+        start = max(start, since)
+    if until is not None:
+        end = min(end, until)
+    return max(0, end - start)
+
+
+def _ready(task):
+    # when a task is compiled and only waits on its upstream
+    return _ts(task, 'compile_end_timestamp') or _ts(task, 'task_start_timestamp')
+
+
+def upstream_task_ids(task) -> List[int]:
+    '''
+    Ids of the tasks sending data to this task, collected from the receivers among its executors.
+    '''
+    ret = []
+    for e in task.get('executors') or []:
+        ret.extend(e.get('receiver_source_task_ids', []))
+    return ret
+
+
+def phase_breakdown(task, upstream=None, since=None, until=None) -> Dict[str, int]:
+    '''
+    Split the life of a task into PHASES, in microseconds, only counting the time between `since` and `until` if
+    given.
+    Waiting on index is part of compiling in tiflash, so it is subtracted from compile.
+    wait_upstream is the time between the end of compiling and the end of the upstream task, during which this task
+    can not finish whatever it does.
+    '''
+    init = _ts(task, 'task_init_timestamp')
+    start = _ts(task, 'task_start_timestamp')
+    compile_start = _ts(task, 'compile_start_timestamp')
+    compile_end = _ts(task, 'compile_end_timestamp')
+    wait_index_start = _ts(task, 'wait_index_start_timestamp')
+    wait_index_end = _ts(task, 'wait_index_end_timestamp')
+    end = _ts(task, 'task_end_timestamp')
+    ready = _ready(task)
+    upstream_end = _ts(upstream, 'task_end_timestamp') if upstream is not None else None
+    if upstream_end is not None and ready is not None and end is not None:
+        upstream_end = min(max(upstream_end, ready), end)
+    else:
+        upstream_end = ready
+    wait_index = _span(wait_index_start, wait_index_end, since, until)
+    phases = {
+        'schedule': _span(init, start, since, until),
+        'compile': max(0, _span(compile_start, compile_end, since, until) - wait_index),
+        'wait_index': wait_index,
+        'wait_upstream': _span(ready, upstream_end, since, until),
+        'execute': _span(upstream_end, end, since, until),
+    }
+    begin = init if since is None else since
+    phases['other'] = max(0, _span(begin, end, until=until) - sum(phases.values()))
+    return phases
+
+
+def critical_path(tasks) -> List[Dict]:
+    '''
+    The chain of tasks that determines the latency of a query, from a leaf task to the root task.
+    Starting from the root, which is the last finishing task that sends data to no other task of the query, we walk
+    to the upstream task that finishes last, until a task with no upstream. Each task and exchange edge is visited
+    at most once, so this is linear in the size of the query.
+    `phases` is the breakdown of the whole life of each task into PHASES, while `critical_phases` only accounts a task
+    for the time after its upstream on the path finishes, into CRITICAL_PHASES: the time a task waits on its upstream
+    is the execute of the upstream, and the critical_phases of all the tasks add up to the length of the path.
+    Returns a list of {task_id, host, duration, phases, critical_phases}, leaf first.
+    '''
+    by_id = {t['task_id']: t for t in tasks}
+    if not by_id:
+        return []
+    upstreams = {task_id: [i for i in upstream_task_ids(t) if i in by_id] for task_id, t in by_id.items()}
+    senders = set(i for ids in upstreams.values() for i in ids)
+    roots = [t for task_id, t in by_id.items() if task_id not in senders] or list(by_id.values())
+    cur = max(roots, key=lambda t: t.get('task_end_timestamp') or 0)
+
+    chain = [cur]
+    visited = {cur['task_id']}
+    while True:
+        candidates = [by_id[i] for i in upstreams[cur['task_id']] if i not in visited]
+        if not candidates:
+            break
+        cur = max(candidates, key=lambda t: t.get('task_end_timestamp') or 0)
+        visited.add(cur['task_id'])
+        chain.append(cur)
+    chain.reverse()
+
+    # boundaries[i] is where the critical time of chain[i - 1] stops and the one of chain[i] starts
+    boundaries = [None]
+    for upstream, task in zip(chain, chain[1:]):
+        boundary = _ts(upstream, 'task_end_timestamp') or _ready(task)
+        if boundary is not None and boundaries[-1] is not None:
+            boundary = max(boundary, boundaries[-1])
+        boundaries.append(boundary)
+    boundaries.append(None)
+
+    ret = []
+    for i, task in enumerate(chain):
+        upstream = chain[i - 1] if i > 0 else None
+        critical = phase_breakdown(task, upstream, boundaries[i], boundaries[i + 1])
+        ret.append({
+            'task_id': task['task_id'],
+            'host': task.get('host', ''),
+            'duration': _span(_ts(task, 'task_init_timestamp'), _ts(task, 'task_end_timestamp')),
+            'phases': phase_breakdown(task, upstream),
+            'critical_phases': {phase: critical[phase] for phase in CRITICAL_PHASES},
+        })
+    return ret
+
+
+def query_duration(tasks):
+    inits = [t['task_init_timestamp'] for t in tasks if t.get('task_init_timestamp')]
+    ends = [t['task_end_timestamp'] for t in tasks if t.get('task_end_timestamp')]
+    if not inits or not ends:
+        return 0
+    return max(0, max(ends) - min(inits))
+
+
+def _skew(values):
+    '''
+    max/median of values, None if the median is 0.
+    '''
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    median = statistics.median(values)
+    return max(values) / median if median > 0 else None
+
+
+def _task_duration(task):
+    return _span(_ts(task, 'task_init_timestamp'), _ts(task, 'task_end_timestamp'))
+
+
+def stage_skew(tasks, straggler_ratio=STRAGGLER_RATIO) -> List[Dict]:
+    '''
+    Skew of each stage of a query, i.e. the tasks sharing a sender_executor_id, as the max/median ratio of the
+    durations and throughputs of its tasks. Tasks taking at least straggler_ratio times the median duration of their
+    stage are stragglers, slowest first.
+    Returns a list of {sender_executor_id, task_count, median_duration, duration_skew, input_throughput_skew,
+    output_throughput_skew, stragglers}, sorted by sender_executor_id.
+    '''
+    stages = defaultdict(list)
+    for task in tasks:
+        stages[task['sender_executor_id']].append(task)
+    ret = []
+    for sender_executor_id, stage_tasks in sorted(stages.items()):
+        durations = [_task_duration(t) for t in stage_tasks]
+        median = statistics.median(durations)
+        stragglers = []
+        if len(stage_tasks) > 1 and median > 0:
+            for task, duration in zip(stage_tasks, durations):
+                if duration >= straggler_ratio * median:
+                    stragglers.append({'task_id': task['task_id'], 'host': task.get('host', ''), 'duration': duration,
+                                       'ratio': duration / median})
+        stragglers.sort(key=lambda s: s['duration'], reverse=True)
+        ret.append({
+            'sender_executor_id': sender_executor_id,
+            'task_count': len(stage_tasks),
+            'median_duration': median,
+            'duration_skew': _skew(durations),
+            'input_throughput_skew': _skew(
+                (t.get('local_input_throughput') or 0) + (t.get('remote_input_throughput') or 0) for t in stage_tasks),
+            'output_throughput_skew': _skew(t.get('output_throughput') for t in stage_tasks),
+            'stragglers': stragglers,
+        })
+    return ret
+
+
+def stragglers(tasks, straggler_ratio=STRAGGLER_RATIO):
+    '''
+    Ids of the straggler tasks of a query, see stage_skew.
+    '''
+    return set(s['task_id'] for stage in stage_skew(tasks, straggler_ratio) for s in stage['stragglers'])
+
+
+def analyze_query(query_tso, tasks):
+    '''
+    Critical path analysis of a single query, as a json-serializable dict.
+    '''
+    path = critical_path(tasks)
+    totals = {phase: sum(p['critical_phases'][phase] for p in path) for phase in CRITICAL_PHASES}
+    logging.debug('query_tso [{}] critical path {}'.format(query_tso, [p['task_id'] for p in path]))
+    return {
+        'query_tso': query_tso,
+        'task_count': len(tasks),
+        'duration': query_duration(tasks),
+        'critical_path': path,
+        'phases': totals,
+        'skew': stage_skew(tasks),
+        'host_task_count': dict(Counter(t.get('host', '') for t in tasks)),
+    }
+
+
+def host_rollup(reports):
+    '''
+    Which hosts straggle most often across the reports of analyze_query, as a list of {host, stragglers, tasks,
+    queries, straggler_rate}, most stragglers first. queries is the number of queries in which the host has a
+    straggler.
+    '''
+    hosts = defaultdict(lambda: {'stragglers': 0, 'tasks': 0, 'queries': 0})
+    for report in reports:
+        for host, count in report['host_task_count'].items():
+            hosts[host]['tasks'] += count
+        straggling = defaultdict(int)
+        for stage in report['skew']:
+            for s in stage['stragglers']:
+                straggling[s['host']] += 1
+        for host, count in straggling.items():
+            hosts[host]['stragglers'] += count
+            hosts[host]['queries'] += 1
+    ret = []
+    for host, row in hosts.items():
+        ret.append(dict(host=host, straggler_rate=row['stragglers'] / row['tasks'] if row['tasks'] else 0, **row))
+    ret.sort(key=lambda r: (r['stragglers'], r['straggler_rate']), reverse=True)
+    return ret
+
+
+def format_report(report):
+    '''
+    Human readable lines of a report of analyze_query, durations in milliseconds.
+    Each task on the path is shown with the phases of its whole life, followed by the length of the path attributed
+    to each of CRITICAL_PHASES, and the skew of each stage.
+    '''
+    lines = ['query_tso [{}], {} tasks, duration {:.3f}ms, critical path {}'.format(
+        report['query_tso'], report['task_count'], report['duration'] / 1000,
+        ' -> '.join(str(p['task_id']) for p in report['critical_path']))]
+    lines.append('  {:>8} {:<22}'.format('task_id', 'host') + ''.join(' {:>14}'.format(p) for p in PHASES))
+    for p in report['critical_path']:
+        lines.append('  {:>8} {:<22}'.format(p['task_id'], p['host']) +
+                     ''.join(' {:>14.3f}'.format(p['phases'][phase] / 1000) for phase in PHASES))
+    lines.append('  {:>8} {:<22}'.format('critical', '') +
+                 ''.join(' {:>14.3f}'.format(report['phases'][phase] / 1000) if phase in report['phases']
+                         else ' {:>14}'.format('-') for phase in PHASES))
+    lines.append('  {:>8} {:>6} {:>14} {:>10} {:>10} {:>10}  {}'.format(
+        'stage', 'tasks', 'median(ms)', 'duration', 'input', 'output', 'stragglers (max/median)'))
+    for stage in report['skew']:
+        lines.append('  {:>8} {:>6} {:>14.3f} {:>10} {:>10} {:>10}  {}'.format(
+            stage['sender_executor_id'], stage['task_count'], stage['median_duration'] / 1000,
+            _fmt_skew(stage['duration_skew']), _fmt_skew(stage['input_throughput_skew']),
+            _fmt_skew(stage['output_throughput_skew']),
+            ', '.join('{}@{} ({:.2f}x)'.format(s['task_id'], s['host'], s['ratio']) for s in stage['stragglers'])).rstrip())
+    return lines
+
+
+def _fmt_skew(value):
+    return '{:.2f}x'.format(value) if value is not None else '-'
+
+
+def format_host_rollup(rows):
+    '''
+    Human readable lines of host_rollup.
+    '''
+    lines = ['{:<22} {:>10} {:>10} {:>10} {:>10}'.format('host', 'stragglers', 'tasks', 'rate', 'queries')]
+    for r in rows:
+        lines.append('{:<22} {:>10} {:>10} {:>9.2f}% {:>10}'.format(
+            r['host'], r['stragglers'], r['tasks'], r['straggler_rate'] * 100, r['queries']))
+    return lines
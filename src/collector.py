@@ -0,0 +1,593 @@
+import io
+import json
+import logging
+import os
+import shlex
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from os.path import expanduser
+
+import paramiko
+import yaml
+
+import profiler
+import utils
+
+HOME_DIR = expanduser("~")
+# size of each read from the ssh channel and of each write to the local file
+CHUNK_SIZE = 1 << 20
+# how far back from the end of a growing log we look for the last complete line
+LAST_LINE_LOOKBACK = 1 << 16
+# size of each random read while searching a log for the bounds of a time window
+SEARCH_BLOCK = 1 << 16
+# every tiflash log line starts with e.g. `[2021/11/19 16:39:26.539 +08:00]`
+LINE_TIME_FORMAT = '[%Y/%m/%d %H:%M:%S.%f %z]'
+LINE_TIME_LENGTH = len('[2021/11/19 16:39:26.539 +08:00]')
+# the parsing agent uploaded to each tiflash host with --agent
+AGENT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flashprof_agent.py')
+# prints the first python able to run the agent, or exits with 1 if there is none
+PYTHON_PROBE = ('for p in python3 python; do '
+                '$p -c "import sys; sys.exit(sys.version_info < (3, 5))" 2>/dev/null && echo $p && exit 0; '
+                'done; exit 1')
+# a new directory only the collecting user can access, for the agent
+AGENT_MKTEMP = 'mktemp -d "${TMPDIR:-/tmp}/flashprof_agent.XXXXXXXX"'
+
+
+class CollectOptions:
+    '''
+    Options shared by every host of a single `collect` run.
+    If manifest_dir is set, collection is incremental: only log bytes appended since the last run are fetched and
+    appended to the local log, and a per-host manifest of consumed files is kept in manifest_dir.
+    If since or until is set, only the part of the logs written in that window is read, both being timestamps in
+    microseconds.
+    storage_compression is one of utils.COMPRESSIONS to store the local logs compressed, or None.
+    If agent is set, flashprof_agent.py is run on each host to parse and reduce its logs there, hosts without a usable
+    python fall back to grep.
+    '''
+
+    def __init__(self, tso=None, timeout=600, retries=2, compress=False, manifest_dir=None, since=None, until=None,
+                 storage_compression=None, agent=False):
+        self.tso = tso
+        self.timeout = timeout
+        self.retries = retries
+        self.compress = compress
+        self.manifest_dir = manifest_dir
+        self.since = since
+        self.until = until
+        self.storage_compression = storage_compression
+        self.agent = agent
+
+    @property
+    def incremental(self):
+        return self.manifest_dir is not None
+
+    @property
+    def windowed(self):
+        return self.since is not None or self.until is not None
+
+
+class HostResult:
+    '''
+    Collection outcome of a single tiflash server, used for the summary printed at the end of `collect`.
+    '''
+
+    def __init__(self, host):
+        self.host = host
+        self.ok = False
+        self.bytes_transferred = 0
+        self.bytes_written = 0
+        self.duration = 0.0
+        self.attempts = 0
+        self.error = ''
+
+
+def get_tiup_config(cluster_name):
+    cluster_dir = '{}/.tiup/storage/cluster/clusters/{}/'.format(HOME_DIR, cluster_name)
+    ssh_key_file = '{}/ssh/id_rsa'.format(cluster_dir)
+    logging.debug('cluster_dir = {}'.format(cluster_dir))
+    meta_filename = '{}/meta.yaml'.format(cluster_dir)
+    fd = open(meta_filename, 'r')
+    meta = yaml.safe_load(fd.read())
+    fd.close()
+    username = meta['user']
+    tiflash_servers = meta['topology']['tiflash_servers']
+    return username, ssh_key_file, tiflash_servers
+
+
+def _connect(host, port, username, ssh_key_file, timeout):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(host, port, username, key_filename=ssh_key_file,
+                timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+    return ssh
+
+
+def _grep_pattern(tso):
+    if tso is None:
+        return r'"\"mpp_task_tracing MPP<query:<[0-9a-zA-Z:_, ]+start_ts:\d+>,task_id:\d+>"'
+    return r'"\"mpp_task_tracing MPP<query:<[0-9a-zA-Z:_, ]+start_ts:{}>,task_id:\d+>"'.format(tso)
+
+
+def _grep_command(remote_log_filename, tso):
+    return 'grep -P {} {}'.format(_grep_pattern(tso), remote_log_filename)
+
+
+def _exec(ssh, command, timeout):
+    stdin, stdout, stderr = ssh.exec_command(command, timeout=timeout)
+    out = stdout.read()
+    err = stderr.read()
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        raise RuntimeError('remote command `{}` exited with {}: {}'.format(
+            command, exit_status, err.decode(errors='replace').strip()))
+    return out.decode()
+
+
+def _list_remote_logs(ssh, remote_log_dir, timeout):
+    '''
+    List tiflash.log and its rotated files, oldest first, as a list of {name, inode, size}.
+    Rotated files compressed by the logger are skipped, they cannot be read by byte offset.
+    '''
+    command = "find {} -maxdepth 1 -type f -name 'tiflash.log*' ! -name '*.gz' -printf '%i %s %T@ %f\\n'".format(
+        shlex.quote(remote_log_dir))
+    files = []
+    for line in _exec(ssh, command, timeout).splitlines():
+        inode, size, mtime, name = line.split(' ', 3)
+        files.append({'name': name, 'inode': inode, 'size': int(size), 'mtime': float(mtime)})
+    # the file being written is always the newest one
+    files.sort(key=lambda f: (f['name'] == 'tiflash.log', f['mtime']))
+    return files
+
+
+def _last_line_end(sftp, path, size):
+    '''
+    Returns the offset just after the last newline before size, so a line being written is left for the next run.
+    '''
+    start = max(0, size - LAST_LINE_LOOKBACK)
+    with sftp.open(path, 'rb') as fd:
+        fd.seek(start)
+        data = fd.read(size - start)
+    pos = data.rfind(b'\n')
+    return start + pos + 1 if pos >= 0 else start
+
+
+def _read_manifest(manifest_dir, host):
+    filename = os.path.join(manifest_dir, '{}.json'.format(host))
+    if not os.path.exists(filename):
+        return {'files': {}}
+    with open(filename, 'rt') as fd:
+        return json.load(fd)
+
+
+def _write_manifest(manifest_dir, host, manifest):
+    filename = os.path.join(manifest_dir, '{}.json'.format(host))
+    with open(filename + '.tmp', 'wt') as fd:
+        json.dump(manifest, fd, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def _plan_incremental(ssh, remote_log_dir, manifest, timeout):
+    '''
+    Decide which byte ranges of the remote logs have not been collected yet.
+    Files are tracked by inode, so a tiflash.log renamed by log rotation keeps its offset and is finished under its
+    new name, while the new tiflash.log is read from the beginning.
+    Returns ([(path, start, end)], new_manifest).
+    '''
+    consumed = manifest['files']
+    ranges = []
+    files = {}
+    sftp = None
+    try:
+        for f in _list_remote_logs(ssh, remote_log_dir, timeout):
+            path = os.path.join(remote_log_dir, f['name'])
+            start = 0
+            previous = consumed.get(f['inode'])
+            # a rotated file never becomes tiflash.log again, so this means the inode has been reused
+            reused = previous is not None and f['name'] == 'tiflash.log' and previous['name'] != 'tiflash.log'
+            if previous is not None and not reused and f['size'] >= previous['offset']:
+                start = previous['offset']
+            end = f['size']
+            if f['name'] == 'tiflash.log' and end > start:
+                if sftp is None:
+                    sftp = ssh.open_sftp()
+                end = max(start, _last_line_end(sftp, path, end))
+            if end > start:
+                ranges.append((path, start, end))
+            files[f['inode']] = {'name': f['name'], 'offset': end}
+    finally:
+        if sftp is not None:
+            sftp.close()
+    return ranges, {'files': files, 'updated_at': time.time()}
+
+
+def _line_time(line):
+    '''
+    Returns the timestamp of a log line in microseconds, or None if it does not start with one, e.g. the lines of a
+    multi-line message.
+    '''
+    try:
+        t = datetime.strptime(line[:LINE_TIME_LENGTH].decode(), LINE_TIME_FORMAT)
+    except ValueError:
+        return None
+    return int(t.timestamp()) * 1000000 + t.microsecond
+
+
+def _iter_line_times(fd, offset, size):
+    '''
+    Yields (line_start, timestamp) of the timestamped lines starting at or after offset, reading SEARCH_BLOCK bytes at
+    a time. A line started before offset is skipped.
+    '''
+    fd.seek(offset)
+    buf = b''
+    pos = offset
+    skip_partial = offset > 0
+    while pos < size:
+        data = fd.read(min(SEARCH_BLOCK, size - pos))
+        if not data:
+            return
+        pos += len(data)
+        buf += data
+        base = pos - len(buf)
+        start = 0
+        if skip_partial:
+            # the byte before offset decides whether offset is a line start
+            nl = buf.find(b'\n')
+            if nl < 0:
+                buf = b''
+                continue
+            start = nl + 1
+            skip_partial = False
+        while True:
+            end = buf.find(b'\n', start)
+            if end < 0:
+                break
+            ts = _line_time(buf[start:end])
+            if ts is not None:
+                yield base + start, ts
+            start = end + 1
+        buf = buf[start:]
+
+
+def _time_lower_bound(fd, size, t):
+    '''
+    Binary search the offset of the first line whose timestamp is >= t, or size if there is none.
+    Each step reads a single block at a random offset, so only O(log(size)) blocks are read.
+    '''
+    lo, hi = 0, size
+    while hi - lo > SEARCH_BLOCK:
+        mid = (lo + hi) // 2
+        # a line starting at or after mid, any line starting between mid - 1 and it has no timestamp
+        found = next(_iter_line_times(fd, max(0, mid - 1), size), None)
+        if found is None or found[1] >= t:
+            hi = mid
+        else:
+            lo = found[0] + 1
+    for line_start, ts in _iter_line_times(fd, max(0, lo - 1), size):
+        if ts >= t:
+            return line_start
+    return size
+
+
+def _plan_window(ssh, remote_log_dir, since, until, timeout):
+    '''
+    Decide which byte ranges of the remote logs were written between since and until, both in microseconds and
+    optional, by binary searching line timestamps over sftp, so the remote host only reads the window.
+    Returns [(path, start, end)].
+    '''
+    ranges = []
+    sftp = ssh.open_sftp()
+    try:
+        for f in _list_remote_logs(ssh, remote_log_dir, timeout):
+            path = os.path.join(remote_log_dir, f['name'])
+            size = f['size']
+            if f['name'] == 'tiflash.log':
+                size = _last_line_end(sftp, path, size)
+            with sftp.open(path, 'rb') as fd:
+                start = 0 if since is None else _time_lower_bound(fd, size, since)
+                end = size if until is None else _time_lower_bound(fd, size, until + 1)
+            logging.debug('window of {} is [{}, {}) of {} bytes'.format(path, start, end, size))
+            if end > start:
+                ranges.append((path, start, end))
+    finally:
+        sftp.close()
+    return ranges
+
+
+def _range_grep_command(ranges, tso):
+    '''
+    Grep tracing lines out of the byte range [start, end) of each file, in order.
+    '''
+    reads = ['tail -c +{} {} | head -c {}'.format(start + 1, shlex.quote(path), end - start) for path, start, end in ranges]
+    return '{{ {}; }} | {}'.format('; '.join(reads), 'grep -P {}'.format(_grep_pattern(tso)))
+
+
+def _upload_agent(ssh, timeout):
+    '''
+    Upload flashprof_agent.py into a new directory only the collecting user can access, made by mktemp on the remote
+    host, so no other user can swap it before it runs. Returns the remote directory, to be removed by _remove_agent.
+    '''
+    with open(AGENT_SOURCE, 'rb') as fd:
+        source = fd.read()
+    remote_dir = _exec(ssh, AGENT_MKTEMP, timeout).strip()
+    try:
+        sftp = ssh.open_sftp()
+        try:
+            sftp.putfo(io.BytesIO(source), remote_dir + '/flashprof_agent.py')
+        finally:
+            sftp.close()
+    except Exception:
+        _remove_agent(ssh, remote_dir, timeout)
+        raise
+    return remote_dir
+
+
+def _remove_agent(ssh, remote_dir, timeout):
+    try:
+        _exec(ssh, 'rm -rf -- {}'.format(shlex.quote(remote_dir)), timeout)
+    except Exception as e:
+        logging.warning('failed to remove the agent in {}: {}'.format(remote_dir, e))
+
+
+def _prepare_agent(ssh, host, timeout):
+    '''
+    Upload the agent, returns (argv prefix running it, remote directory of it), or None to fall back to grep if the
+    host has no python >= 3.5 or the upload fails.
+    '''
+    try:
+        python = _exec(ssh, PYTHON_PROBE, timeout).strip()
+    except RuntimeError:
+        logging.warning('no python >= 3.5 on {}, fall back to grep'.format(host))
+        return None
+    try:
+        remote_dir = _upload_agent(ssh, timeout)
+    except (OSError, RuntimeError, paramiko.SSHException) as e:
+        logging.warning('failed to upload the agent to {}, fall back to grep: {}'.format(host, e))
+        return None
+    return [python, remote_dir + '/flashprof_agent.py'], remote_dir
+
+
+def _agent_command(agent, ranges, options):
+    '''
+    Run the agent over ranges, [(path, start, end)] with start and end None for a whole file, in order.
+    '''
+    argv = agent + [path if start is None else '{}:{}:{}'.format(path, start, end) for path, start, end in ranges]
+    if options.tso is not None:
+        argv += ['--tso', str(options.tso)]
+    if options.since is not None:
+        argv += ['--since', str(options.since)]
+    if options.until is not None:
+        argv += ['--until', str(options.until)]
+    if options.compress:
+        argv.append('--gzip')
+    return ' '.join(shlex.quote(arg) for arg in argv)
+
+
+def follow_command(remote_log_dir, tso):
+    '''
+    Print tracing lines of tiflash.log as soon as they are written, following the file across log rotations.
+    '''
+    return 'tail -n 0 -F {} | grep --line-buffered -P {}'.format(
+        shlex.quote(os.path.join(remote_log_dir, 'tiflash.log')), _grep_pattern(tso))
+
+
+def open_follow_channel(server, username, ssh_key_file, tso, timeout):
+    '''
+    Connect to a tiflash server and start following its tracing lines, returns (ssh, channel).
+    The channel is non-blocking, so that the channels of many hosts can be read by a single thread with select.
+    A pty is requested, so the remote tail is hung up when the channel is closed instead of lingering.
+    '''
+    ssh = _connect(server['host'], server['ssh_port'], username, ssh_key_file, timeout)
+    try:
+        channel = ssh.get_transport().open_session(timeout=timeout)
+        channel.get_pty()
+        channel.exec_command(follow_command(server['log_dir'], tso))
+    except Exception:
+        ssh.close()
+        raise
+    channel.setblocking(0)
+    return ssh, channel
+
+
+def _stream_to_file(channel, local_log_filename, compressed, mode='wb'):
+    '''
+    Write the stdout of channel to local_log_filename chunk by chunk, so memory usage does not depend on the log size.
+    If compressed, the remote output is a gzip stream and is inflated on the fly.
+    local_log_filename is compressed according to its extension, see utils.open_file.
+    Returns (bytes_transferred, bytes_written), bytes_written being before local compression.
+    '''
+    transferred = 0
+    written = 0
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if compressed else None
+    with utils.open_file(local_log_filename, mode) as fd:
+        while True:
+            chunk = channel.recv(CHUNK_SIZE)
+            if not chunk:
+                break
+            transferred += len(chunk)
+            if decompressor is None:
+                fd.write(chunk)
+                written += len(chunk)
+                continue
+            # bound the inflated size of each write, a highly compressible chunk can expand a lot
+            data = decompressor.decompress(chunk, CHUNK_SIZE)
+            while data:
+                fd.write(data)
+                written += len(data)
+                data = decompressor.decompress(decompressor.unconsumed_tail, CHUNK_SIZE)
+        if decompressor is not None:
+            data = decompressor.flush()
+            fd.write(data)
+            written += len(data)
+    return transferred, written
+
+
+def _copy_log_file(host, port, username, ssh_key_file, remote_log_dir, local_log_filename, options,
+                   local_agent_filename=None):
+    '''
+    Grep tracing lines out of the remote tiflash.log into local_log_filename, returns (bytes_transferred, bytes_written).
+    Connecting and running the remote command are each bounded by options.timeout seconds.
+    If options.compress, the grep output is piped through gzip on the remote host to save network bandwidth.
+    If options.agent, the logs are parsed on the remote host by flashprof_agent.py instead, and the final task records
+    it prints are written to local_agent_filename, unless the host cannot run it.
+    '''
+    timeout = options.timeout
+    with profiler.stage('ssh_connect', host=host):
+        ssh = _connect(host, port, username, ssh_key_file, timeout)
+    # closing the client makes any blocking read on the channel return, so a hung host cannot stall its worker
+    timer = threading.Timer(timeout, ssh.close)
+    timer.start()
+    # the private directory the agent is uploaded to, removed once it has run
+    agent_dir = None
+    try:
+        remote_log_filename = os.path.join(remote_log_dir, 'tiflash.log')
+        agent = None
+        if options.agent:
+            with profiler.stage('prepare_agent', host=host):
+                prepared = _prepare_agent(ssh, host, timeout)
+            if prepared is not None:
+                agent, agent_dir = prepared
+        mode = 'wb'
+        ranges = [(remote_log_filename, None, None)]
+        if options.incremental:
+            manifest = _read_manifest(options.manifest_dir, host)
+            with profiler.stage('plan_incremental', host=host):
+                ranges, manifest = _plan_incremental(ssh, remote_log_dir, manifest, timeout)
+            logging.debug('incremental ranges of {}: {}'.format(host, ranges))
+            if len(ranges) == 0:
+                logging.info('no new logs on {}'.format(host))
+                _write_manifest(options.manifest_dir, host, manifest)
+                return 0, 0
+            mode = 'ab'
+        elif options.windowed and agent is not None:
+            # the agent searches the window bounds itself, with local reads instead of sftp round trips
+            ranges = [(os.path.join(remote_log_dir, f['name']), None, None)
+                      for f in _list_remote_logs(ssh, remote_log_dir, timeout)]
+        elif options.windowed:
+            with profiler.stage('plan_window', host=host):
+                ranges = _plan_window(ssh, remote_log_dir, options.since, options.until, timeout)
+            logging.debug('window ranges of {}: {}'.format(host, ranges))
+            if len(ranges) == 0:
+                logging.info('no logs in the time window on {}'.format(host))
+                return 0, 0
+        if agent is not None:
+            command = _agent_command(agent, ranges, options)
+            local_log_filename = local_agent_filename
+            stage = 'remote_agent'
+        else:
+            if options.incremental or options.windowed:
+                command = _range_grep_command(ranges, options.tso)
+            else:
+                command = _grep_command(remote_log_filename, options.tso)
+            if options.compress:
+                command += ' | gzip -c'
+            stage = 'remote_grep'
+        logging.debug('executing ssh command on {}: {}'.format(host, command))
+        # the remote command runs while its output is streamed, so both are accounted to this stage
+        with profiler.stage(stage, host=host, file=local_log_filename) as span:
+            stdin, stdout, stderr = ssh.exec_command(command, timeout=timeout)
+            logging.info('{} & scp {}@{}:{}/{} {}'.format('parse' if agent else 'grep', username, host, port,
+                                                          remote_log_filename, local_log_filename))
+            transferred, written = _stream_to_file(stdout.channel, local_log_filename, options.compress, mode)
+            err = stderr.read()
+            span.add(bytes_in=transferred, bytes_out=written)
+        if not timer.is_alive():
+            raise TimeoutError('timed out after {}s'.format(timeout))
+        exit_status = stdout.channel.recv_exit_status()
+        err = err.decode(errors='replace').strip()
+        if agent is not None:
+            # the agent reports malformed records and what it has done on stderr
+            if exit_status != 0:
+                raise RuntimeError('agent exited with {}: {}'.format(exit_status, err))
+            for line in err.splitlines():
+                logging.info('agent on {}: {}'.format(host, line))
+        # grep exits with 1 when nothing matches, which is not an error
+        elif exit_status > 1 or len(err) != 0:
+            raise RuntimeError('remote command exited with {}: {}'.format(exit_status, err))
+        if options.incremental:
+            _write_manifest(options.manifest_dir, host, manifest)
+        return transferred, written
+    finally:
+        if agent_dir is not None:
+            _remove_agent(ssh, agent_dir, timeout)
+        timer.cancel()
+        ssh.close()
+
+
+def _collect_one(server, username, ssh_key_file, log_dir, options):
+    host = server['host']
+    result = HostResult(host)
+    ext = utils.COMPRESSIONS.get(options.storage_compression, '')
+    local_log_filename = os.path.join(log_dir, '{}.tiflash.log{}'.format(host, ext))
+    # records already parsed and reduced by the agent, see log_parser.parse_ndjson
+    local_agent_filename = os.path.join(log_dir, '{}.agent.ndjson{}'.format(host, ext))
+    # on failure, roll the local files back to what previous runs have appended
+    local_sizes = {}
+    for filename in [local_log_filename, local_agent_filename]:
+        local_sizes[filename] = 0
+        if options.incremental and os.path.exists(filename):
+            local_sizes[filename] = os.path.getsize(filename)
+    start = time.time()
+    for attempt in range(1, options.retries + 2):
+        result.attempts = attempt
+        try:
+            with profiler.stage('collect_host', host=host, attempt=attempt) as span:
+                result.bytes_transferred, result.bytes_written = _copy_log_file(
+                    host, server['ssh_port'], username, ssh_key_file, server['log_dir'], local_log_filename, options,
+                    local_agent_filename)
+                span.add(bytes_in=result.bytes_transferred, bytes_out=result.bytes_written)
+            result.ok = True
+            result.error = ''
+            break
+        except Exception as e:
+            result.error = '{}: {}'.format(type(e).__name__, e)
+            logging.warning('failed to collect from {}, attempt [{}/{}]: {}'.format(
+                host, attempt, options.retries + 1, result.error))
+            for filename, local_size in local_sizes.items():
+                if local_size > 0:
+                    os.truncate(filename, local_size)
+                elif os.path.exists(filename):
+                    os.remove(filename)
+            if attempt <= options.retries:
+                time.sleep(min(2 ** (attempt - 1), 10))
+    result.duration = time.time() - start
+    return result
+
+
+def collect_logs(tiflash_servers, username, ssh_key_file, log_dir, options, parallelism):
+    '''
+    Collect tracing logs from all tiflash servers concurrently, with at most `parallelism` hosts in flight.
+    Returns a list of HostResult in the same order as tiflash_servers.
+    '''
+    if options.incremental:
+        os.makedirs(options.manifest_dir, exist_ok=True)
+    results = [None] * len(tiflash_servers)
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+        futures = {}
+        for i, server in enumerate(tiflash_servers):
+            future = executor.submit(_collect_one, server, username, ssh_key_file, log_dir, options)
+            futures[future] = i
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            logging.info('{} {} in {:.2f}s'.format('collected' if result.ok else 'failed to collect',
+                                                   result.host, result.duration))
+    return results
+
+
+def log_summary(results):
+    logging.info('collect summary:')
+    logging.info('{:<24} {:<6} {:>14} {:>14} {:>10} {:>8}  {}'.format(
+        'host', 'status', 'transferred', 'written', 'duration', 'attempts', 'error'))
+    for r in results:
+        logging.info('{:<24} {:<6} {:>14} {:>14} {:>9.2f}s {:>8}  {}'.format(
+            r.host, 'ok' if r.ok else 'failed', r.bytes_transferred, r.bytes_written, r.duration, r.attempts, r.error))
+    transferred = sum(r.bytes_transferred for r in results)
+    written = sum(r.bytes_written for r in results)
+    logging.info('transferred {} bytes in total for {} bytes of logs{}'.format(
+        transferred, written, ', ratio {:.2f}'.format(written / transferred) if transferred else ''))
+    failed = [r.host for r in results if not r.ok]
+    if failed:
+        logging.error('failed to collect logs from {} of {} hosts: {}'.format(len(failed), len(results), ', '.join(failed)))
@@ -0,0 +1,194 @@
+import statistics
+from collections import defaultdict, deque
+from typing import Dict, List
+
+import analysis
+
+# phases of analysis.phase_breakdown compared between stages, waiting on upstream is not known without the upstream
+STAGE_PHASES = ['schedule', 'compile', 'wait_index', 'execute']
+THROUGHPUTS = ['local_input_throughput', 'remote_input_throughput', 'output_throughput']
+EXECUTOR_METRICS = [
+    'rows_selectivity',
+    'bytes_selectivity',
+    'hash_table_rows',
+    'probe_rows_selectivity',
+    'probe_bytes_selectivity',
+    'hash_table_bytes',
+]
+
+
+def group_stages(tasks) -> Dict[int, List]:
+    '''
+    {sender_executor_id: [tasks]} of a query, tasks being task_model.Task.
+    '''
+    ret = defaultdict(list)
+    for task in tasks:
+        ret[task.sender_executor_id].append(task)
+    return ret
+
+
+def _signature(stage_tasks):
+    return tuple(e.type for e in stage_tasks[0].executors_from_root())
+
+
+def align_stages(stages_a, stages_b):
+    '''
+    Pairs of (sender_executor_id in a, sender_executor_id in b) of the stages running the same part of the plan, None
+    on either side for a stage only in one query.
+    A stage of a is paired with the stage of b with the same sender_executor_id and executor types if any, else with
+    the first unpaired stage with the same executor types, else with the stage with the same sender_executor_id,
+    stages of b being indexed by both so this is linear in the number of stages.
+    '''
+    signatures_a = {sid: _signature(tasks) for sid, tasks in stages_a.items()}
+    signatures_b = {sid: _signature(tasks) for sid, tasks in stages_b.items()}
+    by_signature = defaultdict(deque)
+    for sid in sorted(stages_b):
+        by_signature[signatures_b[sid]].append(sid)
+    paired = {}  # sender_executor_id in b -> in a
+
+    def _pair(sid_a, sid_b):
+        paired[sid_b] = sid_a
+        by_signature[signatures_b[sid_b]].remove(sid_b)
+
+    unpaired = []
+    for sid_a in sorted(stages_a):
+        if signatures_b.get(sid_a) == signatures_a[sid_a]:
+            _pair(sid_a, sid_a)
+        else:
+            unpaired.append(sid_a)
+    rest = []
+    for sid_a in unpaired:
+        candidates = by_signature.get(signatures_a[sid_a])
+        if candidates:
+            _pair(sid_a, candidates[0])
+        else:
+            rest.append(sid_a)
+    ret = []
+    for sid_a in rest:
+        if sid_a in signatures_b and sid_a not in paired:
+            _pair(sid_a, sid_a)
+        else:
+            ret.append((sid_a, None))
+    ret.extend((paired.get(sid_b), sid_b) for sid_b in sorted(stages_b))
+    return ret
+
+
+def _median(values):
+    values = [v for v in values if v is not None]
+    return statistics.median(values) if values else None
+
+
+def _delta(a, b):
+    return {
+        'a': a,
+        'b': b,
+        'delta': b - a if a is not None and b is not None else None,
+        'ratio': b / a if a and b is not None else None,
+    }
+
+
+def _stage_metrics(tasks):
+    '''
+    Medians over the tasks of a stage, durations in microseconds.
+    '''
+    phases = [analysis.phase_breakdown(t) for t in tasks]
+    ret = {'duration': _median(sum(p.values()) for p in phases)}
+    for phase in STAGE_PHASES:
+        ret[phase] = _median(p[phase] for p in phases)
+    for name in THROUGHPUTS:
+        ret[name] = _median(getattr(t, name) for t in tasks)
+    return ret
+
+
+def _executor_metrics(tasks):
+    '''
+    Medians of EXECUTOR_METRICS over the tasks of a stage, for each executor in plan order, as [(executor, metrics)].
+    '''
+    plans = [t.executors_from_root() for t in tasks]
+    ret = []
+    for position, e in enumerate(plans[0]):
+        executors = [plan[position] for plan in plans if len(plan) > position and plan[position].type == e.type]
+        ret.append((e, {name: _median(x.get(name) for x in executors) for name in EXECUTOR_METRICS}))
+    return ret
+
+
+def _diff_executors(tasks_a, tasks_b):
+    '''
+    Executors of two aligned stages paired by their position in the plan, as long as their types match.
+    '''
+    ret = []
+    for (ea, ma), (eb, mb) in zip(_executor_metrics(tasks_a), _executor_metrics(tasks_b)):
+        if ea.type != eb.type:
+            break
+        metrics = {name: _delta(ma[name], mb[name])
+                   for name in EXECUTOR_METRICS if ma[name] is not None or mb[name] is not None}
+        ret.append({'executor': [ea.id, eb.id], 'type': ea.type, 'metrics': metrics})
+    return ret
+
+
+def diff_queries(tso_a, tasks_a, tso_b, tasks_b):
+    '''
+    Stage by stage comparison of two runs of a query, e.g. before and after an upgrade, as a json-serializable dict.
+    `slowdown` of a stage is the ratio of the median durations of its tasks in b and in a.
+    '''
+    stages_a = group_stages(tasks_a)
+    stages_b = group_stages(tasks_b)
+    stages = []
+    for sid_a, sid_b in align_stages(stages_a, stages_b):
+        a = stages_a.get(sid_a, [])
+        b = stages_b.get(sid_b, [])
+        ma = _stage_metrics(a) if a else {}
+        mb = _stage_metrics(b) if b else {}
+        metrics = {name: _delta(ma.get(name), mb.get(name)) for name in (ma or mb)}
+        stages.append({
+            'stage': [sid_a, sid_b],
+            'executors': ', '.join('{}_{}'.format(e.type, e.id) for e in (b or a)[0].executors_from_root()),
+            'task_count': [len(a), len(b)],
+            'metrics': metrics,
+            'executor_metrics': _diff_executors(a, b) if a and b else [],
+            'slowdown': metrics['duration']['ratio'],
+        })
+    return {
+        'query_tso': [tso_a, tso_b],
+        'task_count': [len(tasks_a), len(tasks_b)],
+        'duration': _delta(analysis.query_duration(tasks_a), analysis.query_duration(tasks_b)),
+        'stages': stages,
+    }
+
+
+def _fmt(value, scale=1):
+    return '{:.3f}'.format(value / scale) if value is not None else '-'
+
+
+def _fmt_ratio(value):
+    return '{:.2f}x'.format(value) if value is not None else '-'
+
+
+def format_report(report):
+    '''
+    Human readable lines of a report of diff_queries, stages sorted by how much slower they got, durations in
+    milliseconds.
+    '''
+    tso_a, tso_b = report['query_tso']
+    duration = report['duration']
+    lines = ['query_tso [{}] -> [{}], {} -> {} tasks, duration {}ms -> {}ms ({})'.format(
+        tso_a, tso_b, report['task_count'][0], report['task_count'][1], _fmt(duration['a'], 1000),
+        _fmt(duration['b'], 1000), _fmt_ratio(duration['ratio']))]
+    stages = sorted(report['stages'], key=lambda s: s['metrics']['duration']['delta'] or 0, reverse=True)
+    for stage in stages:
+        sid_a, sid_b = stage['stage']
+        lines.append('  stage {} -> {}, {} -> {} tasks, {}'.format(
+            '-' if sid_a is None else sid_a, '-' if sid_b is None else sid_b, stage['task_count'][0],
+            stage['task_count'][1], stage['executors']))
+        lines.append('    {:<34} {:>14} {:>14} {:>14} {:>8}'.format('', 'a', 'b', 'delta', 'ratio'))
+        for name, d in stage['metrics'].items():
+            scale = 1 if name in THROUGHPUTS else 1000
+            label = name if name in THROUGHPUTS else name + '(ms)'
+            lines.append('    {:<34} {:>14} {:>14} {:>14} {:>8}'.format(
+                label, _fmt(d['a'], scale), _fmt(d['b'], scale), _fmt(d['delta'], scale), _fmt_ratio(d['ratio'])))
+        for e in stage['executor_metrics']:
+            for name, d in e['metrics'].items():
+                lines.append('    {:<34} {:>14} {:>14} {:>14} {:>8}'.format(
+                    '{}_{}.{}'.format(e['type'], e['executor'][1], name)[:34], _fmt(d['a']), _fmt(d['b']),
+                    _fmt(d['delta']), _fmt_ratio(d['ratio'])))
+    return lines
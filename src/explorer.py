@@ -0,0 +1,295 @@
+import datetime
+import json
+import logging
+import os
+
+import analysis
+import task_model
+import utils
+from visualize_task_json import COLLAPSE_THRESHOLD
+
+SHARD_DIR = 'queries'
+# hint shown when the browser refuses to load shards from file:// urls
+SERVE_HINT = 'python3 -m http.server --directory {}'
+
+
+def index_row(query_tso, tasks):
+    '''
+    Summary of a query shown in the index.
+    query_tso is kept as a string, it does not fit in the integers of javascript.
+    '''
+    failed = sum(1 for t in tasks if t.get('status') != 'FINISHED' or t.get('error_message'))
+    inits = [t['task_init_timestamp'] for t in tasks if t.get('task_init_timestamp')]
+    start = ''
+    if inits:
+        start = datetime.datetime.fromtimestamp(min(inits) / 1000000).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    return {
+        'query_tso': str(query_tso),
+        'start': start,
+        'task_count': len(tasks),
+        'duration_ms': analysis.query_duration(tasks) / 1000,
+        'failed': failed,
+        'status': 'FAILED' if failed else 'FINISHED',
+        'hosts': sorted(set(t.get('host', '') for t in tasks)),
+    }
+
+
+def _write_shard(filename, tasks):
+    '''
+    Returns whether the shard is written, it is left as it is if its content is unchanged.
+    '''
+    data = json.dumps([task_model.as_dict(t) for t in tasks], separators=(',', ':')).encode()
+    if os.path.exists(filename) and os.path.getsize(filename) == len(data):
+        with open(filename, 'rb') as fd:
+            if fd.read() == data:
+                return False
+    with open(filename + '.tmp', 'wb') as fd:
+        fd.write(data)
+    os.replace(filename + '.tmp', filename)
+    return True
+
+
+def write_explorer(queries, out_dir, gc=True, collapse_threshold=COLLAPSE_THRESHOLD):
+    '''
+    Write index.html listing queries ({tso: [tasks]}) and a json shard per query in out_dir/queries, which is laid out
+    in the browser only when the query is opened, and can also be rendered with `render_one --json_file`.
+    If gc, shards of queries not in queries are deleted, else the index is merged with the existing one.
+    Queries with more than collapse_threshold tasks are laid out with a node per stage.
+    '''
+    shard_dir = os.path.join(out_dir, SHARD_DIR)
+    utils.ensure_dir_exist(shard_dir)
+    index_filename = os.path.join(out_dir, 'index.json')
+    rows = {}
+    if not gc and os.path.exists(index_filename):
+        rows = {r['query_tso']: r for r in utils.read_json(index_filename)}
+    written = 0
+    for query_tso, tasks in queries.items():
+        tasks = sorted(tasks, key=lambda t: t['task_id'])
+        if _write_shard(os.path.join(shard_dir, '{}.json'.format(query_tso)), tasks):
+            written += 1
+        rows[str(query_tso)] = index_row(query_tso, tasks)
+    logging.info('wrote {} shards, {} unchanged'.format(written, len(queries) - written))
+    if gc:
+        removed = 0
+        for filename in os.listdir(shard_dir):
+            if filename[:-len('.json')] not in rows:
+                os.remove(os.path.join(shard_dir, filename))
+                removed += 1
+        if removed:
+            logging.info('removed shards of {} queries no longer in the dataset'.format(removed))
+    index = sorted(rows.values(), key=lambda r: r['query_tso'])
+    with open(index_filename, 'wt') as fd:
+        json.dump(index, fd, separators=(',', ':'))
+    # the index is embedded, so the list of queries can be browsed straight from the file system
+    html = HTML_TEMPLATE.replace('/*INDEX*/', json.dumps(index, separators=(',', ':')).replace('</', '<\\/'))
+    html = html.replace('/*COLLAPSE_THRESHOLD*/', str(collapse_threshold))
+    html = html.replace('/*SERVE_HINT*/', json.dumps(SERVE_HINT.format(os.path.abspath(out_dir))))
+    with open(os.path.join(out_dir, 'index.html'), 'wt') as fd:
+        fd.write(html)
+    logging.info('wrote the index of {} queries to {}'.format(len(index), os.path.join(out_dir, 'index.html')))
+
+
+HTML_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>flashprof explorer</title>
+<style>
+body { font: 13px monospace; margin: 0; display: flex; height: 100vh; }
+#list { width: 50%; overflow: auto; border-right: 1px solid #ccc; }
+#view { flex: 1; overflow: auto; position: relative; }
+#toolbar { position: sticky; top: 0; background: #fff; padding: 6px; border-bottom: 1px solid #ccc; }
+table { border-collapse: collapse; width: 100%; }
+th { cursor: pointer; text-align: left; background: #f4f4f4; position: sticky; top: 36px; }
+th, td { padding: 2px 6px; white-space: nowrap; }
+tr.row:hover { background: #eef; cursor: pointer; }
+tr.selected { background: #dde; }
+.failed { color: #c00; }
+#detail { white-space: pre; padding: 6px; border-top: 1px solid #ccc; }
+svg text { font: 11px monospace; }
+</style>
+</head>
+<body>
+<div id="list">
+  <div id="toolbar">
+    <input id="filter" placeholder="filter by tso, host or status" size="40">
+    <span id="count"></span>
+    <button id="more">more</button>
+  </div>
+  <table><thead><tr>
+    <th data-key="query_tso">query_tso</th><th data-key="start">start</th><th data-key="task_count">tasks</th>
+    <th data-key="duration_ms">duration_ms</th><th data-key="status">status</th><th data-key="hosts">hosts</th>
+  </tr></thead><tbody id="rows"></tbody></table>
+</div>
+<div id="view"><div id="graph">select a query</div><div id="detail"></div></div>
+<script>
+const INDEX = /*INDEX*/;
+const COLLAPSE_THRESHOLD = /*COLLAPSE_THRESHOLD*/;
+const SERVE_HINT = /*SERVE_HINT*/;
+const PAGE = 500;
+let shown = PAGE, sortKey = 'query_tso', sortDesc = false, rows = INDEX;
+
+function applyFilter() {
+  const f = document.getElementById('filter').value.toLowerCase();
+  rows = INDEX.filter(r => !f || [r.query_tso, r.status, r.hosts.join(' ')].some(v => v.toLowerCase().includes(f)));
+  rows.sort((a, b) => {
+    const x = a[sortKey], y = b[sortKey];
+    const c = typeof x === 'number' ? x - y : String(x).localeCompare(String(y));
+    return sortDesc ? -c : c;
+  });
+  drawRows();
+}
+
+function drawRows() {
+  const body = document.getElementById('rows');
+  body.innerHTML = '';
+  for (const r of rows.slice(0, shown)) {
+    const tr = document.createElement('tr');
+    tr.className = 'row' + (r.failed ? ' failed' : '');
+    for (const v of [r.query_tso, r.start, r.task_count, r.duration_ms.toFixed(3),
+                     r.failed ? r.status + '(' + r.failed + ')' : r.status, r.hosts.join(', ')]) {
+      const td = document.createElement('td');
+      td.textContent = v;
+      tr.appendChild(td);
+    }
+    tr.onclick = () => {
+      document.querySelectorAll('tr.selected').forEach(e => e.classList.remove('selected'));
+      tr.classList.add('selected');
+      openQuery(r.query_tso);
+    };
+    body.appendChild(tr);
+  }
+  document.getElementById('count').textContent = Math.min(shown, rows.length) + ' of ' + rows.length + ' queries';
+}
+
+function failedTask(t) { return t.status !== 'FINISHED' || t.error_message; }
+
+function upstreams(t) {
+  const ret = [];
+  for (const e of t.executors || []) ret.push(...(e.receiver_source_task_ids || []));
+  return ret;
+}
+
+// nodes are tasks, or stages of tasks sharing a sender_executor_id for wide queries
+function buildNodes(tasks) {
+  const collapse = tasks.length > COLLAPSE_THRESHOLD;
+  const key = t => collapse ? 'stage ' + t.sender_executor_id : 'task ' + t.task_id;
+  const nodes = new Map(), nodeOfTask = new Map();
+  for (const t of tasks) {
+    const k = key(t);
+    if (!nodes.has(k)) nodes.set(k, {id: k, tasks: [], ups: new Set()});
+    nodes.get(k).tasks.push(t);
+    nodeOfTask.set(t.task_id, k);
+  }
+  for (const t of tasks) {
+    for (const u of upstreams(t)) {
+      if (nodeOfTask.has(u) && nodeOfTask.get(u) !== key(t)) nodes.get(key(t)).ups.add(nodeOfTask.get(u));
+    }
+  }
+  return nodes;
+}
+
+// longest path layering from the leaves, drawn bottom up like the graphviz dags
+function layout(nodes) {
+  const layer = new Map();
+  const visit = (n, depth) => {
+    if (layer.has(n.id)) return layer.get(n.id);
+    if (depth > nodes.size) return 0;
+    let l = 0;
+    for (const u of n.ups) l = Math.max(l, visit(nodes.get(u), depth + 1) + 1);
+    layer.set(n.id, l);
+    return l;
+  };
+  const layers = [];
+  for (const n of nodes.values()) {
+    const l = visit(n, 0);
+    (layers[l] = layers[l] || []).push(n);
+  }
+  const W = 200, H = 70, GAP_X = 20, GAP_Y = 50;
+  const width = Math.max(...layers.map(l => l.length)) * (W + GAP_X);
+  layers.forEach((ns, l) => ns.forEach((n, i) => {
+    n.x = i * (W + GAP_X) + 10;
+    n.y = (layers.length - 1 - l) * (H + GAP_Y) + 10;
+  }));
+  return {W: W, H: H, width: width + 20, height: layers.length * (H + GAP_Y) + 20};
+}
+
+function nodeLabel(n) {
+  const ts = n.tasks;
+  const dur = ts.map(t => (t.task_end_timestamp - t.task_start_timestamp) / 1000).filter(d => d >= 0);
+  const failed = ts.filter(failedTask).length;
+  const lines = [n.id];
+  if (ts.length === 1) {
+    lines.push(ts[0].host, ts[0].status);
+  } else {
+    lines.push(ts.length + ' tasks, ' + failed + ' failed', new Set(ts.map(t => t.host)).size + ' hosts');
+  }
+  if (dur.length) lines.push('duration ' + Math.max(...dur).toFixed(3) + 'ms');
+  return lines;
+}
+
+function drawQuery(tasks) {
+  const nodes = buildNodes(tasks);
+  const g = layout(nodes);
+  const ns = 'http://www.w3.org/2000/svg';
+  const svg = document.createElementNS(ns, 'svg');
+  svg.setAttribute('width', g.width);
+  svg.setAttribute('height', g.height);
+  for (const n of nodes.values()) {
+    for (const u of n.ups) {
+      const s = nodes.get(u), line = document.createElementNS(ns, 'line');
+      line.setAttribute('x1', s.x + g.W / 2); line.setAttribute('y1', s.y);
+      line.setAttribute('x2', n.x + g.W / 2); line.setAttribute('y2', n.y + g.H);
+      line.setAttribute('stroke', '#c00'); line.setAttribute('stroke-dasharray', '4');
+      svg.appendChild(line);
+    }
+  }
+  for (const n of nodes.values()) {
+    const rect = document.createElementNS(ns, 'rect');
+    rect.setAttribute('x', n.x); rect.setAttribute('y', n.y);
+    rect.setAttribute('width', g.W); rect.setAttribute('height', g.H);
+    rect.setAttribute('fill', '#fff');
+    const failed = n.tasks.some(failedTask);
+    rect.setAttribute('stroke', failed ? '#c00' : '#333');
+    rect.setAttribute('stroke-width', failed ? 3 : 1);
+    rect.style.cursor = 'pointer';
+    rect.onclick = () => { document.getElementById('detail').textContent = JSON.stringify(n.tasks, null, 1); };
+    svg.appendChild(rect);
+    nodeLabel(n).forEach((s, i) => {
+      const text = document.createElementNS(ns, 'text');
+      text.setAttribute('x', n.x + 6); text.setAttribute('y', n.y + 15 + i * 14);
+      text.textContent = s;
+      text.style.pointerEvents = 'none';
+      svg.appendChild(text);
+    });
+  }
+  return svg;
+}
+
+function openQuery(tso) {
+  const graph = document.getElementById('graph');
+  graph.textContent = 'loading ' + tso;
+  document.getElementById('detail').textContent = '';
+  fetch('queries/' + tso + '.json').then(r => r.json()).then(tasks => {
+    graph.innerHTML = '';
+    graph.appendChild(drawQuery(tasks));
+  }).catch(e => {
+    graph.textContent = 'failed to load queries/' + tso + '.json: ' + e + '\\nbrowsers may refuse to load files from ' +
+      'file:// urls, serve this directory with `' + SERVE_HINT + '` and open http://localhost:8000, or render it with ' +
+      '`flashprof render_one --json_file queries/' + tso + '.json`';
+    graph.style.whiteSpace = 'pre';
+  });
+}
+
+document.getElementById('filter').oninput = () => { shown = PAGE; applyFilter(); };
+document.getElementById('more').onclick = () => { shown += PAGE; drawRows(); };
+document.querySelectorAll('th').forEach(th => th.onclick = () => {
+  sortDesc = sortKey === th.dataset.key ? !sortDesc : false;
+  sortKey = th.dataset.key;
+  applyFilter();
+});
+applyFilter();
+</script>
+</body>
+</html>
+'''
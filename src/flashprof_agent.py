@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+'''
+Parsing agent of `flashprof collect --agent`, uploaded to and run on each tiflash host over ssh.
+It scans the tracing lines of the given logs and writes the final state of each task to stdout as ndjson, so parsing
+runs on the cores of the cluster and only reduced records cross the network.
+It is uploaded as a single file, so it depends on nothing but the standard library of python >= 3.5, and mirrors
+log_parser.scan_payloads and task_reducer.TaskReducer rather than importing them.
+'''
+import argparse
+import gzip
+import json
+import mmap
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+# size of each random read while searching a log for the bounds of a time window, and of the tail searched for the
+# last complete line of a growing log
+SEARCH_BLOCK = 1 << 16
+GZIP_LEVEL = 6
+# see log_parser
+SOURCE_MARKER = b'"] [source="mpp_task_tracing MPP<query:<'
+PAYLOAD_START = b'["{'
+# every tiflash log line starts with e.g. `[2021/11/19 16:39:26.539 +08:00]`
+LINE_TIME_LENGTH = len('[2021/11/19 16:39:26.539 +08:00]')
+INITIALIZING = 'INITIALIZING'
+
+
+def _log(message):
+    sys.stderr.write(message + '\n')
+
+
+def _line_time(line):
+    '''
+    Returns the timestamp of a log line in microseconds, or None if it does not start with one.
+    The offset is parsed by hand, %z only accepts `+08:00` since python 3.7.
+    '''
+    prefix = line[:LINE_TIME_LENGTH]
+    if len(prefix) != LINE_TIME_LENGTH or prefix[:1] != b'[' or prefix[-1:] != b']':
+        return None
+    try:
+        date, clock, offset = prefix[1:-1].decode().split(' ')
+        t = datetime.strptime(date + ' ' + clock, '%Y/%m/%d %H:%M:%S.%f')
+        sign = -1 if offset[0] == '-' else 1
+        t = t.replace(tzinfo=timezone(sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[4:6]))))
+    except (ValueError, IndexError, UnicodeDecodeError):
+        return None
+    return int(t.timestamp()) * 1000000 + t.microsecond
+
+
+def _next_line_time(fd, offset, size):
+    '''
+    Returns (line_start, timestamp) of the first timestamped line starting at or after offset, or None.
+    '''
+    # the byte before offset decides whether offset is a line start
+    fd.seek(max(0, offset - 1))
+    if offset > 0:
+        fd.readline()
+    while True:
+        pos = fd.tell()
+        if pos >= size:
+            return None
+        ts = _line_time(fd.readline(LINE_TIME_LENGTH + 1))
+        if ts is not None:
+            return pos, ts
+        fd.seek(pos)
+        fd.readline()
+
+
+def _time_lower_bound(fd, size, t):
+    '''
+    Binary search the offset of the first line whose timestamp is >= t, or size if there is none.
+    '''
+    lo, hi = 0, size
+    while hi - lo > SEARCH_BLOCK:
+        mid = (lo + hi) // 2
+        found = _next_line_time(fd, mid, size)
+        if found is None or found[1] >= t:
+            hi = mid
+        else:
+            lo = found[0] + 1
+    found = _next_line_time(fd, lo, size)
+    while found is not None and found[1] < t:
+        found = _next_line_time(fd, found[0] + 1, size)
+    return size if found is None else found[0]
+
+
+def _last_line_end(fd, size):
+    '''
+    Offset right after the last newline, so a line being written is left for the next run.
+    '''
+    start = max(0, size - SEARCH_BLOCK)
+    fd.seek(start)
+    data = fd.read(size - start)
+    return start + data.rfind(b'\n') + 1 if b'\n' in data else start
+
+
+def scan_payloads(buf, start, end, tso_token=None):
+    '''
+    Yields the escaped json payload of each tracing line in buf[start:end], see log_parser.scan_payloads.
+    If tso_token is given, lines whose source does not contain it are skipped without decoding them.
+    '''
+    pos = start
+    while pos < end:
+        marker = buf.find(SOURCE_MARKER, pos, end)
+        if marker < 0:
+            return
+        line_start = buf.rfind(b'\n', pos, marker) + 1
+        if line_start == 0:
+            line_start = pos
+        line_end = buf.find(b'\n', marker, end)
+        if line_end < 0:
+            line_end = end
+        payload_start = buf.find(PAYLOAD_START, line_start, marker)
+        if payload_start >= 0 and (tso_token is None or buf.find(tso_token, marker, line_end) >= 0):
+            yield buf[payload_start + 2:marker]
+        pos = line_end + 1
+
+
+class Reducer:
+    '''
+    Keeps the final state of each task, see task_reducer.TaskReducer: terminal records are written as soon as they are
+    seen, INITIALIZING records are held until the task ends, and the ones of tasks still running are written by
+    flush() for the collecting side to pair with records of other files.
+    The ids of the tasks ended are only kept while their query has tasks in flight.
+    '''
+
+    def __init__(self, out):
+        self.out = out
+        self._in_flight = {}  # query_tso -> {task_id: INITIALIZING record}
+        self._done = {}  # query_tso -> ids of the tasks ended, while it has tasks in flight
+        self.records = 0
+        self.emitted = 0
+
+    def add(self, text, record):
+        self.records += 1
+        query_tso, task_id = record.get('query_tso'), record.get('task_id')
+        if task_id in self._done.get(query_tso, ()):
+            return
+        if record.get('status') == INITIALIZING:
+            self._in_flight.setdefault(query_tso, {}).setdefault(task_id, text)
+            return
+        in_flight = self._in_flight.get(query_tso)
+        if in_flight is not None:
+            in_flight.pop(task_id, None)
+            if in_flight:
+                self._done.setdefault(query_tso, set()).add(task_id)
+            else:
+                del self._in_flight[query_tso]
+                self._done.pop(query_tso, None)
+        self._write(text)
+
+    def flush(self):
+        for in_flight in self._in_flight.values():
+            for text in in_flight.values():
+                self._write(text)
+        self._in_flight.clear()
+        self._done.clear()
+
+    def _write(self, text):
+        self.out.write(text.encode('utf-8'))
+        self.out.write(b'\n')
+        self.emitted += 1
+
+
+def _parse_spec(spec):
+    '''
+    (path, start, end) of `path` or `path:start:end`, start and end being None for the whole file.
+    '''
+    parts = spec.rsplit(':', 2)
+    if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+        return parts[0], int(parts[1]), int(parts[2])
+    return spec, None, None
+
+
+def scan_file(path, start, end, reducer, tso=None, since=None, until=None):
+    '''
+    Feed the task records in the byte range [start, end) of a log to reducer, the whole file up to its last complete
+    line if start is None, narrowed to the lines written between since and until if given.
+    Returns the number of bytes scanned.
+    '''
+    tso_token = None if tso is None else 'start_ts:{}>'.format(tso).encode()
+    with open(path, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if start is None:
+            start, end = 0, _last_line_end(fd, size)
+        end = min(end, size)
+        if since is not None:
+            start = max(start, _time_lower_bound(fd, end, since))
+        if until is not None:
+            end = min(end, _time_lower_bound(fd, end, until + 1))
+        if end <= start:
+            return 0
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for payload in scan_payloads(buf, start, end, tso_token):
+                try:
+                    text = json.loads('"' + payload.decode('utf-8') + '"')
+                    record = json.loads(text)
+                except ValueError as e:
+                    _log('failed to load json in {}: {}'.format(path, e))
+                    continue
+                reducer.add(text, record)
+    return end - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write the final state of each task traced in tiflash logs as ndjson')
+    parser.add_argument('files', nargs='+', help='log files in order, each optionally as path:start:end to only scan '
+                                                 'that byte range')
+    parser.add_argument('--tso', type=int, help='only keep the tasks of this query')
+    parser.add_argument('--since', type=int, help='only scan lines logged since this timestamp in microseconds')
+    parser.add_argument('--until', type=int, help='only scan lines logged until this timestamp in microseconds')
+    parser.add_argument('--gzip', action='store_true', help='gzip the output')
+    args = parser.parse_args(argv)
+
+    out = sys.stdout.buffer
+    if args.gzip:
+        out = gzip.GzipFile(fileobj=out, mode='wb', compresslevel=GZIP_LEVEL)
+    reducer = Reducer(out)
+    scanned = 0
+    for spec in args.files:
+        path, start, end = _parse_spec(spec)
+        scanned += scan_file(path, start, end, reducer, args.tso, args.since, args.until)
+    reducer.flush()
+    if args.gzip:
+        out.close()
+    sys.stdout.buffer.flush()
+    _log('scanned {} bytes, reduced {} records to {}'.format(scanned, reducer.records, reducer.emitted))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+import itertools
+import json
+import logging
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import profiler
+import utils
+
+# large files are split into byte ranges of about this size, so they can be parsed by several processes
+CHUNK_SIZE = 64 << 20
+# compressed files are decompressed by blocks of this size
+BLOCK_SIZE = 16 << 20
+# chunks in flight per parsing process, enough to keep every process busy while the records of a file are consumed
+PENDING_PER_JOB = 2
+
+# every tracing line looks like
+# [2021/11/19 16:39:26.539 +08:00] [DEBUG] [<unknown>] ["{\"query_tso\":...}"] [source="mpp_task_tracing MPP<query:<...>,task_id:1>"] ...
+# the message is a quoted string, so the quote right before the marker closes the json payload
+SOURCE_MARKER = b'"] [source="mpp_task_tracing MPP<query:<'
+PAYLOAD_START = b'["{'
+
+
+def split_file(filename, chunk_size=CHUNK_SIZE, start=0, size=None):
+    '''
+    Split a file, or its bytes [start, size) which must be aligned to lines, into byte ranges [start, end) of about
+    chunk_size bytes, each of which ends right after a newline (or at EOF), so no line is cut across two ranges.
+    '''
+    if size is None:
+        size = os.path.getsize(filename)
+    ranges = []
+    with open(filename, 'rb') as fd:
+        while start < size:
+            end = start + chunk_size
+            if end >= size:
+                end = size
+            else:
+                fd.seek(end - 1)
+                fd.readline()
+                end = fd.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def scan_payloads(buf, start, end):
+    '''
+    Yields the escaped json payload of each tracing line in buf[start:end], buf being bytes or a mmap.
+    Lines are never split, the literal marker is searched over the whole range and only matching lines are touched.
+    '''
+    pos = start
+    while pos < end:
+        marker = buf.find(SOURCE_MARKER, pos, end)
+        if marker < 0:
+            return
+        line_start = buf.rfind(b'\n', pos, marker) + 1
+        if line_start == 0:
+            line_start = pos
+        line_end = buf.find(b'\n', marker, end)
+        if line_end < 0:
+            line_end = end
+        payload_start = buf.find(PAYLOAD_START, line_start, marker)
+        if payload_start >= 0:
+            yield buf[payload_start + 2:marker]
+        pos = line_end + 1
+
+
+def _decode(payload):
+    '''
+    Returns (json text, record) of an escaped payload, or None if it is malformed.
+    The payload is the content of a quoted string in the log, so it is unescaped as a json string literal, which keeps
+    legitimate backslashes in the task record intact.
+    '''
+    try:
+        text = json.loads(b'"' + payload + b'"')
+        # validate it, a malformed record must not end up in the artifacts
+        return text, json.loads(text)
+    except Exception as e:
+        logging.error('failed to load json: {}\n{}'.format(e, payload.decode('utf-8', errors='replace')))
+        return None
+
+
+def decode_payload(payload):
+    '''
+    Returns the json text of an escaped payload, or None if it is malformed.
+    '''
+    decoded = _decode(payload)
+    return None if decoded is None else decoded[0]
+
+
+def decode_record(payload):
+    '''
+    Returns (query_tso, task_id, status, json text) of an escaped payload, the input of a TaskReducer, or None if it is
+    malformed.
+    '''
+    decoded = _decode(payload)
+    if decoded is None:
+        return None
+    text, record = decoded
+    return record.get('query_tso'), record.get('task_id'), record.get('status'), text
+
+
+def parse_line(line):
+    '''
+    Returns the task record in a single log line as a dict, or None if it is not a tracing line.
+    '''
+    for payload in scan_payloads(line, 0, len(line)):
+        text = decode_payload(payload)
+        return None if text is None else json.loads(text)
+    return None
+
+
+def parse_range(filename, start, end):
+    '''
+    Parse the task records in the byte range [start, end) of a log file, which must be aligned to lines.
+    Records are returned as (query_tso, task_id, status, json text) tuples, which are much cheaper than dicts to send
+    back from a worker process.
+    '''
+    ret = []
+    if end <= start:
+        return ret
+    with profiler.stage('parse_range', file=filename, start=start, end=end) as span:
+        with open(filename, 'rb') as fd:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                for payload in scan_payloads(buf, start, end):
+                    record = decode_record(payload)
+                    if record is not None:
+                        ret.append(record)
+        span.add(bytes_in=end - start, records=len(ret))
+    return ret
+
+
+def parse_compressed(filename, start=0, block_size=BLOCK_SIZE):
+    '''
+    Parse the task records of a compressed log file, which can neither be mapped nor split, so it is decompressed and
+    scanned one block at a time. Records are returned like parse_range.
+    Only the streams from the byte offset start on are read, start being where a stream appended to the file starts.
+    '''
+    ret = []
+    with profiler.stage('parse_compressed', file=filename, start=start) as span:
+        bytes_in = 0
+        with open(filename, 'rb') as raw:
+            raw.seek(start)
+            with utils.open_file(filename, 'rb', raw) as fd:
+                rest = b''
+                while True:
+                    block = fd.read(block_size)
+                    bytes_in += len(block)
+                    buf = rest + block
+                    # only whole lines are scanned, the last one is scanned with the next block
+                    end = buf.rfind(b'\n') + 1 if block else len(buf)
+                    for payload in scan_payloads(buf, 0, end):
+                        record = decode_record(payload)
+                        if record is not None:
+                            ret.append(record)
+                    rest = buf[end:]
+                    if not block:
+                        break
+        span.add(bytes_in=bytes_in, records=len(ret))
+    return ret
+
+
+def parse_ndjson(filename, start=0):
+    '''
+    Parse the task records of an ndjson file, e.g. reduced on a tiflash host by flashprof_agent.py, returned like
+    parse_range, so they are reduced along with the records of the other files.
+    Only the lines from the byte offset start on are read, see parse_compressed.
+    '''
+    ret = []
+    with profiler.stage('parse_ndjson', file=filename, start=start) as span:
+        with open(filename, 'rb') as raw:
+            raw.seek(start)
+            with utils.open_file(filename, 'rt', raw) as fd:
+                for line in fd:
+                    text = line.rstrip('\n')
+                    if not text:
+                        continue
+                    try:
+                        record = json.loads(text)
+                    except ValueError as e:
+                        logging.error('failed to load json: {}\n{}'.format(e, text))
+                        continue
+                    ret.append((record.get('query_tso'), record.get('task_id'), record.get('status'), text))
+        span.add(records=len(ret))
+    return ret
+
+
+def _split_tasks(filename, chunk_size, start=0, size=None):
+    '''
+    The (function, args) parsing each part of the bytes [start, size) of a file.
+    '''
+    if utils.strip_compression(filename).endswith('.ndjson'):
+        return [(parse_ndjson, (filename, start))]
+    if utils.compression_ext(filename):
+        return [(parse_compressed, (filename, start))]
+    return [(parse_range, (filename, s, e)) for s, e in split_file(filename, chunk_size, start, size)]
+
+
+def parse_files(filenames, jobs=1, chunk_size=CHUNK_SIZE, ranges=None):
+    '''
+    Parse task records out of log files, yields (filename, records) for each chunk of each file in order, records
+    being (query_tso, task_id, status, json text) tuples. A file without chunks is yielded once with no records.
+    With jobs > 1, the chunks of all the files are parsed by a pool of `jobs` processes, and yielded in the same
+    order, so the output is the same as parsing serially. Compressed files, see utils.open_file, and ndjson files of
+    task records are parsed as a single chunk.
+    ranges maps a filename to the byte range (start, size) of it to parse, e.g. the bytes appended since a previous
+    run, the whole file if it is absent. Compressed and ndjson files are read from start to their end.
+    At most PENDING_PER_JOB * jobs chunks are in flight or parsed but not yet yielded, refilled as they are consumed
+    in order, so memory holds the records of a few chunks rather than of whole files.
+    '''
+    ranges = ranges or {}
+    if jobs <= 1:
+        for filename in filenames:
+            tasks = _split_tasks(filename, chunk_size, *ranges.get(filename, (0, None)))
+            if not tasks:
+                yield filename, []
+            for func, args in tasks:
+                yield filename, func(*args)
+        return
+
+    tasks = ((i, func, args) for i, filename in enumerate(filenames)
+             for func, args in _split_tasks(filename, chunk_size, *ranges.get(filename, (0, None))))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=profiler.init_worker,
+                             initargs=profiler.worker_args()) as executor:
+        pending = deque()
+
+        def _fill():
+            for i, func, args in itertools.islice(tasks, PENDING_PER_JOB * jobs - len(pending)):
+                pending.append((i, executor.submit(func, *args)))
+
+        _fill()
+        # files before this one are yielded, those without chunks in between are empty
+        current = 0
+        while pending:
+            i, future = pending.popleft()
+            while current < i:
+                yield filenames[current], []
+                current += 1
+            current = i + 1
+            records = future.result()
+            # the pool keeps no reference to a done future, dropping ours releases its records once they are consumed
+            del future
+            _fill()
+            yield filenames[i], records
+        while current < len(filenames):
+            yield filenames[current], []
+            current += 1
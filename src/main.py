@@ -1,92 +1,140 @@
 import argparse
+import itertools
 import json
 import logging
 import os
-import re
 import shutil
 import sys
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from enum import Enum
-from os.path import expanduser
-
-import paramiko
-import yaml
 
+import analysis
+import collector
+import diff as query_diff
+import explorer
+import log_parser
+import profiler
+import render_cache
+import task_model
+import task_reducer
+import task_store
+import trace_event
 import utils
-from visualize_task_json import draw_tasks_dag
+import watch as watcher
+from visualize_task_json import COLLAPSE_THRESHOLD, draw_diff_dag, draw_tasks_dag
 
-HOME_DIR = expanduser("~")
 FLASHPROF_DIR = os.path.join(os.path.realpath('.'), 'flashprof')
 FLASHPROF_CLUSTER_DIR = os.path.join(FLASHPROF_DIR, 'cluster')
 
 
 class RENDER_TYPE(Enum):
     TASK_DAG = 'task_dag'
+    TIMELINE = 'timeline'
+    EXPLORER = 'explorer'
 
     def __str__(self):
         return self.value
 
 
-def _get_tiup_config(cluster_name):
-    cluster_dir = '{}/.tiup/storage/cluster/clusters/{}/'.format(HOME_DIR, cluster_name)
-    ssh_key_file = '{}/ssh/id_rsa'.format(cluster_dir)
-    logging.debug('cluster_dir = {}'.format(cluster_dir))
-    meta_filename = '{}/meta.yaml'.format(cluster_dir)
-    fd = open(meta_filename, 'r')
-    meta = yaml.safe_load(fd.read())
-    fd.close()
-    username = meta['user']
-    tiflash_servers = meta['topology']['tiflash_servers']
-    return username, ssh_key_file, tiflash_servers
-
-
-def _copy_log_file(host, port, username, ssh_key_file, remote_log_dir, cluster_name, tso):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect(host, port, username, key_filename=ssh_key_file)
-    # sftp = ssh.open_sftp()
-    remote_log_filename = os.path.join(remote_log_dir, 'tiflash.log')
-    local_log_filename = os.path.join(FLASHPROF_CLUSTER_DIR, cluster_name, 'log', '{}.tiflash.log'.format(host))
-    # remote_log_filename = '/mnt/pingcap/tiflash_mpp_profiler/log/172.16.5.59.tiflash.log'
-    command = r'grep -P "\"mpp_task_tracing MPP<query:<[0-9a-zA-Z:_, ]+start_ts:\d+>,task_id:\d+>" {}'.format(remote_log_filename) if tso is None \
-        else r'grep -P "\"mpp_task_tracing MPP<query:<[0-9a-zA-Z:_, ]+start_ts:{}>,task_id:\d+>" {}'.format(tso, remote_log_filename)
-    logging.debug('executing ssh command: {}'.format(command))
-    stdin, stdout, stderr = ssh.exec_command(command)
-    logging.info('grep & scp {}@{}:{}/{} {}'.format(username, host, port, remote_log_filename, local_log_filename))
-    # sftp.get(remote_log_filename, local_log_filename)
-    with open(local_log_filename, 'wb') as fd:
-        fd.write(stdout.read())
-    err = stderr.read()
-    if len(err) != 0:
-        logging.error('error occurs: {}'.format(err))
+class RenderOptions:
+    '''
+    Options shared by every query of a single render run.
+    '''
+
+    def __init__(self, type=RENDER_TYPE.TASK_DAG, format='svg', jobs=1, use_cache=True, critical_path=False,
+                 collapse_threshold=COLLAPSE_THRESHOLD, straggler_ratio=analysis.STRAGGLER_RATIO):
+        self.type = type
+        self.format = format
+        self.jobs = jobs
+        self.use_cache = use_cache
+        self.critical_path = critical_path
+        self.collapse_threshold = collapse_threshold
+        self.straggler_ratio = straggler_ratio
+
+    def cache_token(self):
+        '''
+        The options that change the rendered output, part of the render cache key.
+        '''
+        return [str(self.type), self.format, self.critical_path, self.collapse_threshold, self.straggler_ratio]
+
+
+def _parse_log_to_file(log_dir, task_dag_json_dir, jobs=1, compression=None, ranges=None):
+    '''
+    Parse the logs in log_dir into their ndjson files in task_dag_json_dir, returns the output filenames.
+    If ranges is given, see log_parser.parse_files, only the logs in it are parsed and their records are appended to
+    the ndjson files.
+    '''
+    if ranges is None:
+        log_files = [os.path.join(log_dir, log_filename) for log_filename in sorted(os.listdir(log_dir))]
+    else:
+        log_files = sorted(ranges)
+    logging.info('parsing {} files with {} jobs'.format(len(log_files), jobs))
+    return _write_task_dag_ndjson_files(log_parser.parse_files(log_files, jobs, ranges=ranges), task_dag_json_dir,
+                                        compression, 'wt' if ranges is None else 'at')
+
+
+def _parse_one_log_to_file(log_file, task_dag_json_dir, jobs=1, compression=None):
+    output_filenames = _write_task_dag_ndjson_files(log_parser.parse_files([log_file], jobs), task_dag_json_dir,
+                                                    compression)
+    return output_filenames[0] if output_filenames else None
+
+
+def _remove_other_compressions(filename):
+    '''
+    Remove the files with the same name as filename but another compression, e.g. left by a previous run.
+    '''
+    base = utils.strip_compression(filename)
+    for name in [base] + [base + ext for ext in utils.COMPRESSIONS.values()]:
+        if name != filename and os.path.exists(name):
+            os.remove(name)
+
+
+def _write_task_dag_ndjson_files(parsed, task_dag_json_dir, compression=None, mode='wt'):
+    '''
+    Write the final state of each task among the records parsed out of each log file to its ndjson file, a single
+    TaskReducer pairing the records of all the files. Tasks that never end are appended to the file of their
+    INITIALIZING record at the end.
+    compression is one of utils.COMPRESSIONS, or None to write plain ndjson. mode 'at' appends to the ndjson files.
+    Returns the output filenames.
+    '''
+    reducer = task_reducer.TaskReducer()
+    output_filenames = []
+    # the records of a file come in chunks, which are reduced and written as they are parsed
+    for log_file, chunks in itertools.groupby(parsed, key=lambda p: p[0]):
+        output_filename = os.path.join(task_dag_json_dir, '{}.task_dag.ndjson{}'.format(
+            os.path.basename(utils.strip_compression(log_file)), utils.COMPRESSIONS.get(compression, '')))
+        _remove_other_compressions(output_filename)
+        records = (record for _, chunk in chunks for record in chunk)
+        _write_task_dag_ndjson(output_filename, reducer.reduce(records, output_filename), mode)
+        output_filenames.append(output_filename)
+    for output_filename, records in reducer.flush().items():
+        _write_task_dag_ndjson(output_filename, records, 'at')
+    logging.info('reduced {} records to the final states of {} tasks'.format(reducer.records, reducer.emitted))
+    return output_filenames
+
+
+def _write_task_dag_ndjson(output_filename, records, mode='wt'):
+    '''
+    Write the json strings of records one per line.
+    '''
+    count = 0
+    size = 0
+    with profiler.stage('write_ndjson', file=output_filename) as span:
+        with utils.open_file(output_filename, mode) as fd:
+            for record in records:
+                fd.write(record)
+                fd.write('\n')
+                count += 1
+                size += len(record) + 1
+        span.add(bytes_out=os.path.getsize(output_filename), records=count)
+    if utils.compression_ext(output_filename):
+        logging.info('write {} records to {}, compression ratio {:.2f}'.format(
+            count, output_filename, size / max(1, os.path.getsize(output_filename))))
     else:
-        logging.info('success')
-
-
-def _parse_log_to_file(log_dir, task_dag_json_dir):
-    for log_filename in os.listdir(log_dir):
-        logging.info('parsing {}'.format(log_filename))
-        _parse_one_log_to_file(os.path.join(log_dir, log_filename), task_dag_json_dir)
-
-def _parse_one_log_to_file(log_file, task_dag_json_dir):
-    ret = []
-    with open(log_file, 'r') as fd:
-        for line in fd:
- 
-            match = re.search(r'\["(\{.+\})"\] \[source="mpp_task_tracing MPP<query:<[0-9a-zA-Z:_, ]+start_ts:\d+>,task_id:\d+>', line)
-            if match is None:
-                continue
-            json_str = match.group(1).replace('\\', '')
-            try:
-                data = json.loads(json_str)
-            except Exception as e:
-                logging.error('failed to load json: {}\n{}'.format(e, json_str))
-                continue
-            ret.append(data)
-    output_filename = os.path.join(task_dag_json_dir, os.path.basename(log_file) + '.task_dag.json')
-    logging.info('write to {}'.format(output_filename))
-    with open(output_filename, 'wt') as fd:
-        json.dump(ret, fd, indent=1)
+        logging.info('write {} records to {}'.format(count, output_filename))
+
 
 def _clean_cluster(cluster_name):
     cluster_dir = os.path.join(FLASHPROF_CLUSTER_DIR, cluster_name)
@@ -94,119 +142,335 @@ def _clean_cluster(cluster_name):
         shutil.rmtree(cluster_dir)
 
 
-def _combine_json_files(json_dir, except_list):
-    # TODO: potential optimization, make this stream-ish to reduce memory consumption
-    combined = []
-    for filename in os.listdir(json_dir):
-        if filename in except_list:
+def _combine_json_files(json_dir, except_list, compression=None):
+    '''
+    Concatenate the per-host ndjson files into cluster.ndjson, compressed with compression if given, streaming block
+    by block. Files compressed the same way as the output are concatenated as they are, without decompressing them.
+    '''
+    ext = utils.COMPRESSIONS.get(compression, '')
+    output_filename = os.path.join(json_dir, 'cluster.ndjson' + ext)
+    # keep the extension, it decides the compression
+    tmp_filename = os.path.join(json_dir, '.tmp.cluster.ndjson' + ext)
+    inputs = []
+    for filename in sorted(os.listdir(json_dir)):
+        name = utils.strip_compression(filename)
+        if name in except_list or not name.endswith('.ndjson') or filename.startswith('.'):
             continue
-        data = utils.read_file(os.path.join(json_dir, filename))
-        # this must success, because it should dumped with this same script
-        parsed = json.loads(data)
-        combined.extend(parsed)
-    with open(os.path.join(json_dir, 'cluster.json'), 'wt') as fd:
-        json.dump(combined, fd, indent=1)
+        inputs.append(os.path.join(json_dir, filename))
+    raw = all(utils.compression_ext(filename) == ext for filename in inputs)
+    open_file = open if raw else utils.open_file
+    with profiler.stage('combine', file=output_filename) as span:
+        with open_file(tmp_filename, 'wb') as out:
+            for filename in inputs:
+                with open_file(filename, 'rb') as fd:
+                    shutil.copyfileobj(fd, out)
+        span.add(bytes_out=os.path.getsize(tmp_filename))
+    os.replace(tmp_filename, output_filename)
+    _remove_other_compressions(output_filename)
+    return output_filename
+
+
+def _append_json_files(output_filenames, offsets, cluster_filename):
+    '''
+    Append the bytes appended to each per-host ndjson file since offsets, {filename: size}, to cluster_filename.
+    Every file is compressed the same way, so the appended streams are copied as they are.
+    '''
+    with profiler.stage('combine', file=cluster_filename) as span:
+        size = os.path.getsize(cluster_filename)
+        with open(cluster_filename, 'ab') as out:
+            for filename in output_filenames:
+                with open(filename, 'rb') as fd:
+                    fd.seek(offsets.get(filename, 0))
+                    shutil.copyfileobj(fd, out)
+        span.add(bytes_out=os.path.getsize(cluster_filename) - size)
+
+
+def _export_json(ndjson_filename, json_filename):
+    '''
+    Export an ndjson file as a pretty printed json array, the format of artifacts of older versions.
+    Records are written one at a time, the output is the same as json.dump(records, fd, indent=1).
+    '''
+    logging.info('export {} to {}'.format(ndjson_filename, json_filename))
+    with profiler.stage('export_json', file=json_filename), utils.open_file(json_filename, 'wt') as fd:
+        fd.write('[')
+        sep = '\n '
+        for record in utils.read_records(ndjson_filename):
+            fd.write(sep)
+            fd.write(json.dumps(record, indent=1).replace('\n', '\n '))
+            sep = ',\n '
+        fd.write('\n]' if sep != '\n ' else ']')
+
+
+def _task_store_path(cluster_name):
+    return os.path.join(FLASHPROF_CLUSTER_DIR, cluster_name, 'task_dag', 'tasks.db')
+
+
+def _update_task_store(store_path, ndjson_filename, sqlite, offset=None):
+    '''
+    Rebuild the task store from ndjson_filename if sqlite, or else remove the one left by a previous run, which lookups
+    would prefer over the newer artifacts.
+    If offset is given and the store exists, only the records appended to ndjson_filename from offset on are loaded.
+    '''
+    if sqlite and offset is not None and os.path.exists(store_path):
+        task_store.update(store_path, utils.read_records(ndjson_filename, offset))
+    elif sqlite:
+        task_store.build(store_path, utils.read_records(ndjson_filename))
+    elif os.path.exists(store_path):
+        logging.info('remove {}, it is outdated without --sqlite'.format(store_path))
+        os.remove(store_path)
+
+
+def _json_filename(ndjson_filename):
+    '''
+    Name of the json export of an ndjson file, compressed the same way.
+    '''
+    ext = utils.compression_ext(ndjson_filename)
+    return utils.strip_compression(ndjson_filename)[:-len('.ndjson')] + '.json' + ext
+
 
+def _parsed_state_path(cluster_name):
+    return os.path.join(FLASHPROF_CLUSTER_DIR, cluster_name, 'task_dag', 'parsed.json')
 
-def _parse_cluster_log(cluster_name):
+
+def _appended_ranges(state_filename, log_dir, sizes, compression, cluster_filename):
+    '''
+    Returns {log file: (start, size)} of the bytes appended to the logs since they were parsed into the artifacts, as
+    recorded in state_filename, or None if the artifacts have to be parsed again from scratch, e.g. when a log has
+    been rewritten or the artifacts are compressed another way.
+    '''
+    if not os.path.exists(state_filename) or not os.path.exists(cluster_filename):
+        return None
+    with open(state_filename, 'rt') as fd:
+        state = json.load(fd)
+    if state['compression'] != compression:
+        return None
+    ranges = {}
+    for name, size in sizes.items():
+        start = state['logs'].get(name, 0)
+        if size < start:
+            logging.info('{} is smaller than when it was parsed, parse all the logs again'.format(name))
+            return None
+        if size > start:
+            ranges[os.path.join(log_dir, name)] = (start, size)
+    return ranges
+
+
+def _write_parsed_state(state_filename, sizes, compression):
+    with open(state_filename + '.tmp', 'wt') as fd:
+        json.dump({'compression': compression, 'logs': sizes}, fd, indent=1)
+    os.replace(state_filename + '.tmp', state_filename)
+
+
+def _parse_cluster_log(cluster_name, jobs=1, export_json=False, sqlite=False, compression=None, incremental=False):
+    '''
+    Parse the collected logs of a cluster into its artifacts. The size of each log parsed is recorded, and if
+    incremental, only the bytes appended to the logs since are parsed and their records appended to the artifacts,
+    except for the json export, which is written again.
+    '''
     log_dir = os.path.join(FLASHPROF_CLUSTER_DIR, cluster_name, 'log')
     task_dag_json_dir = os.path.join(FLASHPROF_CLUSTER_DIR, cluster_name, 'task_dag', 'json')
     utils.ensure_dir_exist(log_dir)
     utils.ensure_dir_exist(task_dag_json_dir)
-    logging.info('parse logs in {}'.format(log_dir))
-    _parse_log_to_file(log_dir, task_dag_json_dir)
-    _combine_json_files(task_dag_json_dir, ['cluster.json'])
+    sizes = {name: os.path.getsize(os.path.join(log_dir, name)) for name in sorted(os.listdir(log_dir))}
+    state_filename = _parsed_state_path(cluster_name)
+    cluster_filename = os.path.join(task_dag_json_dir, 'cluster.ndjson' + utils.COMPRESSIONS.get(compression, ''))
+    ranges = None
+    if incremental:
+        ranges = _appended_ranges(state_filename, log_dir, sizes, compression, cluster_filename)
+    if ranges is None:
+        logging.info('parse logs in {}'.format(log_dir))
+        with profiler.stage('parse_logs', dir=log_dir):
+            _parse_log_to_file(log_dir, task_dag_json_dir, jobs, compression)
+        cluster_filename = _combine_json_files(task_dag_json_dir, ['cluster.ndjson'], compression)
+        _update_task_store(_task_store_path(cluster_name), cluster_filename, sqlite)
+    else:
+        logging.info('parse the logs appended in {}'.format(log_dir))
+        cluster_size = os.path.getsize(cluster_filename)
+        json_files = [os.path.join(task_dag_json_dir, filename) for filename in os.listdir(task_dag_json_dir)]
+        offsets = {filename: os.path.getsize(filename) for filename in json_files}
+        with profiler.stage('parse_logs', dir=log_dir):
+            output_filenames = _parse_log_to_file(log_dir, task_dag_json_dir, jobs, compression, ranges)
+        _append_json_files(output_filenames, offsets, cluster_filename)
+        _update_task_store(_task_store_path(cluster_name), cluster_filename, sqlite, cluster_size)
+    if export_json:
+        _export_json(cluster_filename, _json_filename(cluster_filename))
+    _write_parsed_state(state_filename, sizes, compression)
 
 
 def collect(parser, args):
-    _clean_cluster(args.cluster)
-    username, ssh_key_file, tiflash_servers = _get_tiup_config(args.cluster)
+    if args.incremental and (args.since is not None or args.until is not None):
+        parser.error('--since/--until can not be used with --incremental')
+    # the manifest would mark the logs of the other queries as collected
+    if args.incremental and args.tso is not None:
+        parser.error('--tso can not be used with --incremental')
+    manifest_dir = None
+    if args.incremental:
+        manifest_dir = os.path.join(FLASHPROF_CLUSTER_DIR, args.cluster, 'manifest')
+    else:
+        _clean_cluster(args.cluster)
+    username, ssh_key_file, tiflash_servers = collector.get_tiup_config(args.cluster)
     log_dir = os.path.join(FLASHPROF_CLUSTER_DIR, args.cluster, 'log')
     task_dag_json_dir = os.path.join(FLASHPROF_CLUSTER_DIR, args.cluster, 'task_dag', 'json')
     utils.ensure_dir_exist(log_dir)
     utils.ensure_dir_exist(task_dag_json_dir)
-    for server in tiflash_servers:
-        _copy_log_file(server['host'], server['ssh_port'], username,
-                       ssh_key_file, server['log_dir'], args.cluster, args.tso)
-    _parse_cluster_log(args.cluster)
+    options = collector.CollectOptions(
+        args.tso, args.timeout, args.retries, args.compress, manifest_dir,
+        since=None if args.since is None else utils.parse_timestamp(args.since),
+        until=None if args.until is None else utils.parse_timestamp(args.until),
+        storage_compression=args.storage_compression, agent=args.agent)
+    results = collector.collect_logs(tiflash_servers, username, ssh_key_file, log_dir, options, args.parallelism)
+    collector.log_summary(results)
+    _parse_cluster_log(args.cluster, args.jobs, args.export_json, args.sqlite, args.storage_compression,
+                       args.incremental)
 
 
 def parse(parser, args):
     if args.cluster is None:
         # all clusters
         for cluster_name in os.listdir(FLASHPROF_CLUSTER_DIR):
-            _parse_cluster_log(cluster_name)
+            _parse_cluster_log(cluster_name, args.jobs, args.export_json, args.sqlite, args.storage_compression)
     else:
         cluster_dir = os.path.join(FLASHPROF_CLUSTER_DIR, args.cluster)
         if not os.path.exists(cluster_dir):
             raise FileNotFoundError('cannot find cluster dir for {}, should be {}'.format(args.cluster, cluster_dir))
-        _parse_cluster_log(args.cluster)
+        _parse_cluster_log(args.cluster, args.jobs, args.export_json, args.sqlite, args.storage_compression)
 
-def _parse_files(log_path, out_dir):
+def _parse_files(log_path, out_dir, jobs=1, export_json=False, sqlite=False, compression=None):
     utils.ensure_dir_exist(out_dir)
-    _parse_one_log_to_file(log_path, out_dir)
+    output_filename = _parse_one_log_to_file(log_path, out_dir, jobs, compression)
+    if export_json:
+        _export_json(output_filename, _json_filename(output_filename))
+    _update_task_store(os.path.join(out_dir, 'tasks.db'), output_filename, sqlite)
 
 def parse_one(parser, args):
-    _parse_files(args.log_file, args.out_dir)
+    _parse_files(args.log_file, args.out_dir, args.jobs, args.export_json, args.sqlite, args.storage_compression)
 
-def _render_files(json_path, out_dir, type, format):
+def _render_files(json_path, out_dir, options):
     '''
     The original json may contain multiple distinct query tso, so we need to split it into multiple input
     with a single tso in each.
     The number of output file(s) is equal to distinct(query_tso) in the original json file.
     '''
-    json_data = utils.read_json(json_path)
+    _render_records(task_model.read_tasks(json_path), out_dir, options)
 
-    # split dataset according to query_tso
-    tso_partitioned = defaultdict(lambda: defaultdict(list))  # {tso: {task_id: [INITIALIZING, FINISHED/CANCELLED]}}
-    for data in json_data:
-        query_tso = data['query_tso']
-        task_id = data['task_id']
-        tso_partitioned[query_tso][task_id].append(data)
 
+def _render_query(query_tso, data, out_dir, options):
+    '''
+    Returns the names of the output files in out_dir.
+    '''
+    logging.debug('query_tso [{}], count [{}]'.format(query_tso, len(data)))
+    if options.type == RENDER_TYPE.TASK_DAG:
+        dot_name = '{}.dot'.format(query_tso)
+        critical_path = None
+        if options.critical_path:
+            critical_path = [p['task_id'] for p in analysis.critical_path(data)]
+        stragglers = analysis.stragglers(data, options.straggler_ratio) if options.straggler_ratio else None
+        with profiler.stage('graphviz', query_tso=query_tso) as span:
+            draw_tasks_dag(data, os.path.join(out_dir, dot_name), options.format, critical_path,
+                           options.collapse_threshold, stragglers)
+            span.add(records=len(data))
+        output_names = [dot_name, '{}.{}'.format(dot_name, options.format)]
+    elif options.type == RENDER_TYPE.TIMELINE:
+        trace_name = '{}.trace.json'.format(query_tso)
+        with profiler.stage('trace_events', query_tso=query_tso) as span:
+            span.add(records=trace_event.write_tasks_trace(data, os.path.join(out_dir, trace_name)))
+        output_names = [trace_name]
+    else:
+        raise Exception('type {} is not supported yet'.format(options.type))
     # only for debugging
-    for query_tso, data in tso_partitioned.items():
-        utils.ensure_dir_exist(os.path.join(out_dir, '.json_debug'))
-        with open(os.path.join(out_dir, '.json_debug', '{}.json'.format(query_tso)), 'wt') as fd:
-            json.dump(data, fd, indent=1)
-
-    # overwrite task with INITIALIZING status with CANCELLED/FINISHED
-    status_pruned = defaultdict(list)  # {tso: [list of tasks]}
-    for query_tso, tasks_map in tso_partitioned.items():
-        for task_id, tasks in tasks_map.items():
-            if len(tasks) == 1:  # only INITIALIZING
-                if tasks[0]['status'] != 'INITIALIZING':
-                    logging.error('expect the only task has status INITIALIZING, tso [{}], task_id [{}]'.format(query_tso, task_id))
-                    continue
-                status_pruned[query_tso].append(tasks[0])
-            elif len(tasks) == 2:  # has INITIALIZING and FINISHED/CANCELLED
-                if tasks[0]['status'] == tasks[1]['status'] == 'INITIALIZING':
-                    logging.error('2 tasks must not all have INITIALIZING status, tso [{}], task_id [{}]'.format(query_tso, task_id))
-                    continue
-                if tasks[0]['status'] != 'INITIALIZING' and tasks[1]['status'] != 'INITIALIZING':
-                    logging.error('at least 1 task must have INITIALIZING status, tso [{}], task_id [{}]'.format(query_tso, task_id))
-                    continue
-                _task = tasks[0]
-                if _task['status'] == 'INITIALIZING':
-                    _task = tasks[1]
-                status_pruned[query_tso].append(_task)
-            else:
-                logging.error('expect only 1 or 2 tasks with status, got [{}], tso [{}], task_id [{}]'.format(len(tasks), query_tso, task_id))
-                continue
-
-    # NOTE: we can parallelize this and utilize all the cpu cores to render
-    for query_tso, data in status_pruned.items():
-        logging.debug('query_tso [{}], count [{}]'.format(query_tso, len(data)))
-        out_path = os.path.join(out_dir, '{}.dot'.format(query_tso))
-        logging.info('rendering query_tso [{}]'.format(query_tso))
-        if type == RENDER_TYPE.TASK_DAG:
-            draw_tasks_dag(data, out_path, format)
-        else:
-            raise Exception('type {} is not supported yet'.format(type))
+    debug_name = os.path.join('.json_debug', '{}.json'.format(query_tso))
+    with open(os.path.join(out_dir, debug_name), 'wt') as fd:
+        json.dump([task_model.as_dict(t) for t in data], fd, indent=1)
+    return output_names + [debug_name]
+
+
+def _group_by_query(records):
+    '''
+    Split records according to query_tso, records being the final state of each task as written by `parse`.
+    Returns {tso: [list of tasks]}.
+    '''
+    ret = defaultdict(list)
+    for record in records:
+        ret[record['query_tso']].append(record)
+    return ret
+
+
+def _render_records(json_data, out_dir, options, gc=True):
+    '''
+    Render every query in json_data, skipping those whose outputs in out_dir are rendered from the same records with
+    the same options. If gc, outputs of queries not in json_data are deleted.
+    '''
+    with profiler.stage('group_by_query'):
+        queries = _group_by_query(json_data)
+    if options.type == RENDER_TYPE.EXPLORER:
+        # nothing is laid out, a query is only laid out when it is opened
+        explorer.write_explorer(queries, out_dir, gc, options.collapse_threshold)
+        return
+    # created before any worker writes a debug dump into it
+    utils.ensure_dir_exist(os.path.join(out_dir, '.json_debug'))
+    cache = render_cache.RenderCache(out_dir)
+    if gc:
+        removed = cache.gc(queries.keys())
+        if removed:
+            logging.info('removed outputs of {} queries no longer in the dataset'.format(removed))
+
+    todo = {}
+    for query_tso, data in queries.items():
+        key = render_cache.render_key(data, options)
+        if options.use_cache and cache.is_fresh(query_tso, key):
+            continue
+        todo[query_tso] = key
+    total = len(todo)
+    logging.info('{} queries to render, {} up to date'.format(total, len(queries) - total))
+
+    # queries are rendered by a pool of processes, and a failed query does not abort the others
+    failed = []
+    start = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, min(options.jobs, total)), initializer=profiler.init_worker,
+                                 initargs=profiler.worker_args()) as executor:
+            futures = {}
+            for query_tso in todo:
+                futures[executor.submit(_render_query, query_tso, queries[query_tso], out_dir, options)] = query_tso
+            for done, future in enumerate(as_completed(futures), 1):
+                query_tso = futures[future]
+                try:
+                    cache.put(query_tso, todo[query_tso], future.result())
+                    logging.info('rendered [{}/{}] query_tso [{}]'.format(done, total, query_tso))
+                except Exception as e:
+                    failed.append(query_tso)
+                    cache.remove(query_tso)
+                    logging.error('failed to render [{}/{}] query_tso [{}]: {}'.format(done, total, query_tso, e))
+    finally:
+        cache.save()
+    elapsed = time.time() - start
+    rendered = total - len(failed)
+    logging.info('rendered {} queries in {:.2f}s with {} jobs, {:.2f} queries/s'.format(
+        rendered, elapsed, options.jobs, rendered / elapsed if elapsed > 0 else 0))
+    if failed:
+        logging.error('failed to render {} queries: {}'.format(len(failed), ', '.join(str(tso) for tso in failed)))
+
+
+def _render_options(args, type):
+    return RenderOptions(type, args.format, args.jobs, not args.no_cache, args.critical_path, args.collapse_threshold,
+                         args.straggler_ratio)
+
+
+def _import_csv_reader():
+    try:
+        import visualize_task_csv
+    except ImportError as e:
+        raise ImportError('`--input_format csv` requires pandas, install it with `pip3 install flashprof[csv]`') from e
+    return visualize_task_csv
 
 
 def render_one(parser, args):
-    _render_files(args.json_file, args.out_dir, args.type, args.format)
+    if args.input_format == 'csv':
+        csv_reader = _import_csv_reader()
+        tasks = task_model.to_tasks(csv_reader.to_records(csv_reader.read_csv(args.json_file)))
+        _render_records(tasks, args.out_dir, _render_options(args, args.type))
+        return
+    _render_files(args.json_file, args.out_dir, _render_options(args, args.type))
 
 
 def render_cluster(parser, args):
@@ -218,11 +482,211 @@ def render_cluster(parser, args):
     else:
         cluster_dirs = [os.path.join(FLASHPROF_CLUSTER_DIR, args.cluster)]
 
+    options = _render_options(args, args.type)
     for cluster_dir in cluster_dirs:
         logging.debug('start rendering for {}'.format(cluster_dir))
-        json_path = os.path.join(cluster_dir, 'task_dag', 'json', 'cluster.json')
-        out_dir = os.path.join(cluster_dir, 'task_dag', args.format)
-        _render_files(json_path, out_dir, RENDER_TYPE.TASK_DAG, args.format)
+        json_path = _cluster_json_path(cluster_dir)
+        if args.type == RENDER_TYPE.TIMELINE:
+            out_dir = os.path.join(cluster_dir, 'timeline')
+        elif args.type == RENDER_TYPE.EXPLORER:
+            out_dir = os.path.join(cluster_dir, 'explorer')
+        else:
+            out_dir = os.path.join(cluster_dir, 'task_dag', args.format)
+        if args.tso is None:
+            _render_files(json_path, out_dir, options)
+            continue
+        records = _read_queries(json_path, [args.tso], os.path.join(cluster_dir, 'task_dag', 'tasks.db'))
+        _render_records(records.get(args.tso, []), out_dir, options, gc=False)
+
+
+def _read_queries(json_path, tsos, store_path=None):
+    '''
+    Returns {tso: [tasks]} of the queries in tsos, looked up in the task store at store_path if it exists, or else
+    scanned from json_path.
+    '''
+    tsos = set(tsos)
+    if store_path is not None and os.path.exists(store_path):
+        with task_store.TaskStore(store_path) as store:
+            return {tso: list(task_model.to_tasks(store.find(task_store.TaskFilter(query_tso=tso)))) for tso in tsos}
+    if store_path is not None:
+        logging.warning('{} does not exist, scanning {} for query_tso {}, run `parse --sqlite` for faster lookups'.format(
+            store_path, json_path, sorted(tsos)))
+    return _group_by_query(t for t in task_model.read_tasks(json_path) if t.query_tso in tsos)
+
+
+def _cluster_json_path(cluster_dir):
+    json_dir = os.path.join(cluster_dir, 'task_dag', 'json')
+    for ext in [''] + list(utils.COMPRESSIONS.values()):
+        json_path = os.path.join(json_dir, 'cluster.ndjson' + ext)
+        if os.path.exists(json_path):
+            return json_path
+    # artifacts of older versions
+    return os.path.join(json_dir, 'cluster.json')
+
+
+def analyze(parser, args):
+    if args.json_file is not None:
+        json_path = args.json_file
+    elif args.cluster is not None:
+        json_path = _cluster_json_path(os.path.join(FLASHPROF_CLUSTER_DIR, args.cluster))
+    else:
+        raise ValueError('either --cluster or --json_file is required')
+    records = task_model.read_tasks(json_path)
+    if args.tso is not None:
+        records = (t for t in records if t.query_tso == args.tso)
+    queries = _group_by_query(records)
+    reports = [analysis.analyze_query(query_tso, tasks) for query_tso, tasks in sorted(queries.items())]
+    if args.out is not None:
+        with open(args.out, 'wt') as fd:
+            for report in reports:
+                fd.write(json.dumps(report))
+                fd.write('\n')
+        logging.info('write {} reports to {}'.format(len(reports), args.out))
+    else:
+        for report in reports:
+            for line in analysis.format_report(report):
+                print(line)
+        # which hosts straggle most often across all the queries
+        for line in analysis.format_host_rollup(analysis.host_rollup(reports)):
+            print(line)
+
+
+def diff(parser, args):
+    if len(args.tso) != 2:
+        parser.error('diff takes exactly 2 --tso')
+    tso_a, tso_b = args.tso
+    if args.json_file:
+        if len(args.json_file) > 2:
+            parser.error('diff takes at most 2 --json_file')
+        sources = [(json_path, None) for json_path in args.json_file]
+        out_dir = args.out_dir or os.path.dirname(os.path.abspath(args.json_file[-1]))
+    elif args.cluster is not None:
+        cluster_dir = os.path.join(FLASHPROF_CLUSTER_DIR, args.cluster)
+        sources = [(_cluster_json_path(cluster_dir), os.path.join(cluster_dir, 'task_dag', 'tasks.db'))]
+        out_dir = args.out_dir or os.path.join(cluster_dir, 'diff')
+    else:
+        parser.error('either --cluster or --json_file is required')
+    if len(sources) == 1:
+        queries = _read_queries(sources[0][0], [tso_a, tso_b], sources[0][1])
+        tasks_a, tasks_b = queries.get(tso_a), queries.get(tso_b)
+    else:
+        tasks_a = _read_queries(sources[0][0], [tso_a]).get(tso_a)
+        tasks_b = _read_queries(sources[1][0], [tso_b]).get(tso_b)
+    for tso, tasks, (json_path, _) in ((tso_a, tasks_a, sources[0]), (tso_b, tasks_b, sources[-1])):
+        if not tasks:
+            raise ValueError('cannot find query_tso [{}] in {}'.format(tso, json_path))
+
+    report = query_diff.diff_queries(tso_a, tasks_a, tso_b, tasks_b)
+    for line in query_diff.format_report(report):
+        print(line)
+    if args.out is not None:
+        with open(args.out, 'wt') as fd:
+            json.dump(report, fd, indent=1)
+        logging.info('write the diff report to {}'.format(args.out))
+    utils.ensure_dir_exist(out_dir)
+    dot_name = os.path.join(out_dir, '{}_{}.dot'.format(tso_a, tso_b))
+    with profiler.stage('graphviz', query_tso=tso_b):
+        draw_diff_dag(report, tasks_b, dot_name, args.format)
+    logging.info('diff dag written to {}.{}'.format(dot_name, args.format))
+
+
+def stats(parser, args):
+    try:
+        import stats as task_stats
+    except ImportError as e:
+        raise ImportError('`stats` requires numpy, install it with `pip3 install flashprof[stats]`') from e
+    json_paths = list(args.json_file or [])
+    if args.input_format == 'csv':
+        if not json_paths or args.cluster is not None:
+            parser.error('--input_format csv only reads the files of --json_file')
+        _import_csv_reader()
+    if args.cluster is not None:
+        json_paths.append(_cluster_json_path(os.path.join(FLASHPROF_CLUSTER_DIR, args.cluster)))
+    elif not json_paths:
+        # all clusters
+        for cluster_name in sorted(os.listdir(FLASHPROF_CLUSTER_DIR)):
+            json_paths.append(_cluster_json_path(os.path.join(FLASHPROF_CLUSTER_DIR, cluster_name)))
+    group_by = [k for k in args.group_by.split(',') if k] if args.group_by else []
+    task_stats.run(json_paths, group_by, args.format, args.out, not args.no_cache, args.input_format)
+
+
+def watch(parser, args):
+    username, ssh_key_file, tiflash_servers = collector.get_tiup_config(args.cluster)
+    out_dir = os.path.join(FLASHPROF_CLUSTER_DIR, args.cluster, 'watch')
+    utils.ensure_dir_exist(out_dir)
+    options = watcher.WatchOptions(args.tso, args.timeout, args.interval, args.window, args.top, args.duration,
+                                   args.parallelism)
+    try:
+        watcher.Watcher(tiflash_servers, username, ssh_key_file, out_dir, options).run()
+    except KeyboardInterrupt:
+        pass
+    logging.info('task records and summary are in {}'.format(out_dir))
+
+
+def _parse_status(status):
+    '''
+    `--status FINISHED` or `--status != FINISHED`, returns (operator, status).
+    '''
+    if status is None:
+        return '=', None
+    status = ''.join(status).strip()
+    for op in ('!=', '='):
+        if status.startswith(op):
+            return op, status[len(op):].strip()
+    return '=', status
+
+
+def query(parser, args):
+    store_path = _task_store_path(args.cluster)
+    if not os.path.exists(store_path):
+        raise FileNotFoundError('cannot find task store for {}, should be {}, run `parse --sqlite` first'.format(
+            args.cluster, store_path))
+    status_op, status = _parse_status(args.status)
+    task_filter = task_store.TaskFilter(
+        query_tso=args.tso, task_id=args.task_id, host=args.host, status=status, status_op=status_op,
+        min_duration=None if args.min_duration is None else int(args.min_duration * 1000),
+        since=None if args.since is None else utils.parse_timestamp(args.since),
+        until=None if args.until is None else utils.parse_timestamp(args.until),
+        executor_type=args.executor_type)
+    with task_store.TaskStore(store_path) as store:
+        records = store.find(task_filter, args.limit, with_executors=args.format == 'ndjson')
+        if args.format == 'ndjson':
+            for record in records:
+                print(json.dumps(record))
+            return
+        print('{:<20} {:>8} {:<22} {:<12} {:>12}  {}'.format('query_tso', 'task_id', 'host', 'status', 'duration_ms', 'error_message'))
+        for r in records:
+            start = r.get('task_start_timestamp')
+            end = r.get('task_end_timestamp')
+            duration = '{:.3f}'.format((end - start) / 1000) if start and end else '-'
+            print('{:<20} {:>8} {:<22} {:<12} {:>12}  {}'.format(
+                r['query_tso'], r['task_id'], r.get('host', ''), r.get('status', ''), duration, r.get('error_message', '')))
+
+
+def _add_parse_arguments(parser):
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='number of processes used to parse logs, default to the number of cpu cores')
+    parser.add_argument('--export_json', action='store_true',
+                        help='also export the parsed ndjson as a pretty printed json array')
+    parser.add_argument('--sqlite', action='store_true',
+                        help='also load the parsed task records into an indexed sqlite database for `query` and `render --tso`')
+    parser.add_argument('--storage_compression', type=str, choices=list(utils.COMPRESSIONS),
+                        help='compress the parsed ndjson, and the collected logs for `collect`, zst requires zstandard')
+
+
+def _add_render_arguments(parser):
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='number of processes used to render queries, default to the number of cpu cores')
+    parser.add_argument('--no_cache', action='store_true',
+                        help='render every query, even if its outputs are up to date')
+    parser.add_argument('--critical_path', action='store_true',
+                        help='highlight the critical path of each query, see the `analyze` subcommand')
+    parser.add_argument('--collapse_threshold', type=int, default=COLLAPSE_THRESHOLD,
+                        help='draw queries with more tasks than this as one node per stage with aggregated timings, '
+                        '0 to always collapse, default to {}'.format(COLLAPSE_THRESHOLD))
+    parser.add_argument('--straggler_ratio', type=float, default=analysis.STRAGGLER_RATIO,
+                        help='outline the tasks taking this many times the median duration of their stage, '
+                        '0 to disable, default to {}'.format(analysis.STRAGGLER_RATIO))
 
 
 def default(parser, args):
@@ -233,6 +697,13 @@ def cli():
     parser = argparse.ArgumentParser()
     parser.add_argument('--log', type=str, default='info',
                         help='log level, use debug for more detailed logs, default to info')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile wall time, cpu time, bytes, records and memory of each stage for each host, file '
+                        'and query, see --profile_out')
+    parser.add_argument('--profile_out', type=str, default='flashprof_profile.json',
+                        help='json report of --profile, default to flashprof_profile.json')
+    parser.add_argument('--profile_trace', type=str,
+                        help='with --profile, also write a chrome trace of the execution of flashprof to this file')
     parser.set_defaults(func=default)
 
     subparsers = parser.add_subparsers()
@@ -241,27 +712,121 @@ def cli():
         'collect', help='try to use tiup configuration in this machine for the cluster specified in args')
     parser_collect.add_argument('--cluster', type=str, required=True)
     parser_collect.add_argument('--tso', type=str)
+    parser_collect.add_argument('--parallelism', type=int, default=16,
+                                help='max number of tiflash servers to collect from concurrently, default to 16')
+    parser_collect.add_argument('--timeout', type=float, default=600,
+                                help='timeout in seconds of a single collecting attempt on one host, default to 600')
+    parser_collect.add_argument('--retries', type=int, default=2,
+                                help='number of retries after a failed attempt on one host, default to 2')
+    parser_collect.add_argument('--compress', action='store_true',
+                                help='gzip the grep output on the remote host before transferring it')
+    parser_collect.add_argument('--incremental', action='store_true',
+                                help='keep previously collected logs and only fetch tracing lines appended since the last '
+                                'incremental run, including those in rotated log files')
+    parser_collect.add_argument('--since', type=str,
+                                help='only collect logs written since this time, "YYYY-MM-DD HH:MM:SS[.ffffff]" in local '
+                                'time or a timestamp in microseconds')
+    parser_collect.add_argument('--until', type=str, help='only collect logs written until this time, same format as --since')
+    parser_collect.add_argument('--agent', action='store_true',
+                                help='parse logs on each tiflash server with a python agent uploaded over ssh, and only '
+                                'transfer the final state of each task, servers without python >= 3.5 fall back to grep')
+    _add_parse_arguments(parser_collect)
     parser_collect.set_defaults(func=collect)
 
     parser_render = subparsers.add_parser('render', help='render task dag files into graphic format')
     parser_render.add_argument('--cluster', type=str)
-    parser_render.add_argument('--format', type=str, default='svg')
+    parser_render.add_argument('--type', type=RENDER_TYPE, default=RENDER_TYPE.TASK_DAG, choices=list(RENDER_TYPE),
+                               help='task_dag renders graphviz dags, timeline writes chrome trace event files to be opened '
+                               'in ui.perfetto.dev, explorer writes an html index of all queries, which are only laid out '
+                               'when opened, default to task_dag')
+    parser_render.add_argument('--format', type=str, default='svg', help='graphviz output format of task_dag')
+    parser_render.add_argument('--tso', type=int, help='only render this query_tso, looked up in the sqlite task store if any')
+    _add_render_arguments(parser_render)
     parser_render.set_defaults(func=render_cluster)
 
     parser_parse = subparsers.add_parser('parse', help='default to parse all clusters\' logs, mainly for debugging')
     parser_parse.add_argument('--cluster', type=str)
+    _add_parse_arguments(parser_parse)
     parser_parse.set_defaults(func=parse)
 
     parser_parse_one = subparsers.add_parser('parse_one', help='parse one file, mainly for debugging')
     parser_parse_one.add_argument('--log_file', type=str, required=True)
     parser_parse_one.add_argument('--out_dir', type=str, required=True)
+    _add_parse_arguments(parser_parse_one)
     parser_parse_one.set_defaults(func=parse_one)
 
+    parser_analyze = subparsers.add_parser('analyze', help='find the critical path of each query and break it down by phase')
+    parser_analyze.add_argument('--cluster', type=str)
+    parser_analyze.add_argument('--json_file', type=str, help='analyze this file instead of the cluster.ndjson of --cluster')
+    parser_analyze.add_argument('--tso', type=int, help='only analyze this query_tso')
+    parser_analyze.add_argument('--out', type=str, help='write the reports to this file as ndjson instead of printing them')
+    parser_analyze.set_defaults(func=analyze)
+
+    parser_diff = subparsers.add_parser('diff', help='compare two runs of a query stage by stage, e.g. before and after an upgrade')
+    parser_diff.add_argument('--tso', type=int, action='append', required=True,
+                             help='query_tso of the first then the second run, given twice')
+    parser_diff.add_argument('--cluster', type=str)
+    parser_diff.add_argument('--json_file', type=str, action='append',
+                             help='read the queries from this file instead of the cluster.ndjson of --cluster, '
+                                  'given twice to read the second run from the second file')
+    parser_diff.add_argument('--out_dir', type=str,
+                             help='where the diff dag is rendered, default to flashprof/cluster/$CLUSTER_NAME/diff, '
+                                  'or the dir of the last --json_file')
+    parser_diff.add_argument('--format', type=str, default='svg')
+    parser_diff.add_argument('--out', type=str, help='also write the report to this json file')
+    parser_diff.set_defaults(func=diff)
+
+    parser_stats = subparsers.add_parser('stats', help='percentiles of task timings, throughput and memory, requires numpy')
+    parser_stats.add_argument('--cluster', type=str, help='default to all clusters if no --json_file is given')
+    parser_stats.add_argument('--json_file', type=str, action='append', help='task dag json/ndjson file, can be repeated')
+    parser_stats.add_argument('--input_format', type=str, default='json', choices=['json', 'csv'],
+                              help='format of --json_file, csv being a tracing csv export, requires pandas')
+    parser_stats.add_argument('--group_by', type=str, default='host',
+                              help='comma separated keys among host, status and executor_type, default to host')
+    parser_stats.add_argument('--format', type=str, default='table', choices=['table', 'csv', 'json'])
+    parser_stats.add_argument('--out', type=str, help='write to this file instead of stdout')
+    parser_stats.add_argument('--no_cache', action='store_true',
+                              help='do not read or write the .columns.npz cache next to the json files')
+    parser_stats.set_defaults(func=stats)
+
+    parser_watch = subparsers.add_parser('watch', help='follow tracing lines of a live cluster and show a rolling summary')
+    parser_watch.add_argument('--cluster', type=str, required=True)
+    parser_watch.add_argument('--tso', type=str)
+    parser_watch.add_argument('--interval', type=float, default=2, help='seconds between summary refreshes, default to 2')
+    parser_watch.add_argument('--window', type=float, default=60,
+                              help='seconds over which queries/s and tasks/s are computed, default to 60')
+    parser_watch.add_argument('--top', type=int, default=10, help='number of slowest queries shown, default to 10')
+    parser_watch.add_argument('--duration', type=float, help='stop after this many seconds, default to run until ctrl-c')
+    parser_watch.add_argument('--parallelism', type=int, default=16,
+                              help='max number of tiflash servers to connect to concurrently, default to 16')
+    parser_watch.add_argument('--timeout', type=float, default=60,
+                              help='timeout in seconds of connecting to one host, default to 60')
+    parser_watch.set_defaults(func=watch)
+
+    parser_query = subparsers.add_parser('query', help='look up task records in the sqlite task store built by `parse --sqlite`')
+    parser_query.add_argument('--cluster', type=str, required=True)
+    parser_query.add_argument('--tso', type=int)
+    parser_query.add_argument('--task_id', type=int)
+    parser_query.add_argument('--host', type=str)
+    parser_query.add_argument('--status', type=str, nargs='+', help='e.g. `--status CANCELLED` or `--status != FINISHED`')
+    parser_query.add_argument('--executor_type', type=str, help='only tasks having an executor of this type')
+    parser_query.add_argument('--min-duration', '--min_duration', dest='min_duration', type=float,
+                              help='minimal task execution duration in milliseconds')
+    parser_query.add_argument('--since', type=str,
+                              help='tasks started since this time, "YYYY-MM-DD HH:MM:SS[.ffffff]" in local time or a timestamp in microseconds')
+    parser_query.add_argument('--until', type=str, help='tasks started until this time, same format as --since')
+    parser_query.add_argument('--limit', type=int)
+    parser_query.add_argument('--format', type=str, default='table', choices=['table', 'ndjson'])
+    parser_query.set_defaults(func=query)
+
     parser_render_one = subparsers.add_parser('render_one', help='render one file, mainly for debugging')
     parser_render_one.add_argument('--json_file', type=str, required=True)
+    parser_render_one.add_argument('--input_format', type=str, default='json', choices=['json', 'csv'],
+                                   help='format of --json_file, csv being a tracing csv export, requires pandas')
     parser_render_one.add_argument('--out_dir', type=str, required=True)
     parser_render_one.add_argument('--type', type=RENDER_TYPE, default=RENDER_TYPE.TASK_DAG, choices=list(RENDER_TYPE))
     parser_render_one.add_argument('--format', type=str, default='svg')
+    _add_render_arguments(parser_render_one)
     parser_render_one.set_defaults(func=render_one)
 
     args = parser.parse_args(sys.argv[1:])
@@ -273,7 +838,15 @@ def cli():
                         format='%(asctime)s.%(msecs)03d %(levelname)s %(message)s', datefmt='%H:%M:%S')
     logging.debug('logging level is set to {}'.format(args.log.upper()))
 
-    args.func(parser, args)
+    if not args.profile:
+        args.func(parser, args)
+    else:
+        profiler.enable()
+        try:
+            with profiler.stage('command', command=args.func.__name__):
+                args.func(parser, args)
+        finally:
+            profiler.finish(args.profile_out, args.profile_trace)
 
     logging.debug('done')
 
@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import trace_event
+
+# counters a stage can account with Span.add
+COUNTERS = ['bytes_in', 'bytes_out', 'records']
+
+# spool dir of the spans of all processes, None when profiling is off
+_spool_dir = None
+_lock = threading.Lock()
+_spool_fd = None
+
+
+def _peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    '''
+    Wall time, cpu time of the current thread and counters of a stage, e.g. the parsing of a file.
+    attrs identify what the stage worked on, e.g. host, file or query_tso.
+    '''
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.counters = {}
+
+    def add(self, **counters):
+        for k, v in counters.items():
+            self.counters[k] = self.counters.get(k, 0) + v
+
+    def __enter__(self):
+        self._start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self._wall
+        cpu = time.thread_time() - self._cpu
+        _record({
+            'name': self.name,
+            'attrs': self.attrs,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+            'start': self._start,
+            'wall': wall,
+            'cpu': cpu,
+            'peak_rss_mb': _peak_rss_mb(),
+            'error': exc_type.__name__ if exc_type is not None else '',
+            **self.counters,
+        })
+        return False
+
+
+def enabled():
+    return _spool_dir is not None
+
+
+def stage(name, **attrs):
+    '''
+    Context manager profiling a stage, returning a Span to account counters with.
+    When profiling is off this is a shared no-op object, so instrumented code pays one function call.
+    '''
+    if _spool_dir is None:
+        return _NOOP_SPAN
+    return Span(name, attrs)
+
+
+def _record(span):
+    # every process appends the spans it ends to its own file in the spool dir, so that spans of worker processes
+    # are collected without sending them back with the results
+    global _spool_fd
+    line = json.dumps(span, separators=(',', ':')) + '\n'
+    with _lock:
+        if _spool_fd is None:
+            _spool_fd = open(os.path.join(_spool_dir, '{}.ndjson'.format(os.getpid())), 'at')
+        _spool_fd.write(line)
+        _spool_fd.flush()
+
+
+def init_worker(spool_dir):
+    '''
+    Initializer of worker processes, pass worker_args() as its initargs.
+    '''
+    global _spool_dir, _spool_fd, _lock
+    _spool_dir = spool_dir
+    # a forked worker must not share the file or the lock of its parent
+    _spool_fd = None
+    _lock = threading.Lock()
+
+
+def worker_args():
+    return (_spool_dir,)
+
+
+def enable():
+    global _spool_dir
+    _spool_dir = tempfile.mkdtemp(prefix='flashprof_profile_')
+
+
+def _read_spans():
+    spans = []
+    for filename in sorted(os.listdir(_spool_dir)):
+        with open(os.path.join(_spool_dir, filename), 'rt') as fd:
+            spans.extend(json.loads(line) for line in fd)
+    spans.sort(key=lambda s: s['start'])
+    return spans
+
+
+def summarize(spans):
+    '''
+    Totals of each stage, sorted by wall time.
+    Wall times of concurrent spans of a stage add up, so they may exceed the wall time of the command.
+    '''
+    stages = defaultdict(lambda: dict(count=0, wall=0.0, cpu=0.0, peak_rss_mb=0.0, **{c: 0 for c in COUNTERS}))
+    for s in spans:
+        total = stages[s['name']]
+        total['count'] += 1
+        total['wall'] += s['wall']
+        total['cpu'] += s['cpu']
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], s['peak_rss_mb'])
+        for c in COUNTERS:
+            total[c] += s.get(c, 0)
+    ret = []
+    for name, total in stages.items():
+        total['records_per_second'] = total['records'] / total['wall'] if total['wall'] > 0 else 0
+        ret.append(dict(name=name, **total))
+    ret.sort(key=lambda t: t['wall'], reverse=True)
+    return ret
+
+
+def write_trace(spans, filename):
+    '''
+    Chrome trace of the spans, each process and thread of flashprof being a track.
+    '''
+    with trace_event.TraceEventWriter(filename) as writer:
+        for pid in sorted(set(s['pid'] for s in spans)):
+            writer.process_name(pid, 'flashprof {}'.format(pid))
+        for s in spans:
+            start = int(s['start'] * 1000000)
+            args = dict(s['attrs'], cpu=s['cpu'], peak_rss_mb=s['peak_rss_mb'],
+                        **{c: s[c] for c in COUNTERS if c in s})
+            writer.complete(s['pid'], s['tid'], s['name'], start, start + max(1, int(s['wall'] * 1000000)), args,
+                            category='flashprof')
+
+
+def finish(report_filename, trace_filename=None, argv=None):
+    '''
+    Write the report of all the spans recorded since enable(), and the chrome trace if trace_filename is given.
+    '''
+    global _spool_dir, _spool_fd
+    if _spool_dir is None:
+        return
+    with _lock:
+        if _spool_fd is not None:
+            _spool_fd.close()
+            _spool_fd = None
+    spans = _read_spans()
+    shutil.rmtree(_spool_dir, ignore_errors=True)
+    _spool_dir = None
+    summary = summarize(spans)
+    with open(report_filename, 'wt') as fd:
+        json.dump({'argv': argv or sys.argv, 'stages': summary, 'spans': spans}, fd, indent=1)
+    logging.info('profile of {} spans written to {}'.format(len(spans), report_filename))
+    logging.info('{:<20} {:>8} {:>10} {:>10} {:>14} {:>14} {:>10} {:>12} {:>10}'.format(
+        'stage', 'count', 'wall(s)', 'cpu(s)', 'bytes_in', 'bytes_out', 'records', 'records/s', 'rss(MB)'))
+    for t in summary:
+        logging.info('{:<20} {:>8} {:>10.3f} {:>10.3f} {:>14} {:>14} {:>10} {:>12.1f} {:>10.1f}'.format(
+            t['name'], t['count'], t['wall'], t['cpu'], t['bytes_in'], t['bytes_out'], t['records'],
+            t['records_per_second'], t['peak_rss_mb']))
+    if trace_filename is not None:
+        write_trace(spans, trace_filename)
+        logging.info('profile trace written to {}'.format(trace_filename))
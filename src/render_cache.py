@@ -0,0 +1,96 @@
+import hashlib
+import json
+import logging
+import os
+
+import task_model
+
+CACHE_FILENAME = '.render_cache.json'
+# modules the rendered outputs depend on, hashed into the render key so that any change to them invalidates the cache,
+# also when running from source
+RENDERER_MODULES = ['main.py', 'analysis.py', 'task_model.py', 'trace_event.py', 'visualize_task_json.py']
+
+
+def _renderer_hash():
+    h = hashlib.sha1()
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in RENDERER_MODULES:
+        with open(os.path.join(src_dir, name), 'rb') as fd:
+            h.update(fd.read())
+    return h.hexdigest()
+
+
+RENDERER_HASH = _renderer_hash()
+
+
+def render_key(data, options):
+    '''
+    Content hash of the pruned task records of a query and everything else the rendered output depends on.
+    '''
+    h = hashlib.sha1()
+    h.update(json.dumps([RENDERER_HASH, options.cache_token()]).encode())
+    for task in sorted(data, key=lambda t: t['task_id']):
+        h.update(json.dumps(task_model.as_dict(task), sort_keys=True, separators=(',', ':')).encode())
+    return h.hexdigest()
+
+
+class RenderCache:
+    '''
+    Maps each query_tso rendered in out_dir to the render key and the output files it was rendered with.
+    '''
+
+    def __init__(self, out_dir):
+        self._out_dir = out_dir
+        self._filename = os.path.join(out_dir, CACHE_FILENAME)
+        self._entries = {}
+        if os.path.exists(self._filename):
+            try:
+                with open(self._filename, 'rt') as fd:
+                    self._entries = json.load(fd)
+            except Exception as e:
+                logging.warning('ignore broken render cache {}: {}'.format(self._filename, e))
+
+    def is_fresh(self, query_tso, key):
+        entry = self._entries.get(str(query_tso))
+        if entry is None or entry['key'] != key:
+            return False
+        return all(os.path.exists(os.path.join(self._out_dir, f)) for f in entry['files'])
+
+    def put(self, query_tso, key, files):
+        '''
+        Record the outputs of a query just rendered, deleting those of its previous entry that it did not overwrite,
+        e.g. in another format.
+        '''
+        entry = self._entries.get(str(query_tso))
+        if entry is not None:
+            self._remove_files(f for f in entry['files'] if f not in files)
+        self._entries[str(query_tso)] = {'key': key, 'files': files}
+
+    def remove(self, query_tso):
+        '''
+        Forget a query and delete its outputs.
+        '''
+        entry = self._entries.pop(str(query_tso), None)
+        if entry is not None:
+            self._remove_files(entry['files'])
+
+    def _remove_files(self, files):
+        for f in files:
+            path = os.path.join(self._out_dir, f)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def gc(self, live_query_tsos):
+        '''
+        Delete the outputs of queries that are no longer in the dataset, returns the number of queries removed.
+        '''
+        live = set(str(tso) for tso in live_query_tsos)
+        stale = [tso for tso in self._entries if tso not in live]
+        for tso in stale:
+            self.remove(tso)
+        return len(stale)
+
+    def save(self):
+        with open(self._filename + '.tmp', 'wt') as fd:
+            json.dump(self._entries, fd)
+        os.replace(self._filename + '.tmp', self._filename)
@@ -0,0 +1,334 @@
+import csv
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+import utils
+
+# numeric columns of the task table, all float64 with nan for missing values
+METRICS = [
+    'duration_ms',
+    'compile_ms',
+    'wait_index_ms',
+    'local_input_throughput',
+    'remote_input_throughput',
+    'output_throughput',
+    'memory_peak',
+]
+GROUP_KEYS = ['host', 'status', 'executor_type']
+STATS = ['count', 'mean', 'p50', 'p90', 'p99', 'max']
+PERCENTILES = {'p50': 0.5, 'p90': 0.9, 'p99': 0.99}
+# bump this when the layout of the cached columns changes
+COLUMNS_VERSION = 2
+
+
+def _span_ms(record, start_key, end_key):
+    # timestamps are in microseconds, and missing ones are logged as 0
+    start = record.get(start_key)
+    end = record.get(end_key)
+    if not start or not end:
+        return np.nan
+    return (end - start) / 1000
+
+
+class TaskColumns:
+    '''
+    Task records as numpy column arrays, with only the final state of each task.
+    String columns are dictionary encoded: host_codes indexes into hosts, and so on.
+    A task may contain several executors of several types, so executor types are kept in a separate exploded table
+    of (executor_task, executor_type_codes), executor_task indexing into the task columns.
+    '''
+
+    def __init__(self, query_tso, task_id, terminal, host_codes, hosts, status_codes, statuses, metrics,
+                 executor_task, executor_type_codes, executor_types):
+        self.query_tso = query_tso
+        self.task_id = task_id
+        self.terminal = terminal
+        self.host_codes = host_codes
+        self.hosts = hosts
+        self.status_codes = status_codes
+        self.statuses = statuses
+        self.metrics = metrics
+        self.executor_task = executor_task
+        self.executor_type_codes = executor_type_codes
+        self.executor_types = executor_types
+
+    def __len__(self):
+        return len(self.query_tso)
+
+    @staticmethod
+    def from_records(records):
+        query_tso = []
+        task_id = []
+        terminal = []
+        hosts = {}
+        host_codes = []
+        statuses = {}
+        status_codes = []
+        metrics = {m: [] for m in METRICS}
+        executor_types = {}
+        executor_task = []
+        executor_type_codes = []
+        for i, r in enumerate(records):
+            query_tso.append(r['query_tso'])
+            task_id.append(r['task_id'])
+            status = r.get('status', '')
+            terminal.append(status != 'INITIALIZING')
+            host_codes.append(hosts.setdefault(r.get('host', ''), len(hosts)))
+            status_codes.append(statuses.setdefault(status, len(statuses)))
+            metrics['duration_ms'].append(_span_ms(r, 'task_start_timestamp', 'task_end_timestamp'))
+            metrics['compile_ms'].append(_span_ms(r, 'compile_start_timestamp', 'compile_end_timestamp'))
+            metrics['wait_index_ms'].append(_span_ms(r, 'wait_index_start_timestamp', 'wait_index_end_timestamp'))
+            for m in METRICS[3:]:
+                v = r.get(m)
+                metrics[m].append(np.nan if v is None else v)
+            # count each type once per task
+            for t in set(e.get('type', '') for e in r.get('executors') or []):
+                executor_task.append(i)
+                executor_type_codes.append(executor_types.setdefault(t, len(executor_types)))
+        return TaskColumns(
+            np.array(query_tso, dtype=np.int64), np.array(task_id, dtype=np.int64), np.array(terminal, dtype=bool),
+            np.array(host_codes, dtype=np.int32), _vocabulary(hosts),
+            np.array(status_codes, dtype=np.int32), _vocabulary(statuses),
+            {m: np.array(v, dtype=np.float64) for m, v in metrics.items()},
+            np.array(executor_task, dtype=np.int64), np.array(executor_type_codes, dtype=np.int32),
+            _vocabulary(executor_types))
+
+    def save(self, filename):
+        arrays = {'version': np.array(COLUMNS_VERSION), 'query_tso': self.query_tso, 'task_id': self.task_id,
+                  'terminal': self.terminal, 'host_codes': self.host_codes, 'hosts': self.hosts,
+                  'status_codes': self.status_codes, 'statuses': self.statuses, 'executor_task': self.executor_task,
+                  'executor_type_codes': self.executor_type_codes, 'executor_types': self.executor_types}
+        for m, v in self.metrics.items():
+            arrays['metric_' + m] = v
+        # np.savez appends .npz to names without it
+        with open(filename + '.tmp', 'wb') as fd:
+            np.savez(fd, **arrays)
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def load(filename):
+        with np.load(filename) as data:
+            if int(data['version']) != COLUMNS_VERSION:
+                return None
+            return TaskColumns(
+                data['query_tso'], data['task_id'], data['terminal'], data['host_codes'], data['hosts'],
+                data['status_codes'], data['statuses'], {m: data['metric_' + m] for m in METRICS},
+                data['executor_task'], data['executor_type_codes'], data['executor_types'])
+
+    def take(self, index):
+        '''
+        A subset of the tasks, index being an integer array in ascending order.
+        '''
+        remap = np.full(len(self), -1, dtype=np.int64)
+        remap[index] = np.arange(len(index))
+        executor_mask = remap[self.executor_task] >= 0
+        return TaskColumns(
+            self.query_tso[index], self.task_id[index], self.terminal[index], self.host_codes[index], self.hosts,
+            self.status_codes[index], self.statuses, {m: v[index] for m, v in self.metrics.items()},
+            remap[self.executor_task[executor_mask]], self.executor_type_codes[executor_mask], self.executor_types)
+
+    def final_states(self):
+        '''
+        Keep one record per (query_tso, task_id), the terminal one if any.
+        '''
+        if len(self) == 0:
+            return self
+        order = np.lexsort((self.terminal, self.task_id, self.query_tso))
+        tso = self.query_tso[order]
+        tid = self.task_id[order]
+        # the last of each run of equal keys, which is terminal if the task has a terminal record
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (tso[1:] != tso[:-1]) | (tid[1:] != tid[:-1])
+        return self.take(np.sort(order[last]))
+
+
+def _vocabulary(codes):
+    vocab = np.empty(len(codes), dtype=object)
+    for value, code in codes.items():
+        vocab[code] = value
+    return vocab.astype(str) if len(vocab) else np.array([], dtype=str)
+
+
+def _recode(codes, vocab, global_vocab):
+    if len(vocab) == 0:
+        return codes
+    return np.searchsorted(global_vocab, vocab)[codes].astype(np.int32)
+
+
+def concat(columns_list):
+    '''
+    Concatenate the columns of several sources, re-encoding their string columns with a shared vocabulary.
+    '''
+    columns_list = [c for c in columns_list if len(c) > 0]
+    if len(columns_list) == 1:
+        return columns_list[0]
+    if not columns_list:
+        return TaskColumns.from_records([])
+    hosts = np.unique(np.concatenate([c.hosts for c in columns_list]))
+    statuses = np.unique(np.concatenate([c.statuses for c in columns_list]))
+    executor_types = np.unique(np.concatenate([c.executor_types for c in columns_list]))
+    offsets = np.cumsum([0] + [len(c) for c in columns_list[:-1]])
+    return TaskColumns(
+        np.concatenate([c.query_tso for c in columns_list]),
+        np.concatenate([c.task_id for c in columns_list]),
+        np.concatenate([c.terminal for c in columns_list]),
+        np.concatenate([_recode(c.host_codes, c.hosts, hosts) for c in columns_list]), hosts,
+        np.concatenate([_recode(c.status_codes, c.statuses, statuses) for c in columns_list]), statuses,
+        {m: np.concatenate([c.metrics[m] for c in columns_list]) for m in METRICS},
+        np.concatenate([c.executor_task + offset for c, offset in zip(columns_list, offsets)]),
+        np.concatenate([_recode(c.executor_type_codes, c.executor_types, executor_types) for c in columns_list]),
+        executor_types)
+
+
+def load_columns(json_path, use_cache=True, input_format='json'):
+    '''
+    Load the task columns of a task dag json file, or of a tracing csv if input_format is csv, with only the final
+    state of each task.
+    Parsing json is by far the slowest part, so the columns are cached in a .columns.npz next to the file, and
+    rebuilt when the file changes.
+    '''
+    cache_path = json_path + '.columns.npz'
+    stat = os.stat(json_path)
+    if use_cache and os.path.exists(cache_path) and os.stat(cache_path).st_mtime >= stat.st_mtime:
+        columns = TaskColumns.load(cache_path)
+        if columns is not None:
+            logging.info('loaded {} task records from {}'.format(len(columns), cache_path))
+            return columns
+    logging.info('building task columns from {}'.format(json_path))
+    # all the records of a task are in the same file, so it is reduced here, before being cached
+    if input_format == 'csv':
+        import visualize_task_csv
+        columns = visualize_task_csv.task_columns(visualize_task_csv.read_csv(json_path))
+    else:
+        columns = TaskColumns.from_records(utils.read_records(json_path)).final_states()
+    if use_cache:
+        columns.save(cache_path)
+    logging.info('loaded {} task records from {}'.format(len(columns), json_path))
+    return columns
+
+
+def _group_order(codes, group_count):
+    '''
+    Returns (order, starts, counts): order sorts rows by group, rows of group g being order[starts[g]:starts[g] + counts[g]].
+    '''
+    # a stable sort of small integers is a radix sort in numpy
+    dtype = np.int16 if group_count < (1 << 15) else np.int64
+    order = np.argsort(codes.astype(dtype), kind='stable')
+    counts = np.bincount(codes, minlength=group_count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+    return order, starts, counts
+
+
+def grouped_stats(codes, values, group_count, group_order=None):
+    '''
+    STATS of values per group, codes being the group of each value in [0, group_count), nan values being ignored.
+    Values are laid out by group once, then each group is sorted on its own, and percentiles are read at computed
+    offsets with linear interpolation. Returns {stat: array of group_count}, nan for groups without values.
+    '''
+    order, starts, counts = group_order if group_order is not None else _group_order(codes, group_count)
+    grouped = values[order]
+    for g in np.flatnonzero(counts):
+        # nan is sorted last, after the valid values of the group
+        grouped[starts[g]:starts[g] + counts[g]].sort()
+    valid = ~np.isnan(values)
+    valid_counts = np.bincount(codes[valid], minlength=group_count)
+    nonempty = valid_counts > 0
+    ret = {'count': valid_counts.astype(np.float64)}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ret['mean'] = np.bincount(codes[valid], weights=values[valid], minlength=group_count) / valid_counts
+    if len(grouped) == 0:
+        for s in STATS[2:]:
+            ret[s] = np.full(group_count, np.nan)
+        return ret
+    last = np.maximum(starts + valid_counts - 1, 0)
+    for name, q in PERCENTILES.items():
+        pos = starts + q * np.maximum(valid_counts - 1, 0)
+        lo = np.minimum(np.floor(pos).astype(np.int64), last)
+        hi = np.minimum(lo + 1, last)
+        frac = pos - np.floor(pos)
+        ret[name] = np.where(nonempty, grouped[lo] * (1 - frac) + grouped[hi] * frac, np.nan)
+    ret['max'] = np.where(nonempty, grouped[last], np.nan)
+    return ret
+
+
+def compute(columns, group_by, metrics=METRICS):
+    '''
+    Grouped aggregates of the task columns, returns a list of rows, one per (group, metric), as dicts.
+    Grouping by executor_type counts a task once for every type of executor it has.
+    '''
+    for key in group_by:
+        if key not in GROUP_KEYS:
+            raise ValueError('unsupported group key {}, should be one of {}'.format(key, GROUP_KEYS))
+    if 'executor_type' in group_by:
+        rows = columns.executor_task
+    else:
+        rows = np.arange(len(columns))
+    # combine the codes of all the keys into a single dense group code
+    group_codes = np.zeros(len(rows), dtype=np.int64)
+    vocabs = []
+    for key in group_by:
+        if key == 'host':
+            codes, vocab = columns.host_codes[rows], columns.hosts
+        elif key == 'status':
+            codes, vocab = columns.status_codes[rows], columns.statuses
+        else:
+            codes, vocab = columns.executor_type_codes, columns.executor_types
+        group_codes = group_codes * len(vocab) + codes
+        vocabs.append(vocab)
+    group_count = int(np.prod([len(v) for v in vocabs])) if vocabs else 1
+    group_order = _group_order(group_codes, group_count)
+    groups = np.flatnonzero(group_order[2])
+
+    ret = []
+    for metric in metrics:
+        stats = grouped_stats(group_codes, columns.metrics[metric][rows], group_count, group_order)
+        for g in groups:
+            row = {}
+            code = g
+            for key, vocab in reversed(list(zip(group_by, vocabs))):
+                row[key] = str(vocab[code % len(vocab)])
+                code //= len(vocab)
+            row = {key: row[key] for key in group_by}
+            row['metric'] = metric
+            for s in STATS:
+                v = stats[s][g]
+                row[s] = None if np.isnan(v) else (int(v) if s == 'count' else float(v))
+            ret.append(row)
+    return ret
+
+
+def write_rows(rows, group_by, out, format):
+    fields = list(group_by) + ['metric'] + STATS
+    if format == 'json':
+        json.dump(rows, out, indent=1)
+        out.write('\n')
+    elif format == 'csv':
+        writer = csv.DictWriter(out, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        widths = [max([len(f)] + [len(str(r[f])) for r in rows]) for f in fields[:len(group_by) + 1]]
+        header = ' '.join('{:<{}}'.format(f, w) for f, w in zip(fields, widths)) + ''.join(' {:>14}'.format(s) for s in STATS)
+        out.write(header + '\n')
+        for r in rows:
+            line = ' '.join('{:<{}}'.format(r[f], w) for f, w in zip(fields, widths))
+            for s in STATS:
+                v = r[s]
+                line += ' {:>14}'.format('-' if v is None else (v if s == 'count' else '{:.3f}'.format(v)))
+            out.write(line + '\n')
+
+
+def run(json_paths, group_by, format, out_path=None, use_cache=True, input_format='json'):
+    columns = concat([load_columns(p, use_cache, input_format) for p in json_paths])
+    logging.info('computing stats of {} tasks grouped by {}'.format(len(columns), group_by))
+    rows = compute(columns, group_by)
+    if out_path is None:
+        write_rows(rows, group_by, sys.stdout, format)
+        return
+    with open(out_path, 'wt', newline='') as fd:
+        write_rows(rows, group_by, fd, format)
+    logging.info('write {} rows to {}'.format(len(rows), out_path))
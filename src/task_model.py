@@ -0,0 +1,222 @@
+import sys
+from typing import Tuple
+
+import task_reducer
+import utils
+
+# fields of a task record in the order tiflash logs them, which is also the order of labels
+TASK_FIELDS = (
+    'query_tso',
+    'task_id',
+    'sender_executor_id',
+    'executors',
+    'host',
+    'task_init_timestamp',
+    'compile_start_timestamp',
+    'wait_index_start_timestamp',
+    'wait_index_end_timestamp',
+    'compile_end_timestamp',
+    'task_start_timestamp',
+    'task_end_timestamp',
+    'status',
+    'error_message',
+    'local_input_throughput',
+    'remote_input_throughput',
+    'output_throughput',
+    'cpu_usage',
+    'memory_peak',
+)
+EXECUTOR_FIELDS = ('id', 'type', 'children', 'sender_target_task_ids', 'receiver_source_task_ids')
+# string values repeated across many records, which are shared instead of stored once per record
+_INTERNED_TASK_FIELDS = ('host', 'status', 'error_message')
+_EMPTY = ()
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _ids(value):
+    return tuple(value) if value else _EMPTY
+
+
+# key tuples of the records seen so far, records with the same keys share one tuple
+_shapes = {}
+
+
+def _shape(record):
+    keys = tuple(record)
+    return _shapes.setdefault(keys, keys)
+
+
+def _extra(record, fields):
+    '''
+    Values of the fields of a record unknown to the model, in the order of its keys.
+    '''
+    ret = tuple(v for k, v in record.items() if k not in fields)
+    return ret if ret else _EMPTY
+
+
+class _Record:
+    '''
+    Read-only dict-like access to the fields of a slotted record, so code written against json dicts keeps working.
+    shape is the tuple of keys of the original record, shared by all the records with the same keys, and extra holds
+    the values of the keys unknown to the model.
+    '''
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            value = getattr(self, key)
+            if value is not None or key in self.shape:
+                return value
+            raise KeyError(key)
+        i = 0
+        for k in self.shape:
+            if k in self._field_set:
+                continue
+            if k == key:
+                return self.extra[i]
+            i += 1
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return key in self.shape
+
+    def items(self):
+        '''
+        (key, value) of the fields of the original record, in its order.
+        '''
+        extra = iter(self.extra)
+        for k in self.shape:
+            yield k, getattr(self, k) if k in self._field_set else next(extra)
+
+
+class Executor(_Record):
+    __slots__ = EXECUTOR_FIELDS + ('shape', 'extra')
+    _fields = EXECUTOR_FIELDS
+    _field_set = frozenset(EXECUTOR_FIELDS)
+
+    @classmethod
+    def from_dict(cls, d):
+        e = cls()
+        e.id = d.get('id')
+        e.type = _intern(d.get('type'))
+        e.children = _ids(d.get('children'))
+        e.sender_target_task_ids = _ids(d['sender_target_task_ids']) if 'sender_target_task_ids' in d else None
+        e.receiver_source_task_ids = _ids(d['receiver_source_task_ids']) if 'receiver_source_task_ids' in d else None
+        e.shape = _shape(d)
+        e.extra = _extra(d, EXECUTOR_FIELDS)
+        return e
+
+    def to_dict(self):
+        return {k: list(v) if type(v) is tuple else v for k, v in self.items()}
+
+    def __reduce__(self):
+        # far smaller pickles than the default of slotted classes, which is a dict of all slots
+        return _executor, tuple(getattr(self, k) for k in self.__slots__)
+
+
+def _executor(*values):
+    e = Executor.__new__(Executor)
+    for k, v in zip(Executor.__slots__, values):
+        setattr(e, k, v)
+    return e
+
+
+class Task(_Record):
+    '''
+    A task record with its executors, in slots instead of a dict per record.
+    Strings repeated across records, i.e. hosts, statuses and executor types, are interned, field names are shared
+    by the records of the same shape, and lists of ids are tuples, so millions of executors take several times less
+    memory than the json dicts they are built from.
+    '''
+    __slots__ = TASK_FIELDS + ('shape', 'extra')
+    _fields = TASK_FIELDS
+    _field_set = frozenset(TASK_FIELDS)
+
+    @classmethod
+    def from_dict(cls, d):
+        t = cls()
+        for k in TASK_FIELDS:
+            setattr(t, k, d.get(k))
+        for k in _INTERNED_TASK_FIELDS:
+            setattr(t, k, _intern(getattr(t, k)))
+        t.executors = tuple(Executor.from_dict(e) for e in d.get('executors') or _EMPTY)
+        t.shape = _shape(d)
+        t.extra = _extra(d, TASK_FIELDS)
+        return t
+
+    def to_dict(self):
+        ret = dict(self.items())
+        ret['executors'] = [e.to_dict() for e in self.executors]
+        return ret
+
+    def __reduce__(self):
+        return _task, tuple(getattr(self, k) for k in self.__slots__)
+
+    @property
+    def failed(self):
+        return self.status != 'FINISHED' or self.error_message != ''
+
+    def executor_map(self):
+        return {e.id: e for e in self.executors}
+
+    def executors_from_root(self):
+        '''
+        Executors in depth first order from the sender executor, i.e. their position in the plan of the task.
+        '''
+        executors = self.executor_map()
+        ret = []
+        stack = [self.sender_executor_id]
+        while stack:
+            e = executors.get(stack.pop())
+            if e is None:
+                continue
+            ret.append(e)
+            stack.extend(reversed(e.children))
+        return ret
+
+    def upstream_task_ids(self) -> Tuple[int]:
+        ret = []
+        for e in self.executors:
+            if e.receiver_source_task_ids:
+                ret.extend(e.receiver_source_task_ids)
+        return tuple(ret)
+
+
+def _task(*values):
+    t = Task.__new__(Task)
+    for k, v in zip(Task.__slots__, values):
+        setattr(t, k, v)
+    return t
+
+
+def as_dict(record):
+    '''
+    The json record of a task, for writing it out.
+    '''
+    return record.to_dict() if isinstance(record, Task) else record
+
+
+def to_tasks(records):
+    '''
+    Tasks of json records, built one at a time so that only one record is ever held as a dict.
+    '''
+    for record in records:
+        yield record if isinstance(record, Task) else Task.from_dict(record)
+
+
+def read_tasks(filename):
+    '''
+    Yields the final state of each task of an ndjson or json file, see utils.read_records. Files may come from older
+    versions or --json_file and hold several records per task, so they are reduced as they are read.
+    '''
+    return to_tasks(task_reducer.final_records(utils.read_records(filename)))
@@ -0,0 +1,98 @@
+import logging
+from collections import defaultdict
+
+INITIALIZING = 'INITIALIZING'
+
+
+class TaskReducer:
+    '''
+    Reduce the records of each task to its final state while they stream by: a task logs an INITIALIZING record when
+    it is dispatched and a FINISHED or CANCELLED one when it ends.
+    Only the INITIALIZING records of tasks in flight are held, a terminal record is emitted as soon as it is seen, and
+    tasks that never end are emitted by flush(). Records may come in any order and from any number of files, as long
+    as the same reducer sees all of them.
+    The ids of the tasks ended are only kept while their query has tasks in flight, so memory is bounded by the
+    queries running at the same time. A record of a task coming after all the tasks of its query have ended is
+    emitted again, and readers keep the terminal state, see final_records.
+    '''
+
+    def __init__(self):
+        self._in_flight = {}  # query_tso -> {task_id: (tag, INITIALIZING record)}
+        self._done = {}  # query_tso -> ids of the tasks whose terminal record is emitted, while it has tasks in flight
+        self.records = 0
+        self.emitted = 0
+
+    def add(self, query_tso, task_id, status, record, tag=None):
+        '''
+        Returns record if it is the final state of its task, or None if it is held or dropped.
+        tag is returned along with the record by flush() if it is held, e.g. the file it comes from.
+        '''
+        self.records += 1
+        if task_id in self._done.get(query_tso, ()):
+            if status != INITIALIZING:
+                logging.error('task has more than 1 terminal record, keep the first one, tso [{}], task_id [{}]'.format(
+                    query_tso, task_id))
+            # else the INITIALIZING record comes after the terminal one, which is already emitted
+            return None
+        in_flight = self._in_flight.get(query_tso)
+        if status == INITIALIZING:
+            if in_flight is None:
+                in_flight = self._in_flight[query_tso] = {}
+            elif task_id in in_flight:
+                logging.error('task has more than 1 INITIALIZING record, keep the first one, tso [{}], task_id [{}]'.format(
+                    query_tso, task_id))
+                return None
+            in_flight[task_id] = (tag, record)
+            return None
+        if in_flight is not None:
+            in_flight.pop(task_id, None)
+            if in_flight:
+                self._done.setdefault(query_tso, set()).add(task_id)
+            else:
+                # the last task of the query in flight has ended
+                del self._in_flight[query_tso]
+                self._done.pop(query_tso, None)
+        self.emitted += 1
+        return record
+
+    def reduce(self, records, tag=None):
+        '''
+        Yields the final states among records, which are (query_tso, task_id, status, record) tuples.
+        '''
+        for query_tso, task_id, status, record in records:
+            record = self.add(query_tso, task_id, status, record, tag)
+            if record is not None:
+                yield record
+
+    def flush(self):
+        '''
+        Returns {tag: [records]} of the tasks seen INITIALIZING but never ended, which are emitted as they are.
+        '''
+        ret = defaultdict(list)
+        for in_flight in self._in_flight.values():
+            for tag, record in in_flight.values():
+                ret[tag].append(record)
+                self.emitted += 1
+        self._in_flight.clear()
+        self._done.clear()
+        return ret
+
+
+def final_records(records):
+    '''
+    Yields the final state of each task among json records, e.g. of a dump of older versions, which has both the
+    INITIALIZING and the terminal record of each task. Records already reduced are yielded as they are.
+    The readers of the records hold all the tasks anyway, so the ids of the tasks yielded are kept to yield each task
+    once, also when TaskReducer emits it again.
+    '''
+    reducer = TaskReducer()
+    seen = set()
+    for record in reducer.reduce((r.get('query_tso'), r.get('task_id'), r.get('status'), r) for r in records):
+        key = (record.get('query_tso'), record.get('task_id'))
+        if key not in seen:
+            seen.add(key)
+            yield record
+    for held in reducer.flush().values():
+        for record in held:
+            if (record.get('query_tso'), record.get('task_id')) not in seen:
+                yield record
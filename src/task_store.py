@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import sqlite3
+
+import profiler
+
+TIMESTAMP_COLUMNS = [
+    'task_init_timestamp',
+    'compile_start_timestamp',
+    'compile_end_timestamp',
+    'wait_index_start_timestamp',
+    'wait_index_end_timestamp',
+    'task_start_timestamp',
+    'task_end_timestamp',
+]
+METRIC_COLUMNS = [
+    'local_input_throughput',
+    'remote_input_throughput',
+    'output_throughput',
+    'cpu_usage',
+    'memory_peak',
+]
+TASK_COLUMNS = ['query_tso', 'task_id', 'host', 'status', 'error_message', 'sender_executor_id'] + \
+    TIMESTAMP_COLUMNS + METRIC_COLUMNS + ['duration', 'record']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    query_tso INTEGER NOT NULL,
+    task_id INTEGER NOT NULL,
+    host TEXT,
+    status TEXT,
+    error_message TEXT,
+    sender_executor_id INTEGER,
+    task_init_timestamp INTEGER,
+    compile_start_timestamp INTEGER,
+    compile_end_timestamp INTEGER,
+    wait_index_start_timestamp INTEGER,
+    wait_index_end_timestamp INTEGER,
+    task_start_timestamp INTEGER,
+    task_end_timestamp INTEGER,
+    local_input_throughput REAL,
+    remote_input_throughput REAL,
+    output_throughput REAL,
+    cpu_usage REAL,
+    memory_peak INTEGER,
+    -- task_end_timestamp - task_start_timestamp, in microseconds
+    duration INTEGER,
+    -- the task record without executors
+    record TEXT NOT NULL,
+    PRIMARY KEY (query_tso, task_id)
+);
+CREATE TABLE IF NOT EXISTS executors (
+    query_tso INTEGER NOT NULL,
+    task_id INTEGER NOT NULL,
+    -- position in the executors list of the task record
+    position INTEGER NOT NULL,
+    executor_id INTEGER,
+    type TEXT,
+    record TEXT NOT NULL,
+    PRIMARY KEY (query_tso, task_id, position)
+);
+CREATE INDEX IF NOT EXISTS tasks_task_id ON tasks (task_id);
+CREATE INDEX IF NOT EXISTS tasks_host ON tasks (host);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status);
+CREATE INDEX IF NOT EXISTS tasks_duration ON tasks (duration);
+CREATE INDEX IF NOT EXISTS tasks_task_init_timestamp ON tasks (task_init_timestamp);
+CREATE INDEX IF NOT EXISTS tasks_task_start_timestamp ON tasks (task_start_timestamp);
+CREATE INDEX IF NOT EXISTS tasks_task_end_timestamp ON tasks (task_end_timestamp);
+CREATE INDEX IF NOT EXISTS executors_type ON executors (type);
+'''
+
+# a task is logged twice, when it is initialized and when it finishes, the terminal record always wins
+UPSERT_TASK = '''
+INSERT INTO tasks ({columns}) VALUES ({placeholders})
+ON CONFLICT (query_tso, task_id) DO UPDATE SET {updates}
+WHERE excluded.status != 'INITIALIZING'
+'''.format(columns=', '.join(TASK_COLUMNS),
+           placeholders=', '.join('?' * len(TASK_COLUMNS)),
+           updates=', '.join('{0} = excluded.{0}'.format(c) for c in TASK_COLUMNS[2:]))
+
+
+class TaskFilter:
+    '''
+    Conditions of a task lookup, None means no condition.
+    status_op is '=' or '!='; min_duration is in microseconds; since and until are microsecond timestamps bounding
+    task_start_timestamp.
+    '''
+
+    def __init__(self, query_tso=None, task_id=None, host=None, status=None, status_op='=',
+                 min_duration=None, since=None, until=None, executor_type=None):
+        self.query_tso = query_tso
+        self.task_id = task_id
+        self.host = host
+        self.status = status
+        self.status_op = status_op
+        self.min_duration = min_duration
+        self.since = since
+        self.until = until
+        self.executor_type = executor_type
+
+    def to_sql(self):
+        conditions = []
+        params = []
+        for column, value in (('query_tso', self.query_tso), ('task_id', self.task_id), ('host', self.host)):
+            if value is not None:
+                conditions.append('{} = ?'.format(column))
+                params.append(value)
+        if self.status is not None:
+            if self.status_op not in ('=', '!='):
+                raise ValueError('unsupported status operator {}'.format(self.status_op))
+            conditions.append('status {} ?'.format(self.status_op))
+            params.append(self.status)
+        if self.min_duration is not None:
+            conditions.append('duration >= ?')
+            params.append(self.min_duration)
+        if self.since is not None:
+            conditions.append('task_start_timestamp >= ?')
+            params.append(self.since)
+        if self.until is not None:
+            conditions.append('task_start_timestamp <= ?')
+            params.append(self.until)
+        if self.executor_type is not None:
+            conditions.append('EXISTS (SELECT 1 FROM executors e WHERE e.query_tso = tasks.query_tso '
+                              'AND e.task_id = tasks.task_id AND e.type = ?)')
+            params.append(self.executor_type)
+        return ' AND '.join(conditions) if conditions else '1', params
+
+
+class TaskStore:
+    '''
+    Task records of a cluster in an indexed sqlite database, with only the final state of each task kept.
+    '''
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._conn = sqlite3.connect(filename)
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def load(self, records, batch_size=10000):
+        '''
+        Insert task records, returns the number of records read.
+        '''
+        count = 0
+        with self._conn:
+            for record in records:
+                self._upsert(record)
+                count += 1
+                if count % batch_size == 0:
+                    self._conn.commit()
+                    logging.debug('loaded {} records into {}'.format(count, self._filename))
+        return count
+
+    def _upsert(self, record):
+        task = {k: v for k, v in record.items() if k != 'executors'}
+        start = record.get('task_start_timestamp')
+        end = record.get('task_end_timestamp')
+        duration = end - start if start and end else None
+        row = [record.get(c) for c in TASK_COLUMNS[:-2]] + [duration, json.dumps(task, separators=(',', ':'))]
+        cursor = self._conn.execute(UPSERT_TASK, row)
+        if cursor.rowcount == 0:
+            return
+        key = (record['query_tso'], record['task_id'])
+        self._conn.execute('DELETE FROM executors WHERE query_tso = ? AND task_id = ?', key)
+        self._conn.executemany(
+            'INSERT INTO executors (query_tso, task_id, position, executor_id, type, record) VALUES (?, ?, ?, ?, ?, ?)',
+            [key + (i, e.get('id'), e.get('type'), json.dumps(e, separators=(',', ':')))
+             for i, e in enumerate(record.get('executors', []))])
+
+    def find(self, task_filter, limit=None, with_executors=True):
+        '''
+        Yields the task records matching task_filter, ordered by (query_tso, task_id).
+        '''
+        where, params = task_filter.to_sql()
+        sql = 'SELECT query_tso, task_id, record FROM tasks WHERE {} ORDER BY query_tso, task_id'.format(where)
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        for query_tso, task_id, record in self._conn.execute(sql, params):
+            task = json.loads(record)
+            if with_executors:
+                task['executors'] = [json.loads(r) for r, in self._conn.execute(
+                    'SELECT record FROM executors WHERE query_tso = ? AND task_id = ? ORDER BY position',
+                    (query_tso, task_id))]
+            yield task
+
+    def query_tsos(self):
+        return [tso for tso, in self._conn.execute('SELECT DISTINCT query_tso FROM tasks ORDER BY query_tso')]
+
+
+def build(filename, records):
+    '''
+    (Re)build the task store in filename from records.
+    '''
+    if os.path.exists(filename):
+        os.remove(filename)
+    update(filename, records)
+
+
+def update(filename, records):
+    '''
+    Load records into the task store in filename, the terminal record of a task replacing its INITIALIZING one.
+    '''
+    with profiler.stage('sqlite_load', file=filename) as span, TaskStore(filename) as store:
+        count = store.load(records)
+        span.add(records=count)
+    logging.info('loaded {} records into {}'.format(count, filename))
@@ -0,0 +1,113 @@
+import json
+import logging
+
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+# the trace is written event by event, so that no trace is ever held in memory as a whole, and can be opened in
+# ui.perfetto.dev or chrome://tracing
+
+
+class TraceEventWriter:
+    '''
+    Streams trace events into a json file of the Trace Event Format, timestamps are in microseconds.
+    '''
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._fd = None
+        self.count = 0
+
+    def __enter__(self):
+        self._fd = open(self._filename, 'wt')
+        self._fd.write('{"displayTimeUnit":"ms","traceEvents":[\n')
+        return self
+
+    def __exit__(self, *args):
+        self._fd.write('\n]}\n')
+        self._fd.close()
+        logging.debug('wrote {} trace events to {}'.format(self.count, self._filename))
+
+    def write(self, event):
+        if self.count > 0:
+            self._fd.write(',\n')
+        self._fd.write(json.dumps(event, separators=(',', ':')))
+        self.count += 1
+
+    def process_name(self, pid, name, sort_index=None):
+        self.write({'ph': 'M', 'pid': pid, 'name': 'process_name', 'args': {'name': name}})
+        if sort_index is not None:
+            self.write({'ph': 'M', 'pid': pid, 'name': 'process_sort_index', 'args': {'sort_index': sort_index}})
+
+    def thread_name(self, pid, tid, name, sort_index=None):
+        self.write({'ph': 'M', 'pid': pid, 'tid': tid, 'name': 'thread_name', 'args': {'name': name}})
+        if sort_index is not None:
+            self.write({'ph': 'M', 'pid': pid, 'tid': tid, 'name': 'thread_sort_index', 'args': {'sort_index': sort_index}})
+
+    def complete(self, pid, tid, name, start, end, args=None, category='task'):
+        '''
+        A duration event, skipped if start or end is missing, which is logged as 0 by tiflash.
+        '''
+        if not start or not end or end < start:
+            return
+        event = {'ph': 'X', 'pid': pid, 'tid': tid, 'name': name, 'cat': category, 'ts': start, 'dur': end - start}
+        if args:
+            event['args'] = args
+        self.write(event)
+
+    def counter(self, pid, name, ts, values):
+        self.write({'ph': 'C', 'pid': pid, 'name': name, 'ts': ts, 'args': values})
+
+
+def _task_args(task):
+    return {k: v for k, v in task.items() if k not in ('executors', 'input_streams') and not k.endswith('_timestamp')}
+
+
+def _write_task(writer, pid, task):
+    '''
+    The life of a task as nested duration events on its own thread: the whole task, compiling (including waiting on
+    index) and executing.
+    '''
+    task_id = task['task_id']
+    init = task.get('task_init_timestamp')
+    end = task.get('task_end_timestamp')
+    compile_end = task.get('compile_end_timestamp')
+    writer.complete(pid, task_id, 'task {}'.format(task_id), init, end, _task_args(task))
+    writer.complete(pid, task_id, 'compile', task.get('compile_start_timestamp'), compile_end)
+    writer.complete(pid, task_id, 'wait_index', task.get('wait_index_start_timestamp'),
+                    task.get('wait_index_end_timestamp'))
+    writer.complete(pid, task_id, 'execute', compile_end or task.get('task_start_timestamp'), end)
+    _write_input_streams(writer, pid, task)
+
+
+def _write_input_streams(writer, pid, task):
+    '''
+    Counter tracks of the push/pull/self samples of the input streams of a task, if any.
+    Samples carry no timestamp, so they are spread evenly over the execution of the task.
+    '''
+    start = task.get('compile_end_timestamp') or task.get('task_start_timestamp') or task.get('task_init_timestamp')
+    end = task.get('task_end_timestamp')
+    for stream in task.get('input_streams') or []:
+        timeline = (stream.get('stat') or {}).get('timeline') or {}
+        samples = list(zip(timeline.get('push', []), timeline.get('pull', []), timeline.get('self', [])))
+        if not samples or not start or not end:
+            continue
+        name = 'task {} [{}] {}({})'.format(task['task_id'], stream['id'], stream.get('name', ''), stream.get('executor', ''))
+        step = (end - start) / len(samples)
+        for i, (push, pull, self_) in enumerate(samples):
+            writer.counter(pid, name, start + int(i * step), {'push': push, 'pull': pull, 'self': self_})
+
+
+def write_tasks_trace(tasks, filename):
+    '''
+    Trace of the tasks of a query, each tiflash host being a process and each task a thread.
+    Returns the number of events written.
+    '''
+    hosts = sorted(set(t.get('host', '') for t in tasks))
+    pids = {host: i + 1 for i, host in enumerate(hosts)}
+    with TraceEventWriter(filename) as writer:
+        for host, pid in pids.items():
+            writer.process_name(pid, host or 'unknown host', pid)
+        for task in sorted(tasks, key=lambda t: t['task_id']):
+            pid = pids[task.get('host', '')]
+            writer.thread_name(pid, task['task_id'], 'task {}'.format(task['task_id']), task['task_id'])
+            _write_task(writer, pid, task)
+    return writer.count
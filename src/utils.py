@@ -1,19 +1,111 @@
+import bz2
+import gzip
+import io
 import json
+import lzma
 import os
+from datetime import datetime
+
+# extensions of the compressed files that are read and written transparently, by compression name
+COMPRESSIONS = {'gz': '.gz', 'xz': '.xz', 'bz2': '.bz2', 'zst': '.zst'}
+# the default level 9 is about twice as slow, and barely smaller on logs
+GZIP_LEVEL = 6
+
+
+def compression_ext(filename):
+    '''
+    The compression extension of filename, e.g. '.gz', or '' if it is not compressed.
+    '''
+    ext = os.path.splitext(filename)[1]
+    return ext if ext in COMPRESSIONS.values() else ''
+
+
+def strip_compression(filename):
+    ext = compression_ext(filename)
+    return filename[:-len(ext)] if ext else filename
+
+
+def open_file(filename, mode='rt', fileobj=None):
+    '''
+    open() that compresses or decompresses on the fly according to the extension of filename, in both text and binary
+    modes. Appending adds a new compressed stream at the end of the file, which is read back as if the data were
+    compressed at once, so compressed files of the same kind can also be concatenated byte by byte.
+    If fileobj is given, it is read instead of opening filename, e.g. from the offset where an appended stream starts.
+    '''
+    ext = compression_ext(filename)
+    target = filename if fileobj is None else fileobj
+    if ext == '.gz':
+        return gzip.open(target, mode, compresslevel=GZIP_LEVEL)
+    if ext == '.xz':
+        return lzma.open(target, mode)
+    if ext == '.bz2':
+        return bz2.open(target, mode)
+    if ext == '.zst':
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError('{} needs zstandard, install it with `pip3 install flashprof[zstd]`'.format(filename)) from e
+        if 'r' in mode:
+            # appended files have several frames
+            fd = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb') if fileobj is None else fileobj,
+                                                            read_across_frames=True, closefd=fileobj is None)
+            return fd if 'b' in mode else io.TextIOWrapper(fd, encoding='utf-8')
+        return zstandard.open(filename, mode)
+    if fileobj is None:
+        return open(filename, mode)
+    return fileobj if 'b' in mode else io.TextIOWrapper(fileobj, encoding='utf-8')
 
 
 def read_file(filename):
-    with open(filename, 'rt') as fd:
+    with open_file(filename, 'rt') as fd:
         return fd.read()
 
 
 def read_json(filename):
-    with open(filename, 'rt') as fd:
+    with open_file(filename, 'rt') as fd:
         data = json.load(fd)
     return data
 
 
+def read_records(filename, offset=0):
+    '''
+    Iterate over the records of an ndjson file one line at a time, or of a json array file, either being possibly
+    compressed.
+    An ndjson file can be read from offset on, e.g. its size before records were appended to it.
+    '''
+    if strip_compression(filename).endswith('.ndjson'):
+        with open(filename, 'rb') as raw:
+            raw.seek(offset)
+            with open_file(filename, 'rt', raw) as fd:
+                for line in fd:
+                    if line.strip():
+                        yield json.loads(line)
+    else:
+        yield from read_json(filename)
+
+
 def ensure_dir_exist(dir_name):
-    if os.path.exists(dir_name):
-        return
-    os.makedirs(dir_name)
+    # concurrent callers may create it at the same time, e.g. render workers
+    os.makedirs(dir_name, exist_ok=True)
+
+
+def parse_datetime(value):
+    '''
+    Parse "YYYY-MM-DD HH:MM[:SS[.ffffff]]" (or with "/" as the date separator) as a naive local datetime.
+    '''
+    value = value.strip().replace('/', '-').replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError('invalid time {}, expect "YYYY-MM-DD HH:MM:SS"'.format(value))
+
+
+def parse_timestamp(value):
+    '''
+    Parse a microsecond timestamp, the unit of task record timestamps, or a local time accepted by parse_datetime.
+    '''
+    if value.isdigit():
+        return int(value)
+    return int(parse_datetime(value).timestamp() * 1000000)
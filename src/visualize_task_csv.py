@@ -1,11 +1,64 @@
-import json
-from collections import defaultdict
-from typing import Any, Dict
+from typing import Any, Dict, Iterator
 
 import graphviz
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 
 OUTPUT_DIR = 'output'
+# rows of each chunk read from a csv
+CHUNK_ROWS = 1 << 18
+# upstreamTaskIds of the root task
+ROOT_TASK_ID = -1
+INITIALIZING = 'INITIALIZING'
+# id of the ExchangeReceiver made up for the tasks of a csv, see to_records
+RECEIVER_ID = 0
+# columns of a tracing csv and the fields of the task records they are
+CSV_FIELDS = {
+    'queryTso': 'query_tso',
+    'taskId': 'task_id',
+    'host': 'host',
+    'taskInitTimestamp': 'task_init_timestamp',
+    'compileStartTimestamp': 'compile_start_timestamp',
+    'waitIndexStartTimestamp': 'wait_index_start_timestamp',
+    'waitIndexEndTimestamp': 'wait_index_end_timestamp',
+    'compileEndTimestamp': 'compile_end_timestamp',
+    'taskStartTimestamp': 'task_start_timestamp',
+    'taskEndTimestamp': 'task_end_timestamp',
+    'status': 'status',
+    'errorMessage': 'error_message',
+    'localInputThroughput': 'local_input_throughput',
+    'remoteInputThroughput': 'remote_input_throughput',
+    'outputThroughput': 'output_throughput',
+    'cpuUsage': 'cpu_usage',
+    'memoryPeak': 'memory_peak',
+}
+# strings repeated across many rows are categorical, ids must be present
+CSV_DTYPES = {
+    'queryTso': 'int64',
+    'taskId': 'int64',
+    'host': 'category',
+    'upstreamTaskIds': 'object',
+    'taskInitTimestamp': 'float64',
+    'compileStartTimestamp': 'float64',
+    'waitIndexStartTimestamp': 'float64',
+    'waitIndexEndTimestamp': 'float64',
+    'compileEndTimestamp': 'float64',
+    'taskStartTimestamp': 'float64',
+    'taskEndTimestamp': 'float64',
+    'status': 'category',
+    'errorMessage': 'object',
+    'localInputThroughput': 'float64',
+    'remoteInputThroughput': 'float64',
+    'outputThroughput': 'float64',
+    'cpuUsage': 'float64',
+    'memoryPeak': 'float64',
+}
+# columns read as nan when empty, the other empty strings are kept as they are
+NULLABLE_COLUMNS = ['localInputThroughput', 'remoteInputThroughput', 'outputThroughput', 'cpuUsage']
+# integer columns that may be empty, e.g. the end timestamp of an unfinished task, which are 0 like in the logs
+# they are parsed as float64, much faster than nullable integers and exact for timestamps in microseconds
+ZERO_FILLED_COLUMNS = [c for c in CSV_DTYPES if c.endswith('Timestamp')] + ['memoryPeak']
 
 
 def draw_test():
@@ -63,23 +116,190 @@ def draw(task_sets: TaskSets):
 
 
 def parse(df: pd.DataFrame) -> TaskSets:
-    task_sets = defaultdict(lambda: {})
-    for label, row in df.iterrows():
-        queryTso = row['queryTso']
-        taskId = row['taskId']
-        parents = json.loads(row['upstreamTaskIds'])
-        outputThroughput = row['outputThroughput']
-        task_sets[queryTso][taskId] = {
-            'parents': parents,
-            'outputThroughput': outputThroughput
+    df = final_rows(df)
+    parents = _lists_by(upstream_edges(df), ['queryTso', 'taskId'], 'upstreamTaskId')
+    task_ids = df['taskId'].to_numpy()
+    output_throughputs = df['outputThroughput'].to_numpy()
+    task_sets = {}
+    for query_tso, index in df.groupby('queryTso', sort=False).indices.items():
+        query_tso = int(query_tso)
+        task_sets[query_tso] = {
+            task_id: {
+                'parents': parents.get((query_tso, task_id), []),
+                'outputThroughput': output_throughput
+            }
+            for task_id, output_throughput in zip(task_ids[index].tolist(), output_throughputs[index].tolist())
         }
-    return dict(task_sets)
+    return task_sets
 
 
-def read_csv(filename: str) -> pd.DataFrame:
-    df = pd.read_csv(filename)
-    df = df[['queryTso', 'taskId', 'upstreamTaskIds', 'outputThroughput']]
-    return df
+def read_csv_chunks(filename: str, chunk_rows: int = CHUNK_ROWS) -> Iterator[pd.DataFrame]:
+    '''
+    Yields the known columns of a tracing csv, chunk_rows rows at a time, with the dtypes of CSV_DTYPES, so no column
+    is inferred from the data or held as python objects except the strings. Empty cells of ZERO_FILLED_COLUMNS are 0.
+    '''
+    chunks = pd.read_csv(filename, usecols=lambda c: c in CSV_DTYPES, dtype=CSV_DTYPES, chunksize=chunk_rows,
+                         keep_default_na=False, na_values={c: [''] for c in NULLABLE_COLUMNS + ZERO_FILLED_COLUMNS})
+    try:
+        for chunk in chunks:
+            for column in ZERO_FILLED_COLUMNS:
+                if column in chunk.columns:
+                    chunk[column] = chunk[column].fillna(0).astype('int64')
+            yield chunk
+    except ValueError as e:
+        raise ValueError('failed to read tracing csv {}, queryTso and taskId must be integers: {}'.format(
+            filename, e)) from e
+
+
+def read_csv(filename: str, chunk_rows: int = CHUNK_ROWS) -> pd.DataFrame:
+    '''
+    The known columns of a tracing csv, read by chunks, the categories of each chunk being unified before they are
+    concatenated so that string columns stay categorical.
+    '''
+    chunks = list(read_csv_chunks(filename, chunk_rows))
+    if not chunks:
+        return pd.DataFrame({c: pd.Series(dtype='int64' if c in ZERO_FILLED_COLUMNS else t)
+                             for c, t in CSV_DTYPES.items()})
+    for column in chunks[0].columns:
+        if chunks[0][column].dtype.name == 'category':
+            categories = union_categoricals([chunk[column] for chunk in chunks]).categories
+            for chunk in chunks:
+                chunk[column] = chunk[column].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def final_rows(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    One row per (queryTso, taskId), the terminal one if any, like stats.TaskColumns.final_states: a task may have an
+    INITIALIZING row and a FINISHED or CANCELLED one.
+    '''
+    if len(df) == 0:
+        return df
+    terminal = (df['status'] != INITIALIZING).to_numpy() if 'status' in df.columns else np.ones(len(df), dtype=bool)
+    tso = df['queryTso'].to_numpy()
+    tid = df['taskId'].to_numpy()
+    order = np.lexsort((terminal, tid, tso))
+    tso = tso[order]
+    tid = tid[order]
+    # the last of each run of equal keys, which is terminal if the task has a terminal row
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (tso[1:] != tso[:-1]) | (tid[1:] != tid[:-1])
+    if last.all():
+        return df
+    return df.iloc[np.sort(order[last])].reset_index(drop=True)
+
+
+def upstream_edges(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    The upstreamTaskIds lists of all tasks exploded into a (queryTso, taskId, upstreamTaskId) table, without the -1
+    of root tasks.
+    '''
+    ids = df['upstreamTaskIds'].str.strip('[] ').str.split(',')
+    edges = pd.DataFrame({'queryTso': df['queryTso'], 'taskId': df['taskId'], 'upstreamTaskId': ids})
+    edges = edges.explode('upstreamTaskId')
+    upstream = pd.to_numeric(edges['upstreamTaskId'].str.strip(), errors='coerce')
+    keep = upstream.notna() & (upstream != ROOT_TASK_ID)
+    return pd.DataFrame({
+        'queryTso': edges['queryTso'][keep],
+        'taskId': edges['taskId'][keep],
+        'upstreamTaskId': upstream[keep].astype('int64'),
+    }).reset_index(drop=True)
+
+
+def _lists_by(edges, key_columns, value_column):
+    '''
+    {(key values): [values]} of a table, grouped by a single stable sort and split where the keys change, instead of
+    calling a python function per group. Values keep their order within each group.
+    '''
+    if len(edges) == 0:
+        return {}
+    edges = edges.sort_values(key_columns, kind='stable')
+    keys = [edges[c].to_numpy() for c in key_columns]
+    changed = np.zeros(len(edges), dtype=bool)
+    changed[0] = True
+    for k in keys:
+        changed[1:] |= k[1:] != k[:-1]
+    starts = np.flatnonzero(changed)
+    values = edges[value_column].tolist()
+    bounds = starts.tolist() + [len(values)]
+    return dict(zip(zip(*(k[starts].tolist() for k in keys)), (values[a:b] for a, b in zip(bounds, bounds[1:]))))
+
+
+def _nan_to_none(values):
+    return [None if v != v else v for v in values]
+
+
+def to_records(df: pd.DataFrame) -> Iterator[Dict[str, Any]]:
+    '''
+    Yields the task records of a tracing csv in the json format of task_dag, so they can be rendered like parsed logs.
+    The csv has no executors, upstreamTaskIds being the tasks a task sends to, so each task gets an ExchangeSender
+    sending to them, with the same id for the tasks sending to the same tasks, which makes them a stage, and an
+    ExchangeReceiver receiving from the tasks sending to it.
+    '''
+    df = final_rows(df)
+    edges = upstream_edges(df)
+    targets = _lists_by(edges, ['queryTso', 'taskId'], 'upstreamTaskId')
+    sources = _lists_by(edges, ['queryTso', 'upstreamTaskId'], 'taskId')
+    # numbered from 1 in each query
+    stages = df.groupby(['queryTso', 'upstreamTaskIds'], sort=False).ngroup()
+    stages = stages.groupby(df['queryTso'], sort=False).rank(method='dense').astype('int64').tolist()
+    fields = [(f, c) for c, f in CSV_FIELDS.items() if c in df.columns and f not in ('query_tso', 'task_id')]
+    columns = [_nan_to_none(df[c].tolist()) if c in NULLABLE_COLUMNS else df[c].tolist() for f, c in fields]
+    for query_tso, task_id, stage, values in zip(df['queryTso'].tolist(), df['taskId'].tolist(), stages,
+                                                 zip(*columns)):
+        key = (query_tso, task_id)
+        receiver_sources = sources.get(key, [])
+        record = {'query_tso': query_tso, 'task_id': task_id, 'sender_executor_id': stage, 'executors': [
+            {'id': stage, 'type': 'ExchangeSender', 'sender_target_task_ids': targets.get(key, []),
+             'children': [RECEIVER_ID] if receiver_sources else []},
+        ]}
+        if receiver_sources:
+            record['executors'].append(
+                {'id': RECEIVER_ID, 'type': 'ExchangeReceiver', 'receiver_source_task_ids': receiver_sources,
+                 'children': []})
+        record.update(zip((f for f, c in fields), values))
+        yield record
+
+
+def _span_ms(df, start_column, end_column):
+    # missing timestamps are 0, like in the logs
+    if start_column not in df.columns or end_column not in df.columns:
+        return np.full(len(df), np.nan)
+    start = df[start_column].to_numpy(dtype=np.float64)
+    end = df[end_column].to_numpy(dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        return np.where((start != 0) & (end != 0), (end - start) / 1000, np.nan)
+
+
+def _codes(column):
+    values = column.astype('category').cat
+    return values.codes.to_numpy(dtype=np.int32), values.categories.to_numpy(dtype=str)
+
+
+def task_columns(df: pd.DataFrame):
+    '''
+    stats.TaskColumns of a tracing csv, built column by column, with only the final state of each task.
+    '''
+    import stats
+    metrics = {
+        'duration_ms': _span_ms(df, 'taskStartTimestamp', 'taskEndTimestamp'),
+        'compile_ms': _span_ms(df, 'compileStartTimestamp', 'compileEndTimestamp'),
+        'wait_index_ms': _span_ms(df, 'waitIndexStartTimestamp', 'waitIndexEndTimestamp'),
+    }
+    for metric, column in [('local_input_throughput', 'localInputThroughput'),
+                           ('remote_input_throughput', 'remoteInputThroughput'),
+                           ('output_throughput', 'outputThroughput'), ('memory_peak', 'memoryPeak')]:
+        if column in df.columns:
+            metrics[metric] = df[column].to_numpy(dtype=np.float64)
+        else:
+            metrics[metric] = np.full(len(df), np.nan)
+    host_codes, hosts = _codes(df['host'] if 'host' in df.columns else pd.Series([''] * len(df)))
+    status_codes, statuses = _codes(df['status'] if 'status' in df.columns else pd.Series([''] * len(df)))
+    terminal = statuses[status_codes] != 'INITIALIZING' if len(df) else np.zeros(0, dtype=bool)
+    return stats.TaskColumns(
+        df['queryTso'].to_numpy(dtype=np.int64), df['taskId'].to_numpy(dtype=np.int64), terminal,
+        host_codes, hosts, status_codes, statuses, metrics,
+        np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.array([], dtype=str)).final_states()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,18 @@
-import json
 import logging
+import statistics
 from collections import defaultdict
 from typing import Any, Dict, List
 
 import graphviz
 
+import task_model
+import trace_event
 from utils import read_json
 
 OUTPUT_DIR = 'output'
+# queries with more tasks than this are drawn with one node per stage by default, laying out every executor of
+# every task takes dot minutes for wide queries
+COLLAPSE_THRESHOLD = 100
 
 
 def _gen_label_executor(detail):
@@ -92,17 +97,24 @@ class InputStreamGraph:
 
 
 class TaskGraph:
-    def __init__(self, task):
+    def __init__(self, task, on_critical_path=False, straggler=False):
         self._task = task
-        self._executors = _trans_list_to_id_map(task['executors'])
-        self._task_id = task['task_id']
+        self._executors = task.executor_map()
+        self._task_id = task.task_id
         self._receiver_sources: Dict[int, List[int]] = {}
-        self._g = graphviz.Digraph(name='cluster_'+str(task['task_id']), comment='task')
-        if self._task['status'] == 'FINISHED' and self._task['error_message'] == '':
-            self._g.attr(label=_gen_label_executor_task(task), labeljust='l', labelloc='b', style='solid')
-        else:
+        self._g = graphviz.Digraph(name='cluster_'+str(task.task_id), comment='task')
+        style = 'bold' if on_critical_path else 'solid'
+        if task.failed:
+            self._g.attr(label=_gen_label_executor_task(task), labeljust='l',
+                         labelloc='b', style=style, color='red', penwidth='3')
+        elif straggler:
             self._g.attr(label=_gen_label_executor_task(task), labeljust='l',
-                         labelloc='b', style='solid', color='red', penwidth='3')
+                         labelloc='b', style=style + ',dashed', color='darkorange', penwidth='3')
+        elif on_critical_path:
+            self._g.attr(label=_gen_label_executor_task(task), labeljust='l',
+                         labelloc='b', style=style, color='blue', penwidth='3')
+        else:
+            self._g.attr(label=_gen_label_executor_task(task), labeljust='l', labelloc='b', style=style)
 
     @property
     def g(self):
@@ -114,12 +126,11 @@ class TaskGraph:
 
     @property
     def sender_executor_id(self):
-        return self._task['sender_executor_id']
+        return self._task.sender_executor_id
 
     @property
     def sender_executor(self):
-        sender_executor_id = self._task['sender_executor_id']
-        return self._executors[sender_executor_id]
+        return self._executors[self._task.sender_executor_id]
 
     @property
     def receiver_sources(self):
@@ -132,17 +143,17 @@ class TaskGraph:
 
     def _collect_receiver_sources(self):
         for eid, e in self._executors.items():
-            if 'receiver_source_task_ids' in e:
-                self._receiver_sources[eid] = e['receiver_source_task_ids']
+            if e.receiver_source_task_ids is not None:
+                self._receiver_sources[eid] = e.receiver_source_task_ids
 
     def _draw_executor_nodes(self):
         for eid, e in self._executors.items():
-            label = '{}_{}\l{}'.format(e['type'], e['id'], _gen_label_executor(e))
+            label = '{}_{}\l{}'.format(e.type, e.id, _gen_label_executor(e))
             self._g.node(self.get_node_id(eid), label, shape='box')
 
     def _draw_executor_edges(self):
         for eid, e in self._executors.items():
-            for child_id in e['children']:
+            for child_id in e.children:
                 self._g.edge(self.get_node_id(child_id), self.get_node_id(eid), weight='0')
 
     def get_node_id(self, node_id):
@@ -150,11 +161,15 @@ class TaskGraph:
 
 
 class Graph:
-    def __init__(self):
+    def __init__(self, critical_path=None):
         self._g = graphviz.Digraph(comment='main')
         self._g.attr(rankdir='BT', splines='line')
         self._task_graphs: Dict[int, TaskGraph] = {}
         self._stages: Dict[int, List[TaskGraph]] = defaultdict(list)
+        # (sender task id, receiver task id) of the exchange edges on the critical path
+        self._critical_edges = set()
+        if critical_path:
+            self._critical_edges = set(zip(critical_path, critical_path[1:]))
 
     def addTaskGraph(self, task_graph: TaskGraph):
         # self._g.subgraph(task_graph.g)
@@ -182,7 +197,10 @@ class Graph:
                     sender_task_graph = self._task_graphs[sender_task_id]
                     sender_executor_id = sender_task_graph.sender_executor_id
                     sender_node_id = sender_task_graph.get_node_id(sender_executor_id)
-                    self._g.edge(sender_node_id, receiver_node_id, color='red', style='dashed')
+                    if (sender_task_id, receiver_task_id) in self._critical_edges:
+                        self._g.edge(sender_node_id, receiver_node_id, color='blue', style='bold', penwidth='3')
+                    else:
+                        self._g.edge(sender_node_id, receiver_node_id, color='red', style='dashed')
 
     def render(self, filename, format):
         self._draw_stages()
@@ -190,12 +208,194 @@ class Graph:
         self._g.render(filename, format=format)
 
 
-def draw_tasks_dag(data, filename, format='png'):
+def _span_ms(task, start_key, end_key):
+    start = getattr(task, start_key)
+    end = getattr(task, end_key)
+    if not start or not end:
+        return None
+    return max(0, end - start) / 1000
+
+
+# aggregated metrics of the tasks of a stage, as (label, function of a task)
+STAGE_METRICS = [
+    ('duration(ms)', lambda t: _span_ms(t, 'task_start_timestamp', 'task_end_timestamp')),
+    ('compile(ms)', lambda t: _span_ms(t, 'compile_start_timestamp', 'compile_end_timestamp')),
+    ('wait_index(ms)', lambda t: _span_ms(t, 'wait_index_start_timestamp', 'wait_index_end_timestamp')),
+    ('local_input_throughput', lambda t: t.local_input_throughput),
+    ('remote_input_throughput', lambda t: t.remote_input_throughput),
+    ('output_throughput', lambda t: t.output_throughput),
+]
+
+
+def _gen_label_stage(sender_executor_id, tasks, stragglers=()):
+    failed = sum(1 for t in tasks if t.failed)
+    executors = ', '.join('{}_{}'.format(e.type, e.id) for e in tasks[0].executors_from_root())
+    labels = [
+        'stage {}'.format(sender_executor_id),
+        executors,
+        'tasks: {}, hosts: {}, failed: {}'.format(len(tasks), len(set(t.host for t in tasks)), failed),
+        '{:<24} {:>10} {:>10} {:>10}'.format('', 'min', 'median', 'max'),
+    ]
+    for name, func in STAGE_METRICS:
+        values = [v for v in (func(t) for t in tasks) if v is not None]
+        if not values:
+            continue
+        labels.append('{:<24} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            name, min(values), statistics.median(values), max(values)))
+    straggling = ['{}@{}'.format(t.task_id, t.host) for t in tasks if t.task_id in stragglers]
+    if straggling:
+        labels.append('stragglers: {}'.format(', '.join(straggling)))
+    return '\l'.join(labels) + '\l'
+
+
+class StageGraph:
+    '''
+    Collapsed view of a query, one node per stage, i.e. the tasks sharing a sender_executor_id, with the timings and
+    throughput of its tasks aggregated, and one edge per pair of stages exchanging data.
+    The size of the graph only depends on the plan of the query, not on the number of tasks.
+    '''
+
+    def __init__(self, critical_path=None, stragglers=None):
+        self._g = graphviz.Digraph(comment='main')
+        self._g.attr(rankdir='BT', splines='line')
+        self._stages: Dict[int, List[task_model.Task]] = defaultdict(list)
+        self._critical_path = critical_path or []
+        self._stragglers = stragglers or set()
+
+    def add_task(self, task):
+        self._stages[task.sender_executor_id].append(task)
+
+    def _draw_stages(self):
+        critical_tasks = set(self._critical_path)
+        for sender_executor_id, tasks in sorted(self._stages.items()):
+            attrs = {'shape': 'box', 'fontname': 'monospace'}
+            if any(t.failed for t in tasks):
+                attrs.update(color='red', penwidth='3')
+            elif any(t.task_id in self._stragglers for t in tasks):
+                attrs.update(color='darkorange', style='dashed', penwidth='3')
+            elif any(t.task_id in critical_tasks for t in tasks):
+                attrs.update(color='blue', style='bold', penwidth='3')
+            self._g.node('stage-{}'.format(sender_executor_id),
+                         _gen_label_stage(sender_executor_id, tasks, self._stragglers), **attrs)
+
+    def _draw_exchanges(self):
+        stage_of_task = {t.task_id: sender_executor_id
+                         for sender_executor_id, tasks in self._stages.items() for t in tasks}
+        critical_edges = set(zip(self._critical_path, self._critical_path[1:]))
+        # (sender stage, receiver stage) -> [number of task pairs, on the critical path]
+        edges = {}
+        for receiver_stage, tasks in self._stages.items():
+            for task in tasks:
+                for sender_task_id in task.upstream_task_ids():
+                    if sender_task_id not in stage_of_task:
+                        logging.error('failed to get source task with task_id [{}] for receiver task [{}]'.format(
+                            sender_task_id, task.task_id))
+                        continue
+                    edge = edges.setdefault((stage_of_task[sender_task_id], receiver_stage), [0, False])
+                    edge[0] += 1
+                    edge[1] = edge[1] or (sender_task_id, task.task_id) in critical_edges
+        for (sender_stage, receiver_stage), (count, critical) in sorted(edges.items()):
+            attrs = {'color': 'blue', 'style': 'bold', 'penwidth': '3'} if critical else {'color': 'red', 'style': 'dashed'}
+            self._g.edge('stage-{}'.format(sender_stage), 'stage-{}'.format(receiver_stage),
+                         label='{} exchanges'.format(count), **attrs)
+
+    def render(self, filename, format):
+        self._draw_stages()
+        self._draw_exchanges()
+        self._g.render(filename, format=format)
+
+
+def _slowdown_color(ratio):
+    '''
+    Fill color of a stage that got `ratio` times slower, white when unchanged, red from twice as slow and green from
+    twice as fast.
+    '''
+    if ratio is None:
+        return '#dddddd'
+    if ratio >= 1:
+        level = min(1.0, ratio - 1)
+        return '#ff{0:02x}{0:02x}'.format(int(255 * (1 - level)))
+    level = min(1.0, (1 / ratio - 1) if ratio > 0 else 1)
+    return '#{0:02x}ff{0:02x}'.format(int(255 * (1 - level)))
+
+
+def _gen_label_diff_stage(stage):
+    sid_a, sid_b = stage['stage']
+    labels = [
+        'stage {} -> {}'.format('-' if sid_a is None else sid_a, '-' if sid_b is None else sid_b),
+        stage['executors'],
+        'tasks: {} -> {}'.format(*stage['task_count']),
+        '{:<24} {:>10} {:>10} {:>8}'.format('', 'a', 'b', 'ratio'),
+    ]
+    for name, d in stage['metrics'].items():
+        if d['a'] is None and d['b'] is None:
+            continue
+        scale = 1 if name.endswith('throughput') else 1000
+        labels.append('{:<24} {:>10} {:>10} {:>8}'.format(
+            name if scale == 1 else name + '(ms)',
+            '-' if d['a'] is None else '{:.3f}'.format(d['a'] / scale),
+            '-' if d['b'] is None else '{:.3f}'.format(d['b'] / scale),
+            '-' if d['ratio'] is None else '{:.2f}x'.format(d['ratio'])))
+    return '\l'.join(labels) + '\l'
+
+
+class DiffStageGraph(StageGraph):
+    '''
+    Stage graph of the second query of a report of diff.diff_queries, each stage filled by how much slower it got than the aligned
+    stage of the first query, and stages only in the first query drawn dashed without edges.
+    '''
+
+    def __init__(self, report):
+        super().__init__()
+        self._report = report
+
+    def _draw_stages(self):
+        for stage in self._report['stages']:
+            sid_a, sid_b = stage['stage']
+            attrs = {'shape': 'box', 'fontname': 'monospace', 'style': 'filled',
+                     'fillcolor': _slowdown_color(stage['slowdown'])}
+            if sid_b is None:
+                attrs['style'] = 'filled,dashed'
+                node_id = 'removed-stage-{}'.format(sid_a)
+            else:
+                node_id = 'stage-{}'.format(sid_b)
+            self._g.node(node_id, _gen_label_diff_stage(stage), **attrs)
+
+
+def draw_diff_dag(report, tasks_b, filename, format='png'):
+    '''
+    Draw a report of diff.diff_queries on the stages of its second query, whose tasks are tasks_b.
+    '''
+    graph = DiffStageGraph(report)
+    for task in task_model.to_tasks(tasks_b):
+        graph.add_task(task)
+    graph.render(filename, format)
+
+
+def draw_tasks_dag(data, filename, format='png', critical_path=None, collapse_threshold=COLLAPSE_THRESHOLD,
+                   stragglers=None):
+    '''
+    critical_path is a list of task ids from leaf to root, whose tasks and exchange edges are drawn in bold blue.
+    stragglers is a set of task ids, see analysis.stage_skew, whose tasks, or stages when collapsed, get a dashed orange
+    border.
+    Queries with more than collapse_threshold tasks are drawn as a StageGraph, None never collapses.
+    data is a list of task_model.Task, json records are converted.
+    '''
+    data = list(task_model.to_tasks(data))
     if filename is None:
         filename = '{}/query_task.dot'.format(OUTPUT_DIR)
-    graph = Graph()
+    if collapse_threshold is not None and len(data) > collapse_threshold:
+        logging.debug('collapse {} tasks into stages'.format(len(data)))
+        stage_graph = StageGraph(critical_path, stragglers)
+        for task in data:
+            stage_graph.add_task(task)
+        stage_graph.render(filename, format)
+        return
+    graph = Graph(critical_path)
+    on_critical_path = set(critical_path or [])
+    stragglers = stragglers or set()
     for task in data:
-        task_graph = TaskGraph(task)
+        task_graph = TaskGraph(task, task.task_id in on_critical_path, task.task_id in stragglers)
         task_graph.draw_executors()
         graph.addTaskGraph(task_graph)
     graph.render(filename, format)
@@ -211,74 +411,16 @@ def draw_input_streams():
     graph.render()
 
 
-# TODO: query tso should be fixed
-def draw_input_streams_timeline():
-    data = read_json('/Users/dragonly/Downloads/test-input-streams(1).json')
-    events = []
-    task_id_set = set()
-
-    # first round, collect metadata events (M)
-    # for the moment, we use ui.perfetto.dev to draw the timeline
-    # using task as process/stream as thread is good for drawing
-    for task in data:
-        task_id = task['query_tso']
-        if task_id not in task_id_set:
-            task_id_set.add(task_id)
-            events.append({
-                'pid': task_id,
-                'ph': 'M',
-                'name': 'process_name',
-                'args': {'name': 'task {}'.format(task_id)}
-            })
-        input_streams = task['input_streams']
-        for stream in input_streams:
-            stream_id = stream['id']
-            events.append({
-                'pid': task_id,
-                'tid': stream_id,
-                'ph': 'M',
-                'name': 'thread_name',
-                'args': {'name': 'stream {}'.format(stream_id)}
-            })
-
-    # second round, collect counter events
-    for task in data:
-        task_id = task['query_tso']
-        input_streams = task['input_streams']
-        for stream in input_streams:
-            stream_id = stream['id']
-            name = '[{}] {}({})'.format(stream_id, stream['name'], stream['executor'])
-            stats = stream['stat']
-            timeline_push = stats['timeline']['push']
-            timeline_pull = stats['timeline']['pull']
-            timeline_self = stats['timeline']['self']
-            events_push = _gen_counter_events(task_id, stream_id, name, timeline_push, timeline_pull, timeline_self)
-            events.extend(events_push)
-
-    with open('output/timeline.json', 'w') as fd:
-        json.dump(events, fd)
-
-# currently we assume that each
-
-
-def _gen_counter_events(pid, tid, name, push, pull, self):
-    ret = []
-    ts = 1
-    for c1, c2, c3 in zip(push, pull, self):
-        ret.append({
-            'pid': pid,
-            'tid': tid,
-            'ph': 'C',
-            'name': name,
-            'ts': ts,
-            'args': {'push': c1, 'pull': c2, 'self': c3}
-        })
-        ts += 100*1000  # microsecond
-    return ret
+def draw_input_streams_timeline(data, filename):
+    '''
+    Trace of the tasks in data and the timelines of their input streams, to be opened in ui.perfetto.dev.
+    '''
+    trace_event.write_tasks_trace(data, filename)
 
 
 if __name__ == '__main__':
     # TODO: consider multiple query tso
     draw_tasks_dag(read_json('/Users/dragonly/Downloads/multi_machine_mpp_task_tracing.json'))
     # draw_input_streams()
-    # draw_input_streams_timeline()
+    # draw_input_streams_timeline(read_json('/Users/dragonly/Downloads/test-input-streams(1).json'),
+    #                             '{}/timeline.json'.format(OUTPUT_DIR))
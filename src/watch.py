@@ -0,0 +1,318 @@
+import heapq
+import json
+import logging
+import os
+import select
+import socket
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import collector
+import log_parser
+
+# size of each non-blocking read from a channel
+READ_SIZE = 1 << 16
+# a query is done once all its tasks are terminal and nothing has been logged for it for this long, since the tasks
+# of a query on different hosts are not initialized at exactly the same time
+QUERY_GRACE_SECONDS = 2
+# queries whose tasks never finish, e.g. because a tiflash server crashed, are dropped after this long
+STALE_QUERY_SECONDS = 600
+# number of recently failed tasks shown in the summary
+RECENT_FAILED_TASKS = 10
+MAX_RECONNECT_DELAY = 60
+
+
+class WatchOptions:
+    '''
+    Options of a single `watch` run, durations are in seconds.
+    '''
+
+    def __init__(self, tso=None, timeout=60, interval=2, window=60, top=10, duration=None, parallelism=16):
+        self.tso = tso
+        self.timeout = timeout
+        self.interval = interval
+        self.window = window
+        self.top = top
+        self.duration = duration
+        self.parallelism = parallelism
+
+
+class _QueryState:
+    def __init__(self, now):
+        self.pending = set()  # ids of the tasks seen INITIALIZING but not terminal yet
+        self.tasks = 0
+        self.failed = 0
+        self.init = None
+        self.end = None
+        self.last_seen = now
+
+
+class WatchSummary:
+    '''
+    Rolling summary of the task records seen so far, the INITIALIZING and terminal records of each task being paired
+    as they arrive.
+    '''
+
+    def __init__(self, window=60, top=10, now=None):
+        self.window = window
+        self.top = top
+        self.started_at = time.time() if now is None else now
+        self.records = 0
+        self.tasks_finished = 0
+        self.tasks_failed = 0
+        self.queries_completed = 0
+        self.queries_stale = 0
+        self._queries = {}
+        self._completions = deque()
+        self._task_completions = deque()
+        self._slowest = []  # min heap of (duration, query_tso, task_count, failed_tasks)
+        self._failed = deque(maxlen=RECENT_FAILED_TASKS)
+
+    def add(self, record, now):
+        '''
+        Account a task record, returns it if it is the final state of its task, else None.
+        '''
+        self.records += 1
+        query = self._queries.get(record['query_tso'])
+        if query is None:
+            query = self._queries[record['query_tso']] = _QueryState(now)
+        query.last_seen = now
+        init = record.get('task_init_timestamp')
+        if init and (query.init is None or init < query.init):
+            query.init = init
+        if record.get('status') == 'INITIALIZING':
+            query.pending.add(record['task_id'])
+            return None
+        # a task initialized before watching started only shows up with its terminal record
+        query.pending.discard(record['task_id'])
+        query.tasks += 1
+        end = record.get('task_end_timestamp')
+        if end and (query.end is None or end > query.end):
+            query.end = end
+        self._task_completions.append(now)
+        if record.get('status') != 'FINISHED' or record.get('error_message'):
+            query.failed += 1
+            self.tasks_failed += 1
+            self._failed.append({k: record.get(k) for k in ('query_tso', 'task_id', 'host', 'status', 'error_message')})
+        else:
+            self.tasks_finished += 1
+        return record
+
+    def tick(self, now):
+        '''
+        Retire the queries that are done or stale, and the completions out of the window.
+        '''
+        for query_tso, query in list(self._queries.items()):
+            idle = now - query.last_seen
+            if not query.pending and query.tasks > 0 and idle >= QUERY_GRACE_SECONDS:
+                self.queries_completed += 1
+                self._completions.append(now)
+                duration = query.end - query.init if query.init and query.end else 0
+                item = (duration, query_tso, query.tasks, query.failed)
+                if len(self._slowest) < self.top:
+                    heapq.heappush(self._slowest, item)
+                else:
+                    heapq.heappushpop(self._slowest, item)
+                del self._queries[query_tso]
+            elif idle >= STALE_QUERY_SECONDS:
+                logging.warning('query_tso [{}] has {} tasks not finished after {}s, dropped'.format(
+                    query_tso, len(query.pending), STALE_QUERY_SECONDS))
+                self.queries_stale += 1
+                del self._queries[query_tso]
+        for completions in (self._completions, self._task_completions):
+            while completions and completions[0] < now - self.window:
+                completions.popleft()
+
+    def snapshot(self, now, hosts=None):
+        window = max(1e-6, min(self.window, now - self.started_at))
+        return {
+            'updated_at': now,
+            'elapsed': now - self.started_at,
+            'records': self.records,
+            'tasks_finished': self.tasks_finished,
+            'tasks_failed': self.tasks_failed,
+            'tasks_in_flight': sum(len(q.pending) for q in self._queries.values()),
+            'tasks_per_second': len(self._task_completions) / window,
+            'queries_completed': self.queries_completed,
+            'queries_in_flight': len(self._queries),
+            'queries_stale': self.queries_stale,
+            'queries_per_second': len(self._completions) / window,
+            'slowest_queries': [{'query_tso': tso, 'duration_ms': duration / 1000, 'task_count': tasks, 'failed_tasks': failed}
+                                for duration, tso, tasks, failed in sorted(self._slowest, reverse=True)],
+            'recent_failed_tasks': list(self._failed),
+            'hosts': hosts or [],
+        }
+
+
+def format_summary(snapshot, window):
+    lines = ['watching {} hosts for {:.0f}s, {} records'.format(
+        len(snapshot['hosts']), snapshot['elapsed'], snapshot['records'])]
+    lines.append('queries: {} completed, {} in flight, {:.2f} queries/s over the last {}s'.format(
+        snapshot['queries_completed'], snapshot['queries_in_flight'], snapshot['queries_per_second'], window))
+    lines.append('tasks:   {} finished, {} failed, {} in flight, {:.2f} tasks/s'.format(
+        snapshot['tasks_finished'], snapshot['tasks_failed'], snapshot['tasks_in_flight'], snapshot['tasks_per_second']))
+    lines.append('')
+    lines.append('{:<24} {:<10} {:>10}  {}'.format('host', 'status', 'lines', 'error'))
+    for h in snapshot['hosts']:
+        lines.append('{:<24} {:<10} {:>10}  {}'.format(
+            h['host'], 'connected' if h['connected'] else 'down', h['lines'], h['error']))
+    lines.append('')
+    lines.append('slowest queries:')
+    lines.append('  {:<20} {:>12} {:>8} {:>8}'.format('query_tso', 'duration_ms', 'tasks', 'failed'))
+    for q in snapshot['slowest_queries']:
+        lines.append('  {:<20} {:>12.3f} {:>8} {:>8}'.format(
+            q['query_tso'], q['duration_ms'], q['task_count'], q['failed_tasks']))
+    if snapshot['recent_failed_tasks']:
+        lines.append('')
+        lines.append('recently failed tasks:')
+        for t in snapshot['recent_failed_tasks']:
+            lines.append('  {:<20} {:>8} {:<22} {:<10} {}'.format(
+                t['query_tso'], t['task_id'], t['host'] or '', t['status'] or '', t['error_message'] or ''))
+    return lines
+
+
+class _Host:
+    def __init__(self, server):
+        self.server = server
+        self.host = server['host']
+        self.ssh = None
+        self.channel = None
+        self.future = None
+        self.buffer = bytearray()
+        self.lines = 0
+        self.failures = 0
+        self.retry_at = 0
+        self.error = ''
+
+    def status(self):
+        return {'host': self.host, 'connected': self.channel is not None, 'lines': self.lines, 'error': self.error}
+
+    def disconnect(self, error, now):
+        if self.ssh is not None:
+            self.ssh.close()
+        self.ssh = None
+        self.channel = None
+        self.buffer.clear()
+        self.failures += 1
+        self.error = error
+        self.retry_at = now + min(2 ** (self.failures - 1), MAX_RECONNECT_DELAY)
+        logging.warning('lost {}: {}, reconnecting in {:.0f}s'.format(self.host, error, self.retry_at - now))
+
+
+def _close_late_connection(future):
+    # a connection opened while watching stops
+    if not future.cancelled() and future.exception() is None:
+        future.result()[0].close()
+
+
+class Watcher:
+    '''
+    Follows the tracing lines of all tiflash servers over one persistent ssh channel per host.
+    A single thread reads all the channels with select and parses lines as they arrive, while connections are opened
+    by a small pool of threads so that a slow host does not stall the others.
+    '''
+
+    def __init__(self, tiflash_servers, username, ssh_key_file, out_dir, options):
+        self._hosts = [_Host(server) for server in tiflash_servers]
+        self._username = username
+        self._ssh_key_file = ssh_key_file
+        self._out_dir = out_dir
+        self._options = options
+        self.summary = WatchSummary(options.window, options.top)
+
+    def _connect(self, pool, now):
+        for h in self._hosts:
+            if h.future is not None and h.future.done():
+                future, h.future = h.future, None
+                try:
+                    h.ssh, h.channel = future.result()
+                    h.error = ''
+                    logging.info('following tracing lines of {}'.format(h.host))
+                except Exception as e:
+                    h.disconnect('{}: {}'.format(type(e).__name__, e), now)
+            if h.channel is None and h.future is None and now >= h.retry_at:
+                h.future = pool.submit(collector.open_follow_channel, h.server, self._username, self._ssh_key_file,
+                                       self._options.tso, self._options.timeout)
+
+    def _read(self, h, now, records_fd):
+        try:
+            data = h.channel.recv(READ_SIZE)
+        except socket.timeout:
+            return
+        if not data:
+            h.disconnect('remote command exited with {}'.format(
+                h.channel.recv_exit_status() if h.channel.exit_status_ready() else 'unknown status'), now)
+            return
+        h.buffer += data
+        # only complete lines are parsed, the rest stays in the buffer until the next read
+        end = h.buffer.rfind(b'\n') + 1
+        if end == 0:
+            return
+        lines = bytes(h.buffer[:end])
+        del h.buffer[:end]
+        h.lines += lines.count(b'\n')
+        for payload in log_parser.scan_payloads(lines, 0, len(lines)):
+            text = log_parser.decode_payload(payload)
+            if text is None:
+                continue
+            record = self.summary.add(json.loads(text), now)
+            if record is not None:
+                records_fd.write(text)
+                records_fd.write('\n')
+
+    def _refresh(self, now):
+        self.summary.tick(now)
+        snapshot = self.summary.snapshot(now, [h.status() for h in self._hosts])
+        filename = os.path.join(self._out_dir, 'summary.json')
+        with open(filename + '.tmp', 'wt') as fd:
+            json.dump(snapshot, fd, indent=1)
+        os.replace(filename + '.tmp', filename)
+        lines = format_summary(snapshot, self._options.window)
+        if sys.stdout.isatty():
+            # redraw in place
+            sys.stdout.write('\x1b[H\x1b[2J')
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
+    def run(self):
+        '''
+        Watch until options.duration seconds have passed, or forever if it is None.
+        Final task records are appended to watch.ndjson in out_dir, and the summary is kept in summary.json.
+        '''
+        start = time.time()
+        deadline = start + self._options.duration if self._options.duration else None
+        next_refresh = start
+        pool = ThreadPoolExecutor(max_workers=max(1, min(self._options.parallelism, len(self._hosts))))
+        try:
+            with open(os.path.join(self._out_dir, 'watch.ndjson'), 'at') as records_fd:
+                while True:
+                    now = time.time()
+                    if deadline is not None and now >= deadline:
+                        break
+                    self._connect(pool, now)
+                    if now >= next_refresh:
+                        records_fd.flush()
+                        self._refresh(now)
+                        next_refresh = now + self._options.interval
+                    # wake up regularly to pick up new connections
+                    wait = max(0, min(next_refresh - now, 0.5))
+                    connected = [h for h in self._hosts if h.channel is not None]
+                    if not connected:
+                        time.sleep(wait)
+                        continue
+                    readable, _, _ = select.select([h.channel for h in connected], [], [], wait)
+                    now = time.time()
+                    for h in connected:
+                        if h.channel in readable:
+                            self._read(h, now, records_fd)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            for h in self._hosts:
+                if h.future is not None:
+                    h.future.add_done_callback(_close_late_connection)
+                if h.ssh is not None:
+                    h.ssh.close()
+                h.ssh = h.channel = None
+            self._refresh(time.time())